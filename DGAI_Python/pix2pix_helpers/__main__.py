@@ -0,0 +1,4 @@
+import sys
+from pix2pix_helpers.cli import main
+
+sys.exit(main())
@@ -0,0 +1,380 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+
+##
+# Performance benchmarks of the pix2pix pipeline, on synthetic images so no dataset is needed.
+#   python -m pix2pix_helpers.benchmark --out results.json --baseline baseline.json
+# Results are written as json. When a baseline is given, every metric that got worse than the
+# tolerance allows is flagged and the exit code is 1. Use --save-baseline to store a new baseline.
+# Timings are only comparable between runs on the same machine, with the same threads and sizes.
+# The train suite measures the step time and peak RSS at every --threads count (1,4,<cores> by default).
+# The startup suite also checks the CLI commands against STARTUP_BUDGETS, and fails the same way.
+# --check-startup runs only that check, as an assertion that fails when a budget is exceeded:
+#   python -m pix2pix_helpers.benchmark --check-startup
+# tests/test_cli_startup.py runs it for prepare with the rest of the tests: python -m pytest tests
+##
+
+SUITES = ('loader', 'combine', 'train', 'inference', 'startup')
+
+# CLI commands: (largest startup in ms or None, packages the command must not import).
+# Batch schedulers launch many short prepare jobs, torch alone takes seconds to import
+STARTUP_BUDGETS = {
+    'prepare': (1000, ('torch', 'torchvision', 'matplotlib')),
+    'train': (None, ('matplotlib',)),
+    'test': (None, ('matplotlib',)),
+    'evaluate': (None, ('matplotlib',)),
+    'export': (None, ('torchvision', 'matplotlib')),
+    'fuse': (None, ('matplotlib',)),
+    'distill': (None, ('matplotlib',)),
+    'serve': (None, ('torchvision', 'matplotlib')),
+}
+
+# Whether a larger value of the metric is better, by metric name suffix
+HIGHER_IS_BETTER = {'samples_s': True, 'pairs_s': True, 'img_s': True,
+                    'ms': False, 'rss_mb': False}
+
+
+def make_synthetic_images(root, count, size=256, seed=0):
+    """
+    Writes count pairs of blocky palette images, similar to the Unity grids, to root/A/train and root/B/train.
+    The same seed always produces the same images
+    """
+    rng = np.random.RandomState(seed)
+    palette = np.array([[0, 0, 0], [255, 0, 0], [255, 255, 0], [255, 255, 255]], dtype=np.uint8)
+    for folder in ('A', 'B'):
+        os.makedirs(os.path.join(root, folder, 'train'), exist_ok=True)
+    for i in range(count):
+        cells = rng.randint(0, len(palette), (2, size // 8, size // 8))
+        for folder, grid in zip(('A', 'B'), cells):
+            image = palette[grid].repeat(8, axis=0).repeat(8, axis=1)
+            Image.fromarray(image).save(os.path.join(root, folder, 'train', f'synthetic_{i}.png'))
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process in MB, None where it can not be measured
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes everywhere else
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+def default_threads():
+    """
+    Thread counts of the train suite: 1, 4 and all the intra-op threads of this machine
+    """
+    import torch
+    cores = torch.get_num_threads()
+    return tuple(sorted(set((1, min(4, cores), cores))))
+
+
+def percentiles(times):
+    times_ms = np.array(times) * 1000
+    return {'p50_ms': float(np.percentile(times_ms, 50)), 'p90_ms': float(np.percentile(times_ms, 90)),
+            'p99_ms': float(np.percentile(times_ms, 99))}
+
+
+def bench_combine(root, workers_list=(1, 2)):
+    from pix2pix_helpers.combine_images import combine_images
+    results = {}
+    count = len(os.listdir(os.path.join(root, 'A', 'train')))
+    for workers in workers_list:
+        out = os.path.join(root, f'AB_{workers}', 'train')
+        start = time.perf_counter()
+        combine_images(os.path.join(root, 'A', 'train'), os.path.join(root, 'B', 'train'), out, workers=workers)
+        results[f'combine.workers_{workers}.pairs_s'] = count / (time.perf_counter() - start)
+    # Keep one combined copy for the loader benchmark
+    ab = os.path.join(root, 'AB')
+    if not os.path.isdir(ab):
+        os.rename(os.path.join(root, f'AB_{workers_list[0]}'), ab)
+    return results
+
+
+def bench_loader(root, workers_list=(0, 2, 4), batch_size=4, epochs=2):
+    import torch.utils.data
+    from pix2pix_helpers.create_dataset import ImageFolderLoader
+    results = {}
+    data = ImageFolderLoader(os.path.join(root, 'AB'), phase='train', preprocess='none', batch_transform=True)
+    for workers in workers_list:
+        loader = torch.utils.data.DataLoader(data, batch_size=batch_size, shuffle=True,
+                                            num_workers=workers, collate_fn=data.collate)
+        samples = 0
+        start = time.perf_counter()
+        for _ in range(epochs):
+            for batch in loader:
+                samples += batch['A'].shape[0]
+        results[f'loader.workers_{workers}.samples_s'] = samples / (time.perf_counter() - start)
+    return results
+
+
+def _train_step_job(batch_size, threads, steps, amp, size, checkpoint_depth=0):
+    # Runs in a fresh process, so the peak RSS belongs to this configuration only
+    import torch
+    from pix2pix_helpers.pix2pix_model import Pix2PixModel
+    torch.set_num_threads(threads)
+    torch.manual_seed(0)
+    model = Pix2PixModel(tempfile.gettempdir(), 'benchmark', is_train=True, amp=amp,
+                        checkpoint_depth=checkpoint_depth)
+    data = {'A': torch.rand(batch_size, 3, size, size) * 2 - 1,
+            'B': torch.rand(batch_size, 3, size, size) * 2 - 1, 'A_paths': []}
+    model.set_input(data)
+    model.optimize_parameters()
+
+    times = []
+    for _ in range(steps):
+        start = time.perf_counter()
+        model.optimize_parameters()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)), peak_rss_mb()
+
+
+def bench_train(batch_sizes=(1, 4), threads_list=(1,), steps=3, amp=False, size=256, checkpoint_depths=(0,)):
+    """
+    Step time and peak RSS of the training step, every configuration in its own process.
+    Depths other than 0 use activation checkpointing in the Generator and get a ckpt_<depth> key
+    """
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for threads in threads_list:
+        for batch_size in batch_sizes:
+            for depth in checkpoint_depths:
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    step_time, rss = executor.submit(_train_step_job, batch_size, threads, steps, amp, size,
+                                                    depth).result()
+                key = f'train.batch_{batch_size}.threads_{threads}'
+                if depth != 0:
+                    key += f'.ckpt_{depth}'
+                results[f'{key}.step_ms'] = step_time * 1000
+                results[f'{key}.samples_s'] = batch_size / step_time
+                if rss is not None:
+                    results[f'{key}.peak_rss_mb'] = rss
+    return results
+
+
+def bench_inference(root, batch_sizes=(1, 8), repeats=10, size=256):
+    import glob
+    import torch
+    from pix2pix_helpers.pix2pix_model import Generator
+    from pix2pix_helpers.inference import GeneratorInference
+    torch.manual_seed(0)
+    netG = Generator(3, 3, 8, ngf=64).eval()
+    paths = sorted(glob.glob(os.path.join(root, 'A', 'train', '*.png')))
+    results = {}
+    for batch_size in batch_sizes:
+        engine = GeneratorInference(netG, batch_size=batch_size, size=size)
+        batch = torch.stack([engine.load_image(p) for p in (paths * batch_size)[:batch_size]])
+        engine.predict(batch)
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            engine.predict(batch)
+            times.append(time.perf_counter() - start)
+        for name, value in percentiles(times).items():
+            results[f'inference.batch_{batch_size}.{name}'] = value
+        results[f'inference.batch_{batch_size}.img_s'] = batch_size / float(np.median(times))
+    return results
+
+
+def _startup_command(name, importtime=False):
+    # Startup of 'python -m pix2pix_helpers <name>' up to the point the command starts working
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [package_root, env.get('PYTHONPATH')]))
+    code = f'from pix2pix_helpers.cli import load_command; load_command({name!r})'
+    flags = ['-X', 'importtime'] if importtime else []
+    return subprocess.run([sys.executable] + flags + ['-c', code], env=env, check=True,
+                        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+
+
+def imported_packages(importtime_log):
+    """
+    Top-level packages in the output of python -X importtime
+    """
+    packages = set()
+    for line in importtime_log.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            packages.add(line.rsplit('|', 1)[1].strip().split('.')[0])
+    return packages
+
+
+def bench_startup(commands=tuple(STARTUP_BUDGETS), repeats=5):
+    """
+    Startup time of every CLI command, each run in a fresh interpreter.
+    Returns the results and the list of budget violations
+    """
+    results = {}
+    violations = []
+    for name in commands:
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            _startup_command(name)
+            times.append(time.perf_counter() - start)
+        startup_ms = float(np.median(times)) * 1000
+        results[f'startup.{name}.ms'] = startup_ms
+
+        budget_ms, forbidden = STARTUP_BUDGETS[name]
+        if budget_ms is not None and startup_ms > budget_ms:
+            violations.append(f'{name} starts in {startup_ms:.0f} ms, the budget is {budget_ms} ms')
+        imported = imported_packages(_startup_command(name, importtime=True).stderr)
+        for package in forbidden:
+            if package in imported:
+                violations.append(f'{name} imports {package}')
+    return results, violations
+
+
+def check_startup(commands=tuple(STARTUP_BUDGETS), repeats=3):
+    """
+    Raises AssertionError when a CLI command starts slower than its budget or imports a forbidden package.
+    Takes seconds, so it can run before every commit: python -m pix2pix_helpers.benchmark --check-startup
+    """
+    results, violations = bench_startup(commands, repeats)
+    for metric, value in sorted(results.items()):
+        print(f'{metric:45s} {value:10.2f}')
+    assert len(violations) == 0, 'Startup budget exceeded:\n' + '\n'.join(violations)
+    return results
+
+
+def run_benchmarks(suites=SUITES, images=64, quick=False, amp=False, root=None, checkpoint_depths=(0,),
+                   threads_list=None):
+    """
+    Runs the selected suites on freshly generated synthetic images and returns the results dict.
+    The train suite runs at every thread count of threads_list, default_threads() by default
+    """
+    import torch
+    if threads_list is None:
+        threads_list = default_threads()
+    own_root = root is None
+    if own_root:
+        root = tempfile.mkdtemp(prefix='pix2pix_benchmark_')
+    try:
+        make_synthetic_images(root, 16 if quick else images)
+        metrics = {}
+        if 'combine' in suites or 'loader' in suites:
+            metrics.update(bench_combine(root, (1,) if quick else (1, 2, 4)))
+        if 'loader' in suites:
+            metrics.update(bench_loader(root, (0, 2) if quick else (0, 2, 4)))
+        if 'train' in suites:
+            metrics.update(bench_train((1,) if quick else (1, 4, 8), threads_list,
+                                    steps=2 if quick else 5, amp=amp, checkpoint_depths=checkpoint_depths))
+        if 'inference' in suites:
+            metrics.update(bench_inference(root, (1,) if quick else (1, 8), repeats=5 if quick else 20))
+        violations = []
+        if 'startup' in suites:
+            startup, violations = bench_startup(repeats=3 if quick else 5)
+            metrics.update(startup)
+    finally:
+        if own_root:
+            shutil.rmtree(root, ignore_errors=True)
+
+    meta = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'platform': platform.platform(),
+            'python': platform.python_version(), 'torch': torch.__version__,
+            'cpu_count': os.cpu_count(), 'threads': torch.get_num_threads(),
+            'suites': list(suites), 'quick': quick, 'amp': amp,
+            'checkpoint_depths': list(checkpoint_depths), 'train_threads': list(threads_list)}
+    return {'meta': meta, 'metrics': metrics, 'startup_violations': violations}
+
+
+def higher_is_better(metric):
+    for suffix, higher in HIGHER_IS_BETTER.items():
+        if metric.endswith(suffix):
+            return higher
+    return None
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Compares every metric present in both results. Returns a list of (metric, baseline, current, change, regressed),
+    where change is relative and positive when the metric improved
+    """
+    rows = []
+    for metric, current in sorted(results['metrics'].items()):
+        previous = baseline['metrics'].get(metric)
+        higher = higher_is_better(metric)
+        if previous is None or higher is None or previous == 0:
+            continue
+        change = (current - previous) / previous
+        if not higher:
+            change = -change
+        rows.append((metric, previous, current, change, change < -tolerance))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pix2pix pipeline on synthetic images')
+    parser.add_argument('--suites', default=','.join(SUITES), help='comma separated, from ' + ', '.join(SUITES))
+    parser.add_argument('--images', type=int, default=64, help='number of synthetic image pairs')
+    parser.add_argument('--quick', action='store_true', help='fewer sizes and repeats, for a fast check')
+    parser.add_argument('--amp', action='store_true', help='train with mixed precision')
+    parser.add_argument('--threads', default=None,
+                        help='comma separated intra-op threads of the train suite, 1,4,<cores> by default')
+    parser.add_argument('--checkpoint-depth', default='0',
+                        help='comma separated activation checkpointing depths of the train suite, e.g. 0,3,-1')
+    parser.add_argument('--out', default=None, help='json file to write the results to')
+    parser.add_argument('--baseline', default=None, help='json results to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results to --baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative change flagged as a regression')
+    parser.add_argument('--check-startup', action='store_true',
+                        help='only check the CLI commands against STARTUP_BUDGETS, fails when one is exceeded')
+    args = parser.parse_args()
+
+    if args.check_startup:
+        check_startup()
+        return
+
+    suites = [s for s in args.suites.split(',') if s]
+    for suite in suites:
+        assert suite in SUITES, f"Unknown suite '{suite}'"
+    threads_list = [int(t) for t in args.threads.split(',')] if args.threads is not None else None
+    results = run_benchmarks(suites, args.images, args.quick, args.amp,
+                            checkpoint_depths=[int(d) for d in args.checkpoint_depth.split(',')],
+                            threads_list=threads_list)
+
+    for metric, value in sorted(results['metrics'].items()):
+        print(f'{metric:45s} {value:10.2f}')
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1)
+    for violation in results['startup_violations']:
+        print(f'STARTUP BUDGET: {violation}')
+    if len(results['startup_violations']) > 0:
+        sys.exit(1)
+
+    if args.baseline is None:
+        return
+    if args.save_baseline or not os.path.isfile(args.baseline):
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=1)
+        print(f'Baseline saved to {args.baseline}')
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = 0
+    print(f"\nComparison with {args.baseline} ({baseline['meta']['time']}), tolerance {args.tolerance:.0%}")
+    for metric, previous, current, change, regressed in compare(results, baseline, args.tolerance):
+        flag = 'REGRESSION' if regressed else ''
+        print(f'{metric:45s} {previous:10.2f} -> {current:10.2f} {change:+7.1%} {flag}')
+        regressions += regressed
+    if regressions > 0:
+        print(f'{regressions} metrics regressed')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+import os
+import json
+import time
+import hashlib
+import inspect
+import threading
+from contextlib import contextmanager
+import torch
+from pix2pix_helpers.checkpoint import CHECKPOINT_PATTERN
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, the catalog is then only safe to change from one process
+    fcntl = None
+
+##
+# Index of the checkpoints in a checkpoint folder, kept in <ckpt_dir>/catalog.json.
+# For every epoch it stores the files (with size and sha256 digest) and any metrics recorded for it,
+# so finding the latest or best checkpoint does not need to list, stat or open the checkpoint files.
+# Folders written before the catalog existed are indexed on first use (see rebuild).
+# Several processes may change the catalog (training and evaluation, see evaluation.py): every change
+# re-reads the file under a lock file first, so changes made by the other processes are kept.
+##
+
+CATALOG_NAME = 'catalog.json'
+
+
+def file_digest(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def load_weights(path, mmap=True):
+    """
+    Loads a state dict on the CPU. With mmap (PyTorch 2.1 or newer) the tensors are memory-mapped,
+    so only the pages that are actually used are read from disk
+    """
+    kwargs = {}
+    parameters = inspect.signature(torch.load).parameters
+    if mmap and 'mmap' in parameters:
+        kwargs['mmap'] = True
+    if 'weights_only' in parameters:
+        kwargs['weights_only'] = True
+    return torch.load(path, map_location='cpu', **kwargs)
+
+
+def file_info(path, digest=None):
+    """
+    Catalog record of a checkpoint file. Size and modification time tell whether a digest is still valid
+    """
+    stat = os.stat(path)
+    return {'file': os.path.basename(path), 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+            'sha256': digest, 'time': time.time()}
+
+
+class CheckpointCatalog():
+    """
+    Epochs, files, digests and metrics of the checkpoints in ckpt_dir.
+    The catalog file is read lazily and rewritten atomically on every change
+    """
+    def __init__(self, ckpt_dir):
+        self.ckpt_dir = ckpt_dir
+        self.path = os.path.join(ckpt_dir, CATALOG_NAME)
+        self._entries = None
+        # Version of the file the entries were read from or written to
+        self._version = None
+        self._lock = threading.RLock()
+        # Depth of _file_lock in this process, the lock file is only locked by the outermost one
+        self._lock_depth = 0
+
+    def _file_version(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _read(self):
+        version = self._file_version()
+        with open(self.path) as f:
+            self._entries = {int(epoch): entry for epoch, entry in json.load(f)['epochs'].items()}
+        self._version = version
+
+    @property
+    def entries(self):
+        with self._lock:
+            if self._entries is None:
+                if os.path.isfile(self.path):
+                    self._read()
+                else:
+                    self.rebuild()
+            return self._entries
+
+    def refresh(self):
+        """
+        Re-reads the catalog if another process changed it
+        """
+        with self._lock:
+            if self._entries is None or (self._version != self._file_version() and os.path.isfile(self.path)):
+                self._entries = None
+            return self.entries
+
+    @contextmanager
+    def _file_lock(self):
+        with self._lock:
+            if fcntl is None or not os.path.isdir(self.ckpt_dir) or self._lock_depth > 0:
+                self._lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self._lock_depth -= 1
+                return
+            with open(self.path + '.lock', 'a') as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                self._lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self._lock_depth -= 1
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    @contextmanager
+    def _change(self):
+        # Read-modify-write of the catalog, safe between threads and processes
+        with self._lock, self._file_lock():
+            self.refresh()
+            yield self._entries
+            self.save()
+
+    def save(self):
+        with self._lock:
+            if not os.path.isdir(self.ckpt_dir):
+                return
+            catalog = {'version': 1, 'epochs': {str(epoch): self._entries[epoch] for epoch in sorted(self._entries)}}
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(catalog, f, indent=1)
+            os.replace(self.path + '.tmp', self.path)
+            self._version = self._file_version()
+
+    def rebuild(self, with_hash=False):
+        """
+        Indexes the checkpoint files in the folder, e.g. for folders written before the catalog existed.
+        Metrics already in the catalog are kept, and so are the digests of files whose size and modification
+        time did not change. Other digests are only computed with with_hash=True
+        """
+        with self._lock, self._file_lock():
+            # Read again under the lock, so metrics other processes wrote in the meantime are kept
+            old = self._entries or {}
+            if os.path.isfile(self.path):
+                self._read()
+                old = self._entries
+            entries = {}
+            if os.path.isdir(self.ckpt_dir):
+                for file_name in sorted(os.listdir(self.ckpt_dir)):
+                    match = CHECKPOINT_PATTERN.match(file_name)
+                    if not match:
+                        continue
+                    epoch, kind = int(match.group(1)), match.group(2)
+                    path = os.path.join(self.ckpt_dir, file_name)
+                    known = old.get(epoch, {}).get('files', {}).get(kind)
+                    stat = os.stat(path)
+                    if (known is not None and known.get('file') == file_name and known.get('sha256') is not None
+                            and known.get('size') == stat.st_size and known.get('mtime') == stat.st_mtime_ns):
+                        info = known
+                    else:
+                        info = file_info(path, file_digest(path) if with_hash else None)
+                    entries.setdefault(epoch, {'files': {}, 'metrics': {}})['files'][kind] = info
+            for epoch, entry in old.items():
+                if epoch in entries:
+                    entries[epoch]['metrics'] = entry.get('metrics', {})
+            self._entries = entries
+            self.save()
+
+    def add_file(self, path, digest=None, save=True):
+        """
+        Records a checkpoint file written to the folder, its epoch and kind are taken from the file name
+        """
+        match = CHECKPOINT_PATTERN.match(os.path.basename(path))
+        assert match, f"{path} is not a checkpoint file"
+        epoch, kind = int(match.group(1)), match.group(2)
+        info = file_info(path, digest)
+        if not save:
+            # Part of a rebuild, saved once at the end
+            self.entries.setdefault(epoch, {'files': {}, 'metrics': {}})['files'][kind] = info
+            return
+        with self._change() as entries:
+            entries.setdefault(epoch, {'files': {}, 'metrics': {}})['files'][kind] = info
+
+    def remove_epoch(self, epoch):
+        with self._change() as entries:
+            entries.pop(int(epoch), None)
+
+    def set_metrics(self, epoch, **metrics):
+        with self._change() as entries:
+            entry = entries.setdefault(int(epoch), {'files': {}, 'metrics': {}})
+            entry['metrics'].update(metrics)
+
+    def epochs(self, kind='net_G'):
+        """
+        Sorted epochs that have a file of the given kind ('net_G', 'net_D' or 'state')
+        """
+        return sorted(epoch for epoch, entry in self.entries.items() if kind in entry['files'])
+
+    def latest(self, kind='net_G'):
+        epochs = self.epochs(kind)
+        return epochs[-1] if len(epochs) > 0 else None
+
+    def best(self, metric='G_L1', mode='min', kind='net_G'):
+        """
+        Epoch with the lowest (mode='min') or highest (mode='max') recorded value of metric
+        """
+        scored = [(self.entries[epoch]['metrics'][metric], epoch) for epoch in self.epochs(kind)
+                if metric in self.entries[epoch]['metrics']]
+        if len(scored) == 0:
+            return None
+        return (min(scored) if mode == 'min' else max(scored))[1]
+
+    def resolve(self, epoch='latest', kind='net_G', metric='G_L1', mode='min'):
+        """
+        Turns 'latest', 'best', -1 or an epoch number into an epoch that has a file of the given kind
+        """
+        for attempt in range(2):
+            if epoch in ('latest', -1, '-1'):
+                found = self.latest(kind)
+            elif epoch == 'best':
+                found = self.best(metric, mode, kind)
+            else:
+                found = int(epoch)
+            if found is not None and kind in self.entries.get(found, {}).get('files', {}):
+                return found
+            # Files may have been copied into the folder after the catalog was written
+            if attempt == 0:
+                self.rebuild()
+        assert found is not None, f"No checkpoint found in '{self.ckpt_dir}'"
+        raise AssertionError(f"Checkpoint {found} does not exist. Check '{self.ckpt_dir}' to see available checkpoints")
+
+    def file_path(self, epoch, kind='net_G'):
+        return os.path.join(self.ckpt_dir, self.entries[int(epoch)]['files'][kind]['file'])
+
+    def verify(self, epoch, kind='net_G'):
+        """
+        Checks the file against the digest in the catalog. Files without a digest get one recorded
+        """
+        info = self.entries[int(epoch)]['files'][kind]
+        digest = file_digest(self.file_path(epoch, kind))
+        if info['sha256'] is None:
+            with self._change() as entries:
+                if int(epoch) in entries and kind in entries[int(epoch)]['files']:
+                    entries[int(epoch)]['files'][kind]['sha256'] = digest
+            return True
+        return digest == info['sha256']
+
+
+def load_generator(ckpt_dir, epoch='latest', metric='G_L1', mode='min', mmap=True, device='cpu'):
+    """
+    Builds the Generator, with the size read from the weights, and loads its weights only, for inference.
+    With mmap the weights are used directly from the memory-mapped file (PyTorch 2.1 or newer),
+    without initializing them first
+    """
+    from pix2pix_helpers.pix2pix_model import Generator, generator_config
+    catalog = CheckpointCatalog(ckpt_dir)
+    epoch = catalog.resolve(epoch, 'net_G', metric, mode)
+    state_dict = load_weights(catalog.file_path(epoch, 'net_G'), mmap=mmap)
+    # Distilled students are smaller than the default Generator(3, 3, 8, ngf=64)
+    ngf, num_downs = generator_config(state_dict)
+
+    assign = 'assign' in inspect.signature(torch.nn.Module.load_state_dict).parameters
+    if mmap and assign and hasattr(torch.device, '__enter__'):
+        # Build on the meta device, no memory is allocated or initialized for the weights
+        with torch.device('meta'):
+            netG = Generator(3, 3, num_downs, ngf=ngf)
+        netG.load_state_dict(state_dict, assign=True)
+    else:
+        netG = Generator(3, 3, num_downs, ngf=ngf)
+        netG.load_state_dict(state_dict)
+    return netG.to(device).eval(), epoch
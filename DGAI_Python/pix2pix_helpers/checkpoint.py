@@ -0,0 +1,224 @@
+import os
+import re
+import queue
+import hashlib
+import inspect
+import atexit
+import random
+import threading
+import numpy as np
+import torch
+
+##
+# Checkpoint writing off the training thread. State dicts are snapshotted to the CPU (the live
+# networks are never moved) and handed to a background thread that writes them atomically, so a
+# crash during a write never leaves a truncated checkpoint behind.
+# Files in a checkpoint folder:
+#   <epoch>_net_G.pth, <epoch>_net_D.pth   network weights, as before
+#   <epoch>_state.pth                      full training state used to resume
+#   catalog.json                           index of the files above, see catalog.py
+##
+
+CHECKPOINT_PATTERN = re.compile(r'^(\d+)_(net_G|net_D|state)\.pth$')
+
+
+def snapshot(obj):
+    """
+    Copies every tensor in a (nested) state dict to the CPU, leaving the original tensors where they are
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        copy = obj.__class__()
+        for key, value in obj.items():
+            copy[key] = snapshot(value)
+        if hasattr(obj, '_metadata'):
+            copy._metadata = obj._metadata
+        return copy
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(snapshot(value) for value in obj)
+    return obj
+
+
+class _HashingFile():
+    """
+    File wrapper computing the sha256 of everything written through it
+    """
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+
+def atomic_save(obj, path):
+    """
+    Writes to a temporary file in the same folder first and renames it over path once it is complete.
+    Returns the sha256 digest of the file
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        hashing_file = _HashingFile(f)
+        torch.save(obj, hashing_file)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return hashing_file.sha256.hexdigest()
+
+
+def load_state(path):
+    """
+    Loads a full training state on the CPU. It holds numpy and python RNG states, so it is not weights only
+    """
+    if 'weights_only' in inspect.signature(torch.load).parameters:
+        return torch.load(path, map_location='cpu', weights_only=False)
+    return torch.load(path, map_location='cpu')
+
+
+def checkpoint_epochs(ckpt_dir, kind='state'):
+    """
+    Sorted epochs with a checkpoint of the given kind ('state', 'net_G' or 'net_D') in ckpt_dir
+    """
+    if not os.path.isdir(ckpt_dir):
+        return []
+    epochs = set()
+    for file_name in os.listdir(ckpt_dir):
+        match = CHECKPOINT_PATTERN.match(file_name)
+        if match and match.group(2) == kind:
+            epochs.add(int(match.group(1)))
+    return sorted(epochs)
+
+
+def latest_state(ckpt_dir):
+    """
+    Path of the most recent training state in ckpt_dir, None if there is none
+    """
+    epochs = checkpoint_epochs(ckpt_dir, 'state')
+    if len(epochs) == 0:
+        return None
+    return os.path.join(ckpt_dir, '%s_state.pth' % epochs[-1])
+
+
+def apply_retention(ckpt_dir, keep_last=None, keep_every=None, catalog=None):
+    """
+    Deletes the checkpoints of all but the keep_last most recent complete epochs, the ones whose training
+    state is written (it is written last). The newest complete epoch and the epochs after it, which are
+    still being written, are never deleted. Epochs that are a multiple of keep_every are always kept
+    """
+    if keep_last is None:
+        return
+    kinds = {}
+    for file_name in os.listdir(ckpt_dir):
+        match = CHECKPOINT_PATTERN.match(file_name)
+        if match:
+            kinds.setdefault(int(match.group(1)), set()).add(match.group(2))
+    complete = sorted(epoch for epoch, epoch_kinds in kinds.items() if 'state' in epoch_kinds)
+    if len(complete) == 0:
+        return
+    epochs = set(kinds)
+    keep = set(complete[-keep_last:]) if keep_last > 0 else set()
+    keep.update(e for e in epochs if e >= complete[-1])
+    if keep_every:
+        keep.update(e for e in epochs if e % keep_every == 0)
+    for file_name in os.listdir(ckpt_dir):
+        match = CHECKPOINT_PATTERN.match(file_name)
+        if match and int(match.group(1)) not in keep:
+            os.remove(os.path.join(ckpt_dir, file_name))
+    if catalog is not None:
+        for epoch in epochs - keep:
+            catalog.remove_epoch(epoch)
+
+
+def get_rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class CheckpointWriter():
+    """
+    Writes checkpoints on a background thread. At most max_pending snapshots wait in memory,
+    submit blocks when the writer falls further behind. Errors of the writer are raised on the next call
+    """
+    def __init__(self, keep_last=None, keep_every=None, max_pending=2):
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='CheckpointWriter', daemon=True)
+        self._thread.start()
+        # Pending checkpoints are still written when the interpreter exits
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                obj, path, catalog = job
+                _save(obj, path, catalog)
+                # Only once the epoch is complete, so a resumable state always exists on disk
+                if CHECKPOINT_PATTERN.match(os.path.basename(path)).group(2) == 'state':
+                    apply_retention(os.path.dirname(path), self.keep_last, self.keep_every, catalog)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Writing a checkpoint failed') from error
+
+    def submit(self, obj, path, catalog=None):
+        """
+        Queues obj to be written to path. obj must not be modified afterwards, pass a snapshot.
+        The file is added to the catalog once it is written
+        """
+        self._raise_error()
+        assert self._thread.is_alive(), 'CheckpointWriter is closed'
+        self._queue.put((obj, path, catalog))
+
+    def wait(self):
+        """
+        Blocks until every submitted checkpoint is written
+        """
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+
+def _save(obj, path, catalog=None):
+    digest = atomic_save(obj, path)
+    if catalog is not None:
+        catalog.add_file(path, digest)
+
+
+def save_checkpoint(obj, path, writer=None, catalog=None):
+    """
+    Writes in the background with a CheckpointWriter, synchronously (and still atomically) otherwise
+    """
+    if writer is not None:
+        writer.submit(obj, path, catalog)
+    else:
+        _save(obj, path, catalog)
@@ -0,0 +1,64 @@
+import sys
+import importlib
+
+##
+# Command line entry point, the workflows of prepare-files.ipynb and training.ipynb without the notebooks:
+#   python -m pix2pix_helpers prepare --folder data/tracos --combine --split 10
+#   python -m pix2pix_helpers train --folder data/tracos --model tracos_run_1
+#   python -m pix2pix_helpers test --folder data/tracos --model tracos_run_1 --epoch best
+#   python -m pix2pix_helpers evaluate --folder data/tracos --model tracos_run_1
+#   python -m pix2pix_helpers export --model tracos_run_1
+#   python -m pix2pix_helpers fuse --ckpt-dir checkpoints/tracos_run_1 --folder data/tracos
+#   python -m pix2pix_helpers distill --folder data/tracos --teacher tracos_run_1 --student tracos_small
+#   python -m pix2pix_helpers serve --ckpt-dir checkpoints/tracos_run_1
+# Only the module of the command is imported, after the command is known: prepare never loads torch
+# and no command loads matplotlib. Startup times are checked against STARTUP_BUDGETS in benchmark.py,
+# for prepare by tests/test_cli_startup.py, and for every command by:
+#   python -m pix2pix_helpers.benchmark --check-startup
+##
+
+# Command name: (module, function taking the remaining arguments, description)
+COMMANDS = {
+    'prepare': ('pix2pix_helpers.prepare', 'main', 'resize, rename, combine, split and pack a dataset'),
+    'train': ('pix2pix_helpers.train', 'main', 'train a model'),
+    'test': ('pix2pix_helpers.train', 'test_main', 'save test images of a trained model'),
+    'evaluate': ('pix2pix_helpers.evaluation', 'main', 'L1, PSNR, SSIM and palette accuracy of the checkpoints'),
+    'export': ('pix2pix_helpers.onnx_backend', 'export_main', 'export the Generator to ONNX'),
+    'fuse': ('pix2pix_helpers.fuse', 'main', 'fold the BatchNorms of the Generator and export it'),
+    'distill': ('pix2pix_helpers.distill', 'main', 'compare a distilled student Generator with its teacher'),
+    'serve': ('pix2pix_helpers.server', 'main', 'serve the Generator over HTTP'),
+}
+
+PROG = 'python -m pix2pix_helpers'
+
+
+def load_command(name):
+    """
+    Imports the module of the command and returns its entry point
+    """
+    module_name, function, _ = COMMANDS[name]
+    return getattr(importlib.import_module(module_name), function)
+
+
+def usage():
+    lines = [f'usage: {PROG} <command> [options]', '', 'commands:']
+    lines += [f'  {name:10s}{description}' for name, (_, _, description) in COMMANDS.items()]
+    lines += ['', f'{PROG} <command> --help shows the options of a command']
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if len(argv) == 0 or argv[0] in ('-h', '--help'):
+        print(usage())
+        return 0
+    name = argv[0]
+    if name not in COMMANDS:
+        print(usage(), file=sys.stderr)
+        print(f"\nUnknown command '{name}'", file=sys.stderr)
+        return 2
+
+    # argparse of the command names itself after sys.argv[0]
+    sys.argv = [f'{PROG} {name}'] + argv[1:]
+    load_command(name)(argv[1:])
+    return 0
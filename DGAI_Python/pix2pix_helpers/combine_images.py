@@ -1,6 +1,10 @@
 import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 from PIL import Image
+from pix2pix_helpers.image_files import is_image_file
 
 # Based on https://github.com/junyanz/pytorch-CycleGAN-and-pix2pix/blob/master/datasets/combine_A_and_B.py
 
@@ -10,6 +14,12 @@ from PIL import Image
 # A represents the input and B represents the expected output
 ##
 
+# Name of the manifest written to the AB folder by the incremental mode
+MANIFEST_NAME = '.combine_manifest.json'
+
+# Subfolders create_train_test moves the combined images into
+SPLIT_FOLDERS = ('train', 'test')
+
 # Function to write the combined images
 
 def write_image(path_A, path_B, path_AB):
@@ -37,9 +47,124 @@ def combine_imgs(img_a, img_b):
     out.paste(img_b, (w, 0))
     return out
 
-def combine_images(a, b, ab):
+
+def find_pair(img_fold_B, name_A):
+    """
+    Returns the path of the image in folder B matching name_A, trying the other extension
+    (png or jpg) if the names do not match exactly. Returns None if there is no match
+    """
+    # Define the name of the image in folder B based on the name in folder B, same for path
+    name_B = name_A
+    path_B = os.path.join(img_fold_B, name_B)
+    # Confirm that images have the same name in both folders
+    if not os.path.isfile(path_B):
+        base_A, ext_A = os.path.splitext(name_A)
+        ext_B = ""
+        # If not, try a different file extension (SHOULD BE EITHER png OR jpg)
+        if ext_A.lower() == ".jpg":
+            ext_B = ".png"
+        elif ext_A.lower() == ".png":
+            ext_B = ".jpg"
+        name_B = base_A + ext_B
+        path_B = os.path.join(img_fold_B, name_B)
+    if os.path.isfile(path_B):
+        return path_B
+    return None
+
+
+def find_pairs(img_fold_A, img_fold_B):
+    """
+    Lists the (name, path_A, path_B) of every image in folder A that has a match in folder B
+    """
+    pairs = []
+    for name_A in sorted(os.listdir(img_fold_A)):
+        path_A = os.path.join(img_fold_A, name_A)
+        if not is_image_file(name_A) or not os.path.isfile(path_A):
+            continue
+        path_B = find_pair(img_fold_B, name_A)
+        if path_B is not None:
+            pairs.append((name_A, path_A, path_B))
+    return pairs
+
+
+def file_signature(path, with_hash=True):
+    """
+    Size, modification time and (optionally) sha1 of a file, as stored in the manifest
+    """
+    stat = os.stat(path)
+    signature = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if with_hash:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+        signature['sha1'] = sha1.hexdigest()
+    return signature
+
+
+def source_changed(path, entry):
+    """
+    Checks a source file against its manifest entry. The hash is only computed when size or mtime changed
+    Returns (changed, signature)
+    """
+    if entry is None:
+        return True, None
+    signature = file_signature(path, with_hash=False)
+    if signature['size'] == entry['size'] and signature['mtime'] == entry['mtime']:
+        return False, entry
+    if signature['size'] != entry['size']:
+        return True, None
+    # Same size but touched, only a different hash means different content
+    signature = file_signature(path)
+    return signature['sha1'] != entry['sha1'], signature
+
+
+def load_manifest(img_fold_AB):
+    manifest_path = os.path.join(img_fold_AB, MANIFEST_NAME)
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            return json.load(f)
+    return {}
+
+
+def save_manifest(img_fold_AB, manifest):
+    manifest_path = os.path.join(img_fold_AB, MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def find_output(img_fold_AB, name_AB):
+    """
+    Current location of a combined image: the AB folder itself, or AB/train or AB/test once it was split.
+    Returns None if it does not exist
+    """
+    for folder in ('',) + SPLIT_FOLDERS:
+        path_AB = os.path.join(img_fold_AB, folder, name_AB)
+        if os.path.isfile(path_AB):
+            return path_AB
+    return None
+
+
+def combine_job(job):
+    """
+    Combines a single pair, used both serially and by the worker processes.
+    Returns the manifest entry of the pair when hashing is requested
+    """
+    name_AB, path_A, path_B, path_AB, with_hash = job
+    write_image(path_A, path_B, path_AB)
+    if with_hash:
+        return name_AB, {'A': file_signature(path_A), 'B': file_signature(path_B)}
+    return name_AB, None
+
+
+def combine_images(a, b, ab, workers=1, incremental=False):
     """
     Combine images between two folders and place them on a third one.
+    Use workers > 1 (or None for one per core) to combine the pairs on a process pool.
+    With incremental=True, a manifest of the sources is kept in the AB folder so only new or
+    modified pairs are combined again, and outputs whose sources were removed are deleted.
+    Outputs already moved into AB/train or AB/test by create_train_test are found and updated there
     """
 
     # a = os.path.realpath(a)
@@ -51,7 +176,7 @@ def combine_images(a, b, ab):
 
     # Iterate through the buckets
     # for bucket in buckets:
-    
+
     # Define the folders for input and output images
     # img_fold_A = os.path.join(a, bucket)
     img_fold_A = a
@@ -61,35 +186,57 @@ def combine_images(a, b, ab):
     # img_fold_AB = os.path.join(ab, bucket)
     img_fold_AB = ab
     # List the images to be combined
-    img_list = os.listdir(img_fold_A)
+    pairs = find_pairs(img_fold_A, img_fold_B)
     # Create the destination folder if it does not exist
     if not os.path.isdir(img_fold_AB):
         os.makedirs(img_fold_AB)
-    # Iterate through the images
-    img_count = len(img_list)
+
+    manifest = load_manifest(img_fold_AB) if incremental else {}
+    jobs = []
+    for name_A, path_A, path_B in pairs:
+        # Define the name and path of the combined file
+        name_AB = name_A
+        path_AB = os.path.join(img_fold_AB, name_AB)
+
+        if incremental:
+            # A modified pair is written where its output is now, so it stays in its split
+            existing = find_output(img_fold_AB, name_AB)
+            if existing is not None:
+                path_AB = existing
+            entry = manifest.get(name_AB)
+            changed_A, signature_A = source_changed(path_A, entry['A'] if entry else None)
+            changed_B, signature_B = source_changed(path_B, entry['B'] if entry else None)
+            if not changed_A and not changed_B and existing is not None:
+                # Unchanged content, only refresh the stored stats
+                manifest[name_AB] = {'A': signature_A, 'B': signature_B}
+                continue
+
+        jobs.append((name_AB, path_A, path_B, path_AB, incremental))
+
+    if incremental:
+        # Remove the outputs whose sources no longer exist
+        names = set(pair[0] for pair in pairs)
+        for name_AB in [name for name in manifest if name not in names]:
+            path_AB = find_output(img_fold_AB, name_AB)
+            if path_AB is not None:
+                os.remove(path_AB)
+            del manifest[name_AB]
+        print(f"{len(pairs) - len(jobs)} pairs are up to date")
 
     print(f"Combining images from {a} and {b} into {ab}")
-    for n in tqdm(range(img_count)):
-        # Get the name of the image in folder A and its resulting path
-        name_A = img_list[n]
-        path_A = os.path.join(img_fold_A, name_A)
-        # Define the name of the image in folder B based on the name in folder B, same for path
-        name_B = name_A
-        path_B = os.path.join(img_fold_B, name_B)
-        # Confirm that images have the same name in both folders
-        if not os.path.isfile(path_B):
-            ext_A = name_A.split('.')[1]
-            ext_B = ""
-            # If not, try a different file extension (SHOULD BE EITHER png OR jpg)
-            if ext_A.lower() == "jpg":
-                ext_B = ".png"
-            elif ext_A.lower() == "png":
-                ext_B = ".jpg"
-            name_B = name_B.split('.')[0] + ext_B
-            path_B = os.path.join(img_fold_B, name_B)
-        if os.path.isfile(path_A) and os.path.isfile(path_B):
-            # Define the name and path of the combined file
-            name_AB = name_A
-            path_AB = os.path.join(img_fold_AB, name_AB)
-            # Write the combined file
-            write_image(path_A, path_B, path_AB)
\ No newline at end of file
+    if workers == 1:
+        results = map(combine_job, jobs)
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        chunksize = max(1, len(jobs) // ((workers or os.cpu_count() or 1) * 8))
+        results = executor.map(combine_job, jobs, chunksize=chunksize)
+
+    try:
+        for name_AB, entry in tqdm(results, total=len(jobs)):
+            if incremental:
+                manifest[name_AB] = entry
+    finally:
+        if workers != 1:
+            executor.shutdown()
+        if incremental:
+            save_manifest(img_fold_AB, manifest)
@@ -1,23 +1,23 @@
 import torch.utils.data
 import torchvision.transforms as transforms
+import torchvision.transforms.functional as F
+from torchvision.transforms import InterpolationMode
 from PIL import Image
 import os
-
-IMG_EXTENSIONS = [
-    '.jpg', '.JPG', 'jpeg', '.JPEG',
-    '.png', '.PNG', '.ppm', '.PPM', '.bmp', '.BMP',
-    '.tif', '.TIF', '.tiff', '.TIFF',
-]
+from pix2pix_helpers.image_files import IMG_EXTENSIONS, make_dataset, pad_square
 
 class ImageFolderLoader():
     """
     Create a image loader based on a folder that contains a train and a test folder.
     Pre-processing options can be a combination of: resize, crop, scale_width, or none
+    If packed is True, images are read from the memory-mapped shard written by pack_dataset instead of decoding files
+    If batch_transform is True, samples are returned as uint8 tensors and pre-processed per batch by collate
     """
     def __init__(self, root, phase='train', preprocess='resize_and_crop',
-                grayscale=False, method=Image.NEAREST, convert=True, flip=True):
-        self.dir_AB = os.path.join(root, phase)
-        self.AB_paths = sorted(make_dataset(self.dir_AB))
+                grayscale=False, method=Image.NEAREST, convert=True, flip=True, packed=False,
+                batch_transform=False):
+        self.packed = packed
+        self.AB_paths = self.find_images(root, phase)
         if grayscale:
             self.input_nc = 1
             self.output_nc = 1
@@ -25,52 +25,158 @@ class ImageFolderLoader():
             self.input_nc = 3
             self.output_nc = 3
         
-        if len(self.dir_AB) == 0:
-            raise(RuntimeError("Found 0 images in " + root + "\n"
-                                "Supported image extensions are: " + ",".join(IMG_EXTENSIONS)))
-        
         self.root = root
         #self.imgs = imgs
         self.transform = get_transform(preprocess=preprocess, grayscale=grayscale,
-                                            method=method, convert=convert, flip=flip)
+                                            method=method, convert=convert, flip=flip, tensor=packed)
+        if batch_transform:
+            self.batch_transform = PairedBatchTransform(preprocess=preprocess, grayscale=grayscale,
+                                                        method=method, convert=convert, flip=flip)
+        else:
+            self.batch_transform = None
         
         self.loader = default_loader
     
+    def find_images(self, root, phase):
+        """
+        Lists the paths of the AB images of the phase
+        """
+        self.dir_AB = os.path.join(root, phase)
+        if len(self.dir_AB) == 0:
+            raise(RuntimeError("Found 0 images in " + root + "\n"
+                                "Supported image extensions are: " + ",".join(IMG_EXTENSIONS)))
+        if self.packed:
+            from pix2pix_helpers.pack_dataset import PackedShard
+            self.shard = PackedShard(root, phase)
+            return self.shard.paths
+        return sorted(make_dataset(self.dir_AB))
+
     def __getitem__(self, index):
         AB_path = self.AB_paths[index]
-        AB = Image.open(AB_path).convert('RGB')
+        A, B = self.load_pair(index)
+
+        if self.batch_transform is not None:
+            # Keep the pair as uint8 CxHxW, pre-processing runs on the whole batch in collate
+            A = A if isinstance(A, torch.Tensor) else F.pil_to_tensor(A)
+            B = B if isinstance(B, torch.Tensor) else F.pil_to_tensor(B)
+        else:
+            A = self.transform(A)
+            B = self.transform(B)
+
+        return {'A': A, 'B': B, 'A_paths': AB_path, 'B_paths': AB_path}
+
+    def load_pair(self, index):
+        """
+        Returns the A and B images for the given index, as PIL images or uint8 CxHxW tensors when packed
+        """
+        if self.packed:
+            # HxWx3 view into the shard, cropped and permuted without copying or decoding
+            AB = torch.from_numpy(self.shard[index])
+            w2 = int(AB.shape[1] / 2)
+            return AB[:, :w2].permute(2, 0, 1), AB[:, w2:].permute(2, 0, 1)
+
+        AB = Image.open(self.AB_paths[index]).convert('RGB')
         w, h = AB.size
         w2 = int(w / 2)
         A = AB.crop((0, 0, w2, h))
         B = AB.crop((w2, 0, w, h))
+        return A, B
 
-        A_transform = self.transform
-        B_transform = self.transform
-
-        A = A_transform(A)
-        B = B_transform(B)
-
-        return {'A': A, 'B': B, 'A_paths': AB_path, 'B_paths': AB_path}
+    def collate(self, batch):
+        """
+        Collate function for the DataLoader, applies the batch transform to the collated batch when enabled
+        """
+        data = torch.utils.data.dataloader.default_collate(batch)
+        if self.batch_transform is not None:
+            data = self.batch_transform(data)
+        return data
     
     def __len__(self):
         return len(self.AB_paths)
     
+
+class PairedFolderLoader(ImageFolderLoader):
+    """
+    Create a image loader that reads the A and B folders directly, pairing the images by name the same way
+    combine_images does and padding them in memory, so no AB images need to be written to disk.
+    Uses root/A/phase and root/B/phase if they exist, otherwise root/A and root/B
+    """
+    def __init__(self, root, phase='train', preprocess='resize_and_crop',
+                grayscale=False, method=Image.NEAREST, convert=True, flip=True,
+                batch_transform=False):
+        super(PairedFolderLoader, self).__init__(root, phase, preprocess=preprocess, grayscale=grayscale,
+                                                method=method, convert=convert, flip=flip, packed=False,
+                                                batch_transform=batch_transform)
+
+    def find_images(self, root, phase):
+        """
+        Lists the paths of the A images that have a match in B, the matching B paths are kept in B_paths
+        """
+        from pix2pix_helpers.combine_images import find_pairs
+
+        self.dir_A = os.path.join(root, 'A', phase)
+        self.dir_B = os.path.join(root, 'B', phase)
+        if not os.path.isdir(self.dir_A):
+            self.dir_A = os.path.join(root, 'A')
+            self.dir_B = os.path.join(root, 'B')
+        assert os.path.isdir(self.dir_A) and os.path.isdir(self.dir_B), \
+            '%s does not contain A and B folders' % root
+
+        pairs = find_pairs(self.dir_A, self.dir_B)
+        if len(pairs) == 0:
+            raise(RuntimeError("Found 0 image pairs in " + root + "\n"
+                                "Supported image extensions are: " + ",".join(IMG_EXTENSIONS)))
+        self.B_paths = [pair[2] for pair in pairs]
+        return [pair[1] for pair in pairs]
+
+    def __getitem__(self, index):
+        data = super(PairedFolderLoader, self).__getitem__(index)
+        data['B_paths'] = self.B_paths[index]
+        return data
+
+    def load_pair(self, index):
+        A = pad_square(Image.open(self.AB_paths[index]))
+        B = pad_square(Image.open(self.B_paths[index]))
+        # Same as pasting B into a canvas the size of A, like combine_imgs does
+        if B.size != A.size:
+            out = Image.new('RGB', A.size)
+            out.paste(B)
+            B = out
+        return A, B
+
         
+def tensor_interpolation(method):
+    """
+    Interpolation of the tensor Resize giving the same pixels as PIL's resampling method. torch's legacy
+    'nearest' picks the top left source pixel, PIL and 'nearest-exact' the one under the output pixel centre
+    """
+    if method == Image.NEAREST:
+        return getattr(InterpolationMode, 'NEAREST_EXACT', InterpolationMode.NEAREST)
+    return method
+
 def __scale_width(img, target_size, crop_size, method=Image.NEAREST):
-    ow, oh = img.size
+    if isinstance(img, torch.Tensor):
+        oh, ow = img.shape[-2:]
+    else:
+        ow, oh = img.size
     if ow == target_size and oh >= crop_size:
         return img
     w = target_size
     h = int(max(target_size * oh / ow, crop_size))
+    if isinstance(img, torch.Tensor):
+        return transforms.Resize((h, w), tensor_interpolation(method))(img)
     return img.resize((w, h), method)
 
-def get_transform(preprocess='resize_and_crop', grayscale=False, method=Image.NEAREST, convert=True, flip=True):
+def get_transform(preprocess='resize_and_crop', grayscale=False, method=Image.NEAREST, convert=True, flip=True, tensor=False):
+        """
+        Builds the pre-processing pipeline. With tensor=True the pipeline expects uint8 CxHxW tensors instead of PIL images
+        """
         transforms_list = []
         if grayscale:
             transforms_list.append(transforms.Grayscale(1))
         if 'resize' in preprocess:
             osize = [286, 286]
-            transforms_list.append(transforms.Resize(osize, method))
+            transforms_list.append(transforms.Resize(osize, tensor_interpolation(method) if tensor else method))
         
         elif 'scale_width' in preprocess:
             transforms_list.append(transforms.Lambda(lambda img: __scale_width(img, 
@@ -83,7 +189,10 @@ def get_transform(preprocess='resize_and_crop', grayscale=False, method=Image.NE
             transforms_list.append(transforms.RandomHorizontalFlip())
         
         if convert:
-            transforms_list += [transforms.ToTensor()]
+            if tensor:
+                transforms_list += [transforms.ConvertImageDtype(torch.float)]
+            else:
+                transforms_list += [transforms.ToTensor()]
             if grayscale:
                 transforms_list += [transforms.Normalize((0.5,),(0.5,))]
             else:
@@ -91,20 +200,76 @@ def get_transform(preprocess='resize_and_crop', grayscale=False, method=Image.NE
         
         return transforms.Compose(transforms_list)
 
-def is_image_file(filename):
-    return any(filename.endswith(extension) for extension in IMG_EXTENSIONS)
-    
-def make_dataset(dir, max_dataset_size=float("inf")):
-    images = []
-    assert os.path.isdir(dir), '%s is not a valid directory' % dir
-
-    for root, _, fnames in sorted(os.walk(dir)):
-        for fname in fnames:
-            if is_image_file(fname):
-                path = os.path.join(root, fname)
-                images.append(path)
-    
-    return images[:min(max_dataset_size, len(images))]
+class PairedBatchTransform():
+    """
+    Batched equivalent of get_transform, applied to collated uint8 NxCxHxW batches.
+    Resize, crop and flip are folded into one nearest neighbour gather over the whole batch, with
+    parameters shared by A and B, followed by one scale and normalize pass over the batch
+    """
+    def __init__(self, preprocess='resize_and_crop', grayscale=False, method=Image.NEAREST,
+                convert=True, flip=True, load_size=286, crop_size=256):
+        if method != Image.NEAREST:
+            print('PairedBatchTransform only supports nearest resampling, falling back to nearest')
+        self.preprocess = preprocess
+        self.grayscale = grayscale
+        self.convert = convert
+        self.flip = flip
+        self.load_size = load_size
+        self.crop_size = crop_size
+
+    def get_size(self, h, w):
+        if 'resize' in self.preprocess:
+            return self.load_size, self.load_size
+        elif 'scale_width' in self.preprocess:
+            if w == self.load_size and h >= self.crop_size:
+                return h, w
+            return int(max(self.load_size * h / w, self.crop_size)), self.load_size
+        return h, w
+
+    def __call__(self, data):
+        A, B = data['A'], data['B']
+        n, _, h, w = A.shape
+
+        # Size after resizing, and size of the output window
+        rh, rw = self.get_size(h, w)
+        crop = 'crop' in self.preprocess
+        ch, cw = (self.crop_size, self.crop_size) if crop else (rh, rw)
+
+        # Draw the random parameters once per pair, so A and B get the same crop and flip
+        top = torch.randint(0, rh - ch + 1, (n, 1))
+        left = torch.randint(0, rw - cw + 1, (n, 1))
+        flipped = torch.rand(n, 1) < 0.5 if self.flip else torch.zeros((n, 1), dtype=torch.bool)
+
+        # Nearest neighbour source rows / columns of the resized image, taken at the output pixel centres
+        # like PIL. The crop and flip of every sample index into these, so the whole batch is one gather
+        rows = ((torch.arange(rh) + 0.5) * h / rh).floor().long()
+        cols = ((torch.arange(rw) + 0.5) * w / rw).floor().long()
+        offsets_h = torch.arange(ch).unsqueeze(0)
+        offsets_w = torch.arange(cw).unsqueeze(0)
+        rows = rows[top + offsets_h]
+        cols = cols[left + torch.where(flipped, cw - 1 - offsets_w, offsets_w)]
+        identity = rh == h and rw == w and ch == h and cw == w and not flipped.any()
+        # Flat index of every output pixel into its sample's HxW plane, shared by all channels
+        index = (rows.view(n, ch, 1) * w + cols.view(n, 1, cw)).view(n, 1, ch * cw).to(A.device)
+
+        out = []
+        for X in (A, B):
+            if identity:
+                Y = X
+            else:
+                c = X.shape[1]
+                Y = X.reshape(n, c, h * w).gather(2, index.expand(n, c, ch * cw)).view(n, c, ch, cw)
+            if self.grayscale:
+                Y = F.rgb_to_grayscale(Y)
+            if self.convert:
+                # ToTensor and Normalize(0.5, 0.5) in one in-place pass, x / 127.5 - 1 gives the same
+                # floats as (x / 255 - 0.5) / 0.5, so 255 maps to exactly 1.0
+                Y = Y.float().div_(127.5).sub_(1)
+            out.append(Y)
+
+        data = dict(data)
+        data['A'], data['B'] = out
+        return data
 
 def default_loader(path):
     return Image.open(path).convert('RGB')
\ No newline at end of file
@@ -1,13 +1,13 @@
-from importlib.resources import path
 import os
-from random import random
-import shutil
-from tqdm import tqdm
+from pix2pix_helpers.combine_images import MANIFEST_NAME
+from pix2pix_helpers.staging import split_files, stage_files
 
-def create_train_test(source, test_count):
+def create_train_test(source, test_count, seed=0, test_fraction=None, workers=None):
     """
     Create the test and train folders inside the source folder. 
-    Test will contain the specified amount of files
+    Test will contain the specified amount of files.
+    The files in test are picked by a hash of their name and seed, so the split is the same on every run
+    and on every machine. Use test_fraction instead of test_count to send that share of the files to test
     """
 
     trainFolder = os.path.join(source, 'train')
@@ -18,23 +18,23 @@ def create_train_test(source, test_count):
     if not os.path.isdir(testFolder):
         os.makedirs(testFolder)
 
-    test_moved = 0
-
     print(f"Creating test and train folders on {source}")
-    for (dirpath, _, filenames) in os.walk(source):
-        for filename in tqdm(filenames):
-            srcPath = os.path.join(dirpath, filename)
-            
-            if test_moved < test_count:
-                toPath = os.path.join(testFolder, filename)
-                test_moved += 1
-            else :
-                toPath = os.path.join(trainFolder, filename)
-            
-            if os.path.isfile(toPath):
-                print(f"File {toPath} exists! Overwriting has been avoided")
-            
-            else:
-                shutil.move(srcPath, toPath)
-        
-        break
+    # The combine manifest belongs to the AB folder itself
+    filenames = sorted(entry.name for entry in os.scandir(source)
+                    if entry.is_file() and entry.name != MANIFEST_NAME)
+    if test_fraction is not None:
+        test_names = split_files(filenames, test_fraction=test_fraction, seed=seed)
+    else:
+        test_names = split_files(filenames, test_count=test_count, seed=seed)
+
+    jobs = []
+    for filename in filenames:
+        srcPath = os.path.join(source, filename)
+        if filename in test_names:
+            toPath = os.path.join(testFolder, filename)
+        else :
+            toPath = os.path.join(trainFolder, filename)
+        jobs.append((srcPath, toPath))
+
+    # Moves within the folder are renames, only metadata changes
+    stage_files(jobs, mode='move', workers=workers)
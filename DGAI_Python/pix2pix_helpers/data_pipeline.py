@@ -0,0 +1,263 @@
+import os
+import time
+import collections
+import torch
+import torch.utils.data
+
+##
+# Loader layer of the training. create_loader builds a DataLoader with persistent workers, so they are
+# spawned once instead of every epoch, and with pinned memory on CUDA. DevicePrefetcher keeps batches
+# ahead of the step and moves them to the device with non_blocking copies on their own CUDA stream, so
+# the transfer of the next batch overlaps the step. It iterates the loader in the training thread, so the
+# global RNG is drawn in the same order every run and a resumed run sees the same batches.
+# DataPipeline puts both together for the training loop. With autotune, LoaderTuner picks the number of
+# workers and the prefetch depth of the next epoch from the time the step waited for data in the last one;
+# the workers are only respawned when that configuration changes.
+##
+
+def default_workers():
+    """
+    Cores available to this process, divided between the processes of the node when started by torchrun
+    """
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    return max(1, cores // int(os.environ.get('LOCAL_WORLD_SIZE', 1)))
+
+
+def create_loader(dataset, batch_size, shuffle=False, num_workers=0, prefetch=2, pin_memory=False,
+                persistent=True, sampler=None):
+    """
+    DataLoader over dataset with its collate function. prefetch is the number of batches loaded ahead by
+    every worker. Iterable datasets shard and shuffle themselves, so shuffle is ignored for them
+    """
+    kwargs = {}
+    if hasattr(dataset, 'collate'):
+        kwargs['collate_fn'] = dataset.collate
+    if num_workers > 0:
+        kwargs['persistent_workers'] = persistent
+        kwargs['prefetch_factor'] = prefetch
+    if isinstance(dataset, torch.utils.data.IterableDataset):
+        shuffle = False
+    if sampler is not None:
+        shuffle = False
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, sampler=sampler,
+                                    num_workers=num_workers, pin_memory=pin_memory, **kwargs)
+
+
+def to_device(data, device, non_blocking=True):
+    """
+    Moves the tensors in data (a tensor, or a dict, list or tuple of them) to device
+    """
+    if isinstance(data, torch.Tensor):
+        return data.to(device, non_blocking=non_blocking)
+    if isinstance(data, dict):
+        return dict((key, to_device(value, device, non_blocking)) for key, value in data.items())
+    if isinstance(data, (list, tuple)):
+        return type(data)(to_device(value, device, non_blocking) for value in data)
+    return data
+
+
+def record_stream(data, stream):
+    """
+    Marks the CUDA tensors in data as used by stream, so the allocator does not reuse their memory early
+    """
+    if isinstance(data, torch.Tensor):
+        if data.is_cuda:
+            data.record_stream(stream)
+    elif isinstance(data, dict):
+        for value in data.values():
+            record_stream(value, stream)
+    elif isinstance(data, (list, tuple)):
+        for value in data:
+            record_stream(value, stream)
+
+
+class DevicePrefetcher():
+    """
+    Iterates over loader keeping depth batches ahead, their copies to device issued early as non_blocking
+    copies on their own CUDA stream, so the transfer of the next batches overlaps the step. The loader is
+    iterated in the calling thread, so the sampler and the transforms draw from the global RNG in the same
+    order in every run and a run resumed from its RNG state sees the same batches. depth=0 moves every batch when it is consumed.
+    After every iteration wait_time holds the time the consumer waited for batches, without the first
+    one (worker startup), and elapsed the time of the whole iteration
+    """
+    def __init__(self, loader, device=None, depth=2):
+        self.loader = loader
+        self.device = torch.device(device) if device is not None else torch.device('cpu')
+        self.depth = depth
+        self.cuda = self.device.type == 'cuda'
+        self.wait_time = 0.0
+        self.first_wait = 0.0
+        self.elapsed = 0.0
+        self.batches = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _move(self, data, stream):
+        if self.device.type == 'cpu':
+            return data, None
+        if stream is None:
+            return to_device(data, self.device), None
+        with torch.cuda.stream(stream):
+            data = to_device(data, self.device)
+            event = torch.cuda.Event()
+            event.record(stream)
+        return data, event
+
+    def _consume(self, item):
+        data, event = item
+        if event is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_event(event)
+            record_stream(data, current)
+        return data
+
+    def _record_wait(self, seconds):
+        if self.batches == 0:
+            self.first_wait = seconds
+        else:
+            self.wait_time += seconds
+        self.batches += 1
+
+    def __iter__(self):
+        self.wait_time = 0.0
+        self.first_wait = 0.0
+        self.batches = 0
+        start = time.perf_counter()
+        try:
+            iterator = iter(self.loader)
+            stream = torch.cuda.Stream(self.device) if self.cuda and self.depth > 0 else None
+            pending = collections.deque()
+            exhausted = False
+            while True:
+                wait_start = time.perf_counter()
+                # Top the batches ahead up, their copies run on the side stream while the step computes
+                while not exhausted and len(pending) < max(1, self.depth):
+                    try:
+                        pending.append(self._move(next(iterator), stream))
+                    except StopIteration:
+                        exhausted = True
+                if not pending:
+                    return
+                item = pending.popleft()
+                self._record_wait(time.perf_counter() - wait_start)
+                yield self._consume(item)
+        finally:
+            self.elapsed = time.perf_counter() - start
+
+    def wait_fraction(self):
+        """
+        Share of the iteration, after the first batch, spent waiting for data
+        """
+        elapsed = self.elapsed - self.first_wait
+        return self.wait_time / elapsed if elapsed > 0 else 0.0
+
+
+class LoaderTuner():
+    """
+    Hill climbing over the number of workers and the prefetch depth, one configuration per epoch.
+    While the step waits for data more than wait_target of the time, the workers are doubled up to
+    max_workers, then the prefetch depth up to max_prefetch. A change that does not reduce the wait
+    by at least a tenth is undone and the tuning stops
+    """
+    def __init__(self, num_workers, prefetch, max_workers=None, max_prefetch=8, wait_target=0.05):
+        self.num_workers = num_workers
+        self.prefetch = prefetch
+        self.max_workers = max_workers if max_workers is not None else default_workers()
+        self.max_prefetch = max_prefetch
+        self.wait_target = wait_target
+        self.best = None
+        self.done = False
+        self.history = []
+
+    def config(self):
+        return self.num_workers, self.prefetch
+
+    def update(self, wait_fraction):
+        """
+        Records the wait of the current configuration, returns True when the next epoch should use another one
+        """
+        self.history.append((self.num_workers, self.prefetch, wait_fraction))
+        if self.done:
+            return False
+        if self.best is not None and wait_fraction > self.best[2] * 0.9:
+            # The last change did not help, go back to the best configuration
+            self.num_workers, self.prefetch = self.best[:2]
+            self.done = True
+            return True
+        self.best = (self.num_workers, self.prefetch, wait_fraction)
+        if wait_fraction <= self.wait_target:
+            self.done = True
+            return False
+        if self.num_workers < self.max_workers:
+            self.num_workers = min(self.max_workers, max(1, self.num_workers * 2))
+        elif self.prefetch < self.max_prefetch:
+            self.prefetch = min(self.max_prefetch, self.prefetch * 2)
+        else:
+            self.done = True
+            return False
+        return True
+
+
+class DataPipeline():
+    """
+    Training loader: the batches of dataset on device, prefetched by a DevicePrefetcher over a DataLoader
+    with persistent workers. With distributed=True every process gets its own shard of a map-style dataset.
+    With autotune the workers and prefetch depth are tuned by a LoaderTuner after every complete epoch
+    """
+    def __init__(self, dataset, batch_size, device=None, shuffle=True, num_workers=4, prefetch=2,
+                autotune=False, max_workers=None, distributed=False, verbose=True):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.device = torch.device(device) if device is not None else torch.device('cpu')
+        self.shuffle = shuffle
+        self.num_workers = num_workers
+        self.prefetch = prefetch
+        self.verbose = verbose
+        self.sampler = None
+        if distributed and not isinstance(dataset, torch.utils.data.IterableDataset):
+            self.sampler = torch.utils.data.distributed.DistributedSampler(dataset, shuffle=shuffle)
+        self.tuner = LoaderTuner(num_workers, prefetch, max_workers) if autotune else None
+        self.loader = None
+        self.prefetcher = None
+        self.build()
+
+    def build(self):
+        # Dropping the old loader shuts its persistent workers down
+        self.loader = None
+        self.loader = create_loader(self.dataset, self.batch_size, shuffle=self.shuffle,
+                                    num_workers=self.num_workers, prefetch=self.prefetch,
+                                    pin_memory=self.device.type == 'cuda', sampler=self.sampler)
+        # At least two batches ahead, the one being consumed and the next one being copied
+        self.prefetcher = DevicePrefetcher(self.loader, self.device, depth=max(2, self.prefetch))
+
+    def set_epoch(self, epoch):
+        if hasattr(self.dataset, 'set_epoch'):
+            self.dataset.set_epoch(epoch)
+        elif self.sampler is not None:
+            self.sampler.set_epoch(epoch)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        complete = False
+        try:
+            yield from self.prefetcher
+            complete = True
+        finally:
+            # Only complete epochs are representative of the wait for data
+            if complete and self.tuner is not None:
+                self.tune()
+
+    def tune(self):
+        wait_fraction = self.prefetcher.wait_fraction()
+        if self.tuner.update(wait_fraction):
+            self.num_workers, self.prefetch = self.tuner.config()
+            if self.verbose:
+                print(f'Data wait {wait_fraction:.1%} of the epoch, next epoch with {self.num_workers} workers '
+                    f'and prefetch {self.prefetch}')
+            self.build()
@@ -0,0 +1,120 @@
+import os
+import json
+import argparse
+import torch
+from pix2pix_helpers.catalog import load_generator
+from pix2pix_helpers.evaluation import create_test_set, create_test_loader, evaluate
+from pix2pix_helpers.fuse import fuse_generator, median_latency
+
+##
+# Knowledge distillation to a smaller Generator. The student is trained like any model, with a smaller
+# ngf and / or num_downs and a trained teacher: besides the GAN and L1 losses it learns the teacher's
+# outputs (L1, G_KD) and the Discriminator features of the teacher's outputs (G_feat), see Pix2PixModel.
+#   python -m pix2pix_helpers train --folder data/tracos --model tracos_small --ngf 16 --teacher tracos_run_1
+#   python -m pix2pix_helpers distill --folder data/tracos --teacher tracos_run_1 --student tracos_small
+# The report compares student and teacher on CPU latency (eager, and folded with channels-last memory
+# as GeneratorInference(fuse=True) runs), number of parameters and the metrics of the test split.
+##
+
+def count_parameters(net):
+    return sum(parameter.numel() for parameter in net.parameters())
+
+
+def agreement_l1(student, teacher, test_set, device='cpu'):
+    """
+    Mean absolute difference between the outputs of the student and the teacher over the test loader
+    """
+    total, count = 0.0, 0
+    with torch.no_grad():
+        for data in test_set:
+            real_A = data['A'].to(device)
+            total += (student(real_A) - teacher(real_A)).abs().sum().item()
+            count += real_A.numel()
+    return total / max(count, 1)
+
+
+def measure(netG, batch_sizes=(1, 8), repeats=10):
+    """
+    Parameters and median latency in ms per batch size, eager and folded with channels-last memory
+    """
+    fused = fuse_generator(netG).to(memory_format=torch.channels_last)
+    result = {'parameters': count_parameters(netG)}
+    for batch_size in batch_sizes:
+        x = torch.rand(batch_size, 3, 256, 256) * 2 - 1
+        result[f'bs{batch_size}_ms'] = median_latency(netG, x, repeats)
+        result[f'bs{batch_size}_fused_ms'] = median_latency(
+            fused, x.contiguous(memory_format=torch.channels_last), repeats)
+    return result
+
+
+def compare(teacher_dir, student_dir, test_set=None, teacher_epoch='latest', student_epoch='latest',
+            batch_sizes=(1, 8), repeats=10):
+    """
+    Report of the student against the teacher: parameters, latency and, with a test loader, the test metrics
+    of both and the L1 between their outputs
+    """
+    teacher, teacher_epoch = load_generator(teacher_dir, teacher_epoch, mmap=False)
+    student, student_epoch = load_generator(student_dir, student_epoch, mmap=False)
+    report = {'teacher': {'dir': teacher_dir, 'epoch': teacher_epoch},
+            'student': {'dir': student_dir, 'epoch': student_epoch}}
+    for name, netG in (('teacher', teacher), ('student', student)):
+        report[name].update(measure(netG, batch_sizes, repeats))
+        if test_set is not None:
+            report[name].update(evaluate(netG, test_set))
+    if test_set is not None:
+        report['student']['L1_to_teacher'] = agreement_l1(student, teacher, test_set)
+    return report
+
+
+def print_report(report):
+    keys = [key for key in report['student'] if key not in ('dir', 'epoch') and not key.startswith('accuracy_')]
+    print(f'{"":16s} {"teacher":>12s} {"student":>12s} {"ratio":>8s}')
+    for key in keys:
+        student = report['student'][key]
+        teacher = report['teacher'].get(key)
+        if teacher is None:
+            print(f'{key:16s} {"":>12s} {student:12.4f}')
+        elif key == 'parameters':
+            print(f'{key:16s} {teacher / 1e6:11.3f}M {student / 1e6:11.3f}M {student / teacher:8.3f}')
+        else:
+            print(f'{key:16s} {teacher:12.4f} {student:12.4f} {student / teacher if teacher else 0:8.3f}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare a distilled student Generator with its teacher')
+    parser.add_argument('--teacher', required=True, help='name of the teacher model')
+    parser.add_argument('--student', required=True, help='name of the student model')
+    parser.add_argument('--teacher-epoch', default='latest')
+    parser.add_argument('--student-epoch', default='latest')
+    parser.add_argument('--folder', default=None, help='data folder, the test split is used for the metrics')
+    parser.add_argument('--packed', action='store_true')
+    parser.add_argument('--paired-folders', action='store_true')
+    parser.add_argument('--grids', action='store_true')
+    parser.add_argument('--batch-size', type=int, default=8, help='batch size of the test metrics')
+    parser.add_argument('--batch-sizes', default='1,8', help='batch sizes of the latency')
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=None, help='intra-op threads')
+    parser.add_argument('--out', default=None, help='json file of the report, in the student folder by default')
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    test_set = None
+    if args.folder is not None:
+        test_set = create_test_loader(create_test_set(args.folder, args.packed, args.paired_folders, args.grids),
+                                    args.batch_size)
+
+    student_dir = os.path.join('checkpoints', args.student)
+    report = compare(os.path.join('checkpoints', args.teacher), student_dir, test_set,
+                    args.teacher_epoch, args.student_epoch,
+                    [int(b) for b in args.batch_sizes.split(',')], args.repeats)
+    print_report(report)
+
+    out = args.out if args.out is not None else os.path.join(student_dir, 'distill_report.json')
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Report written to {out}')
+
+
+if __name__ == '__main__':
+    main()
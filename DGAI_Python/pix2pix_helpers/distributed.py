@@ -0,0 +1,144 @@
+import os
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.utils.data
+
+##
+# Helpers for multi-process data-parallel training (DistributedDataParallel).
+# Processes are expected to be launched by torchrun, which sets RANK, WORLD_SIZE and LOCAL_RANK.
+# CPU-only hosts use the gloo backend, CUDA hosts use nccl.
+##
+
+def setup_distributed(backend=None):
+    """
+    Initializes the default process group from the torchrun environment variables.
+    Returns the device this process should use
+    """
+    rank = int(os.environ.get('RANK', 0))
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+
+    if backend is None:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    if not dist.is_initialized():
+        dist.init_process_group(backend, rank=rank, world_size=world_size)
+
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        return torch.device('cuda', local_rank)
+    return torch.device('cpu')
+
+
+def cleanup_distributed():
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    """
+    Only rank 0 writes checkpoints, images and logs
+    """
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def create_distributed_loader(dataset, batch_size, shuffle=True, num_workers=0, **kwargs):
+    """
+    DataLoader that gives every process a disjoint shard of the dataset.
+    Call loader.sampler.set_epoch(epoch) at the start of every epoch to reshuffle the shards
+    """
+    sampler = torch.utils.data.distributed.DistributedSampler(dataset, shuffle=shuffle)
+    if 'collate_fn' not in kwargs and hasattr(dataset, 'collate'):
+        kwargs['collate_fn'] = dataset.collate
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, sampler=sampler,
+                                        num_workers=num_workers, **kwargs)
+
+
+class _AllReduceSum(torch.autograd.Function):
+    """
+    Differentiable all-reduce, the gradient is summed over the processes as well
+    """
+    @staticmethod
+    def forward(ctx, input):
+        output = input.clone()
+        dist.all_reduce(output)
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_input = grad_output.clone()
+        dist.all_reduce(grad_input)
+        return grad_input
+
+
+class DistributedBatchNorm2d(nn.BatchNorm2d):
+    """
+    BatchNorm2d with statistics computed over the batches of all processes.
+    nn.SyncBatchNorm only supports CUDA, this works with any backend, including gloo on CPU
+    """
+    def forward(self, input):
+        if not (self.training and is_distributed()):
+            return super(DistributedBatchNorm2d, self).forward(input)
+
+        # Sum, sum of squares and count of every channel, reduced over all processes in a single call.
+        # Accumulated in float32: under bfloat16 autocast E[x^2] - mean^2 cancels and can go negative
+        x = input.float()
+        n = x.numel() // x.shape[1]
+        stats = torch.cat([x.sum((0, 2, 3)), (x * x).sum((0, 2, 3)), x.new_full((1,), n)])
+        stats = _AllReduceSum.apply(stats)
+        c = x.shape[1]
+        count = stats[-1]
+        mean = stats[:c] / count
+        var = (stats[c:2 * c] / count - mean * mean).clamp(min=0)
+
+        if self.track_running_stats:
+            with torch.no_grad():
+                self.num_batches_tracked.add_(1)
+                momentum = self.momentum
+                if momentum is None:
+                    momentum = 1.0 / float(self.num_batches_tracked)
+                unbiased = var * count / (count - 1).clamp(min=1)
+                self.running_mean.mul_(1 - momentum).add_(mean, alpha=momentum)
+                self.running_var.mul_(1 - momentum).add_(unbiased, alpha=momentum)
+
+        output = (x - mean[None, :, None, None]) * torch.rsqrt(var + self.eps)[None, :, None, None]
+        if self.affine:
+            output = output * self.weight[None, :, None, None] + self.bias[None, :, None, None]
+        return output.to(input.dtype)
+
+
+def convert_sync_batchnorm(module):
+    """
+    Replaces every BatchNorm2d in the module by its synchronized version, keeping parameters and buffers.
+    Uses nn.SyncBatchNorm on CUDA and DistributedBatchNorm2d otherwise
+    """
+    if isinstance(module, nn.BatchNorm2d) and not isinstance(module, DistributedBatchNorm2d):
+        if module.weight is not None and module.weight.is_cuda:
+            return nn.SyncBatchNorm.convert_sync_batchnorm(module)
+        converted = DistributedBatchNorm2d(module.num_features, module.eps, module.momentum,
+                                            module.affine, module.track_running_stats)
+        converted.load_state_dict(module.state_dict())
+        converted.to(module.running_mean.device if module.running_mean is not None else 'cpu')
+        converted.train(module.training)
+        return converted
+
+    for name, child in module.named_children():
+        module.add_module(name, convert_sync_batchnorm(child))
+    return module
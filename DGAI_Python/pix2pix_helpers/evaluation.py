@@ -0,0 +1,292 @@
+import os
+import time
+import argparse
+import multiprocessing
+import torch
+import torch.nn.functional as F
+import torch.utils.data
+from pix2pix_helpers.catalog import CheckpointCatalog, load_generator
+from pix2pix_helpers.data_pipeline import create_loader
+from pix2pix_helpers.grid_loader import STATES, DEFAULT_PALETTE
+
+##
+# Evaluation of the Generator on the whole test split, per checkpoint. The metrics are computed on
+# batches of [0, 1] images with tensor ops only:
+#   L1        mean absolute error, on the [-1, 1] scale the L1 loss of training uses
+#   PSNR      mean over the images, in dB
+#   SSIM      gaussian window of 11 pixels, sigma 1.5, mean over the images
+#   accuracy  every pixel is assigned to the nearest palette color (the cell states of the grids),
+#             overall and per class pixel accuracy of the generated colors against the real ones
+# Results are recorded as eval_* metrics of the epoch in the checkpoint catalog, so 'best' can use them
+# (e.g. catalog.resolve('best', metric='eval_SSIM', mode='max')), and logged to TensorBoard when a writer is given.
+# watch() evaluates the checkpoints as they are written, start_watcher() runs it in a separate process
+# so evaluation never slows the training loop down:
+#   python -m pix2pix_helpers evaluate --folder data/tracos --model tracos_run_1 --watch
+##
+
+# Palette of the classes of the accuracy, in class order
+PALETTE = tuple(DEFAULT_PALETTE[state] for state in range(len(STATES)))
+
+# Prefix of the metrics in the catalog and in TensorBoard
+PREFIX = 'eval_'
+
+
+def gaussian_window(size=11, sigma=1.5):
+    x = torch.arange(size, dtype=torch.float32) - (size - 1) / 2
+    window = torch.exp(-x ** 2 / (2 * sigma ** 2))
+    return window / window.sum()
+
+
+def ssim(x, y, window=None, c1=0.01 ** 2, c2=0.03 ** 2):
+    """
+    SSIM of every image pair of two NxCxHxW batches in [0, 1], averaged over channels and pixels.
+    The five local statistics are blurred together, in one separable depthwise convolution
+    """
+    window = gaussian_window() if window is None else window
+    window = window.to(x)
+    channels = x.shape[1]
+    stats = torch.cat([x, y, x * x, y * y, x * y], 1)
+    stats = F.conv2d(stats, window.view(1, 1, -1, 1).expand(5 * channels, 1, -1, 1), groups=5 * channels)
+    stats = F.conv2d(stats, window.view(1, 1, 1, -1).expand(5 * channels, 1, 1, -1), groups=5 * channels)
+    mu_x, mu_y, xx, yy, xy = stats.chunk(5, 1)
+    mu_xy = mu_x * mu_y
+    mu_xx = mu_x * mu_x
+    mu_yy = mu_y * mu_y
+    ssim_map = ((2 * mu_xy + c1) * (2 * (xy - mu_xy) + c2)) / ((mu_xx + mu_yy + c1) * (xx - mu_xx + yy - mu_yy + c2))
+    return ssim_map.mean((1, 2, 3))
+
+
+def psnr(x, y):
+    """
+    PSNR in dB of every image pair of two NxCxHxW batches in [0, 1]
+    """
+    mse = (x - y).pow(2).mean((1, 2, 3))
+    return 10 * torch.log10(1 / mse.clamp(min=1e-10))
+
+
+def palette_classes(images, palette=PALETTE):
+    """
+    Index of the nearest palette color of every pixel of a NxCxHxW batch in [0, 1], as NxHxW
+    """
+    colors = torch.tensor(palette, dtype=images.dtype, device=images.device) / 255
+    # Squared distances without the |x|^2 term, which is the same for every color, as one matmul
+    distances = torch.einsum('nchw,kc->nkhw', images, -2 * colors) + colors.pow(2).sum(1).view(1, -1, 1, 1)
+    return distances.argmin(1)
+
+
+class EvaluationMetrics():
+    """
+    Accumulates the metrics over batches, call update with every generated and real batch
+    (NxCxHxW in [-1, 1], as the Generator works) and compute at the end
+    """
+    def __init__(self, palette=PALETTE, class_names=STATES):
+        self.palette = palette
+        self.class_names = class_names
+        self.window = gaussian_window()
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.pixels = 0
+        self.sums = {'L1': 0.0, 'PSNR': 0.0, 'SSIM': 0.0}
+        self.correct = torch.zeros(len(self.palette), dtype=torch.long)
+        self.total = torch.zeros(len(self.palette), dtype=torch.long)
+
+    def update(self, fake, real):
+        fake = fake.detach().float()
+        real = real.detach().float()
+        self.sums['L1'] += (fake - real).abs().sum().item()
+        self.pixels += real.numel()
+
+        fake = (fake + 1) / 2
+        real = (real + 1) / 2
+        self.sums['PSNR'] += psnr(fake, real).sum().item()
+        self.sums['SSIM'] += ssim(fake, real, self.window).sum().item()
+        self.count += real.shape[0]
+
+        fake_classes = palette_classes(fake, self.palette)
+        real_classes = palette_classes(real, self.palette)
+        n = len(self.palette)
+        self.correct += torch.bincount(real_classes[fake_classes == real_classes], minlength=n).cpu()
+        self.total += torch.bincount(real_classes.flatten(), minlength=n).cpu()
+
+    def compute(self):
+        assert self.count > 0, 'No images were evaluated'
+        metrics = {'L1': self.sums['L1'] / self.pixels, 'PSNR': self.sums['PSNR'] / self.count,
+                'SSIM': self.sums['SSIM'] / self.count,
+                'accuracy': self.correct.sum().item() / self.total.sum().item()}
+        present = self.total > 0
+        metrics['class_accuracy'] = (self.correct[present].double() / self.total[present].double()).mean().item()
+        for name, correct, total in zip(self.class_names, self.correct.tolist(), self.total.tolist()):
+            if total > 0:
+                metrics['accuracy_' + name] = correct / total
+        return metrics
+
+
+def create_test_set(folder_name, packed=False, paired_folders=False, grids=False):
+    """
+    Test split of the same data train.create_train_set reads, without flips and in a fixed order
+    """
+    if grids:
+        from pix2pix_helpers.grid_loader import GridDataset, GridZipDataset
+        if folder_name.endswith('.zip'):
+            return GridZipDataset(folder_name, phase='test', flip=False, shuffle=False, rank=0, world_size=1)
+        return GridDataset(folder_name, phase='test', flip=False)
+    from pix2pix_helpers.create_dataset import ImageFolderLoader, PairedFolderLoader
+    if paired_folders:
+        return PairedFolderLoader(folder_name, phase='test', preprocess='none', flip=False, batch_transform=True)
+    return ImageFolderLoader(f'{folder_name}/AB', phase='test', preprocess='none', flip=False,
+                            packed=packed, batch_transform=True)
+
+
+def create_test_loader(test_data, batch_size=8, num_workers=0):
+    # The watcher evaluates every checkpoint with the same loader, its workers stay alive in between
+    return create_loader(test_data, batch_size, num_workers=num_workers, pin_memory=torch.cuda.is_available())
+
+
+def evaluate(netG, test_set, device='cpu'):
+    """
+    Runs netG over every batch of the test loader and returns the metrics
+    """
+    metrics = EvaluationMetrics()
+    netG.eval()
+    with torch.no_grad():
+        for data in test_set:
+            real_A = data['A'].to(device)
+            real_B = data['B'].to(device)
+            metrics.update(netG(real_A), real_B)
+    return metrics.compute()
+
+
+def record(catalog, epoch, metrics, writer=None):
+    """
+    Stores the metrics of the epoch in the catalog, with the eval_ prefix, and logs them to TensorBoard
+    """
+    catalog.set_metrics(epoch, **dict((PREFIX + name, value) for name, value in metrics.items()))
+    if writer is not None:
+        for name, value in metrics.items():
+            writer.add_scalar('eval/' + name, value, epoch)
+        writer.flush()
+
+
+def evaluate_checkpoint(ckpt_dir, epoch, test_set, device='cpu', writer=None):
+    """
+    Evaluates the Generator of a checkpoint ('latest', 'best' or an epoch) and records the metrics.
+    Returns the epoch and the metrics
+    """
+    netG, epoch = load_generator(ckpt_dir, epoch, device=device)
+    start = time.time()
+    metrics = evaluate(netG, test_set, device)
+    record(CheckpointCatalog(ckpt_dir), epoch, metrics, writer)
+    print(f'Epoch {epoch} | ' + ' | '.join(f'{name} {value:.4f}' for name, value in metrics.items()
+                                            if not name.startswith('accuracy_')) +
+        f' | {time.time() - start:.1f} secs')
+    return epoch, metrics
+
+
+def pending_epochs(catalog):
+    """
+    Epochs with a Generator checkpoint that were not evaluated yet
+    """
+    entries = catalog.refresh()
+    return [epoch for epoch in catalog.epochs('net_G') if PREFIX + 'L1' not in entries[epoch]['metrics']]
+
+
+def watch(ckpt_dir, test_set, device='cpu', writer=None, interval=10, stop_event=None):
+    """
+    Evaluates every checkpoint of ckpt_dir that was not evaluated yet, then waits for new ones.
+    Returns once stop_event is set and every checkpoint written until then is evaluated, runs until
+    interrupted without a stop_event
+    """
+    catalog = CheckpointCatalog(ckpt_dir)
+    while True:
+        stopping = stop_event is not None and stop_event.is_set()
+        for epoch in pending_epochs(catalog):
+            try:
+                evaluate_checkpoint(ckpt_dir, epoch, test_set, device, writer)
+            except (OSError, RuntimeError, KeyError, AssertionError) as e:
+                # Removed by the retention policy in the meantime
+                if epoch in catalog.refresh() and os.path.isfile(catalog.file_path(epoch)):
+                    raise
+                print(f'Checkpoint {epoch} is gone, skipped ({e})')
+        if stopping:
+            return
+        if stop_event is not None:
+            stop_event.wait(interval)
+        else:
+            time.sleep(interval)
+
+
+def _watch_process(ckpt_dir, folder_name, packed, paired_folders, grids, batch_size, threads, log_dir, stop_event):
+    torch.set_num_threads(threads)
+    writer = None
+    if log_dir is not None:
+        from torch.utils.tensorboard import SummaryWriter
+        writer = SummaryWriter(log_dir=log_dir)
+    test_data = create_test_set(folder_name, packed, paired_folders, grids)
+    watch(ckpt_dir, create_test_loader(test_data, batch_size), writer=writer, stop_event=stop_event)
+    if writer is not None:
+        writer.close()
+
+
+def start_watcher(ckpt_dir, folder_name, packed=False, paired_folders=False, grids=False, batch_size=8,
+                threads=1, log_dir=None):
+    """
+    Starts watch in a separate process, on threads cores. Returns the process and its stop event:
+    set the event and join the process to evaluate the remaining checkpoints and stop
+    """
+    context = multiprocessing.get_context('spawn')
+    stop_event = context.Event()
+    # Daemon, so the watcher does not outlive a training that crashed
+    process = context.Process(target=_watch_process, name='EvaluationWatcher', daemon=True,
+                            args=(ckpt_dir, folder_name, packed, paired_folders, grids, batch_size, threads,
+                                log_dir, stop_event))
+    process.start()
+    return process, stop_event
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Evaluate the checkpoints of a model on the test split')
+    parser.add_argument('--folder', required=True, help='folder containing AB/test (or A and B, or the grids)')
+    parser.add_argument('--model', required=True, help='name of the model, read from checkpoints/MODEL')
+    parser.add_argument('--epoch', default=None, help="checkpoint to evaluate, 'latest', 'best' or an epoch, "
+                        "all checkpoints not evaluated yet by default")
+    parser.add_argument('--packed', action='store_true')
+    parser.add_argument('--paired-folders', action='store_true')
+    parser.add_argument('--grids', action='store_true')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=0, help='DataLoader workers')
+    parser.add_argument('--threads', type=int, default=None, help='intra-op threads')
+    parser.add_argument('--no-logs', action='store_true', help='do not log to TensorBoard (runs/MODEL/eval)')
+    parser.add_argument('--watch', action='store_true', help='keep evaluating new checkpoints until interrupted')
+    parser.add_argument('--interval', type=float, default=10, help='seconds between checks for new checkpoints')
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    ckpt_dir = os.path.join('checkpoints', args.model)
+    writer = None
+    if not args.no_logs:
+        from torch.utils.tensorboard import SummaryWriter
+        writer = SummaryWriter(log_dir=os.path.join('runs', args.model, 'eval'))
+    test_set = create_test_loader(create_test_set(args.folder, args.packed, args.paired_folders, args.grids),
+                                args.batch_size, args.workers)
+
+    try:
+        if args.epoch is not None:
+            evaluate_checkpoint(ckpt_dir, args.epoch, test_set, device, writer)
+        elif args.watch:
+            watch(ckpt_dir, test_set, device, writer, args.interval)
+        else:
+            for epoch in pending_epochs(CheckpointCatalog(ckpt_dir)):
+                evaluate_checkpoint(ckpt_dir, epoch, test_set, device, writer)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+import os
+import time
+import copy
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+from pix2pix_helpers.pix2pix_model import UnetBlock
+
+##
+# Inference optimization of the Generator. In eval mode a BatchNorm2d only scales and shifts every channel
+# with its running statistics, so it is folded into the weights and bias of the convolution before it
+# (Conv2d scales its output channels along dim 0 of the weight, ConvTranspose2d along dim 1) and removed
+# from the graph, together with Dropout, which does nothing in eval mode. The folded module has the same
+# UnetBlocks, so the in-place activations and skip connections behave exactly as before.
+# freeze_generator additionally traces and freezes it to TorchScript with channels-last memory, optionally
+# with the activations fused into the convolutions (optimize=True), and the folded module exports to an ONNX
+# graph without BatchNormalization nodes (onnxruntime fuses the activations of the ONNX graph itself).
+#   python -m pix2pix_helpers fuse --ckpt-dir checkpoints/tracos_run_1 --folder data/tracos
+##
+
+CONVOLUTIONS = (nn.Conv2d, nn.ConvTranspose2d)
+
+
+def fold_batchnorm(conv, bn):
+    """
+    New convolution equal to bn(conv(x)) with bn in eval mode
+    """
+    assert isinstance(conv, CONVOLUTIONS) and isinstance(bn, nn.BatchNorm2d)
+    assert bn.track_running_stats, 'Only BatchNorm with running statistics can be folded'
+    fused = copy.deepcopy(conv)
+    with torch.no_grad():
+        scale = bn.running_var.add(bn.eps).rsqrt()
+        if bn.affine:
+            scale = scale * bn.weight
+        shift = -bn.running_mean * scale
+        if bn.affine:
+            shift = shift + bn.bias
+        if isinstance(conv, nn.ConvTranspose2d):
+            # in x out/groups x kh x kw, every group has its own slice of the output channels
+            weight = conv.weight.view(conv.groups, conv.in_channels // conv.groups, -1, *conv.weight.shape[2:])
+            weight = weight * scale.view(conv.groups, 1, -1, 1, 1)
+            fused.weight.copy_(weight.view_as(conv.weight))
+        else:
+            fused.weight.copy_(conv.weight * scale.view(-1, 1, 1, 1))
+        bias = shift if conv.bias is None else conv.bias * scale + shift
+        fused.bias = nn.Parameter(bias)
+    return fused
+
+
+def fold_sequential(sequential):
+    """
+    Sequential with every convolution followed by a BatchNorm2d folded and the Dropouts removed
+    """
+    modules = list(sequential)
+    folded = []
+    i = 0
+    while i < len(modules):
+        module = modules[i]
+        following = modules[i + 1] if i + 1 < len(modules) else None
+        if isinstance(module, CONVOLUTIONS) and isinstance(following, nn.BatchNorm2d):
+            folded.append(fold_batchnorm(module, following))
+            i += 2
+            continue
+        if not isinstance(module, nn.Dropout):
+            folded.append(module)
+        i += 1
+    return nn.Sequential(*folded)
+
+
+def fuse_generator(netG):
+    """
+    Copy of netG in eval mode with the BatchNorms folded into the convolutions, for inference only
+    """
+    fused = copy.deepcopy(netG).eval()
+    for module in fused.modules():
+        if isinstance(module, UnetBlock):
+            module.model = fold_sequential(module.model)
+    for parameter in fused.parameters():
+        parameter.requires_grad_(False)
+    return fused
+
+
+def freeze_generator(netG, size=256, channels_last=True, optimize=False):
+    """
+    Folded netG traced and frozen to TorchScript. With optimize, optimize_for_inference (PyTorch 1.9 or newer)
+    fuses the activations into the convolutions where the CPU backend supports it. Measure before using it,
+    on the ConvTranspose2d layers of the Generator it can be slower than the plain frozen graph
+    """
+    fused = fuse_generator(netG)
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    fused = fused.to(memory_format=memory_format)
+    example = torch.zeros((1, 3, size, size)).contiguous(memory_format=memory_format)
+    with torch.no_grad():
+        frozen = torch.jit.freeze(torch.jit.trace(fused, example))
+        if optimize and hasattr(torch.jit, 'optimize_for_inference'):
+            frozen = torch.jit.optimize_for_inference(frozen)
+    return frozen
+
+
+def max_error(reference, optimized, inputs, batch_size=8):
+    """
+    Largest absolute difference between the outputs of the two networks over the inputs
+    """
+    error = 0.0
+    with torch.no_grad():
+        for i in range(0, len(inputs), batch_size):
+            x = inputs[i:i + batch_size]
+            expected = reference(x)
+            output = torch.as_tensor(optimized(x)).float()
+            error = max(error, (output - expected).abs().max().item())
+    return error
+
+
+def median_latency(fn, x, repeats=10):
+    with torch.no_grad():
+        fn(x)
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            fn(x)
+            times.append(time.perf_counter() - start)
+    return float(np.median(times)) * 1000
+
+
+def count_nodes(path):
+    """
+    Number of nodes of every op type in an ONNX file
+    """
+    import onnx
+    counts = {}
+    for node in onnx.load(path).graph.node:
+        counts[node.op_type] = counts.get(node.op_type, 0) + 1
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fold the BatchNorms of a Generator and export the optimized graph')
+    parser.add_argument('--ckpt-dir', required=True, help='checkpoint folder of the model')
+    parser.add_argument('--epoch', default='latest', help="checkpoint to optimize, 'latest', 'best' or an epoch")
+    parser.add_argument('--folder', default=None, help='data folder, the test split is used for the equivalence check')
+    parser.add_argument('--paired-folders', action='store_true')
+    parser.add_argument('--test-limit', type=int, default=16)
+    parser.add_argument('--out-dir', default='exported')
+    parser.add_argument('--opset', type=int, default=10)
+    parser.add_argument('--batch-sizes', default='1,8')
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--tolerance', type=float, default=1e-4, help='largest absolute error accepted')
+    parser.add_argument('--optimize', action='store_true', help='fuse the activations of the TorchScript graph')
+    args = parser.parse_args(argv)
+
+    from pix2pix_helpers.catalog import load_generator
+    from pix2pix_helpers.onnx_backend import export_onnx, load_test_inputs, OnnxGenerator
+    netG, epoch = load_generator(args.ckpt_dir, args.epoch, mmap=False)
+    model_name = os.path.basename(os.path.normpath(args.ckpt_dir))
+    fused = fuse_generator(netG)
+    frozen = freeze_generator(netG, optimize=args.optimize)
+
+    if args.folder is not None:
+        inputs = load_test_inputs(args.folder, args.paired_folders, args.test_limit)
+    else:
+        inputs = torch.rand(args.test_limit, 3, 256, 256) * 2 - 1
+
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+    script_path = os.path.join(args.out_dir, f'{model_name}_fused.pt')
+    frozen.save(script_path)
+    onnx_path = export_onnx(netG, os.path.join(args.out_dir, f'{model_name}.onnx'), args.opset)
+    fused_onnx_path = export_onnx(fused, os.path.join(args.out_dir, f'{model_name}_fused.onnx'), args.opset)
+    onnx_model = OnnxGenerator(onnx_path)
+    fused_onnx_model = OnnxGenerator(fused_onnx_path)
+
+    print(f'Checkpoint {epoch}, {len(inputs)} inputs')
+    errors = {'folded': max_error(netG, fused, inputs), 'frozen': max_error(netG, frozen, inputs),
+            'onnx folded': max_error(netG, fused_onnx_model, inputs)}
+    for name, error in errors.items():
+        print(f'Max abs error {name:12s} {error:.2e}')
+    for name, path in (('onnx', onnx_path), ('onnx folded', fused_onnx_path)):
+        try:
+            print(f'{name} nodes: {count_nodes(path)}')
+        except ImportError:
+            pass
+
+    # Folded with channels-last memory is what GeneratorInference(fuse=True) runs
+    fused_last = fuse_generator(netG).to(memory_format=torch.channels_last)
+    print('batch | eager ms | folded ms | folded NHWC ms | frozen ms | onnx ms | onnx folded ms')
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        x = torch.rand(batch_size, 3, 256, 256) * 2 - 1
+        x_last = x.contiguous(memory_format=torch.channels_last)
+        times = [median_latency(netG, x, args.repeats), median_latency(fused, x, args.repeats),
+                median_latency(fused_last, x_last, args.repeats), median_latency(frozen, x_last, args.repeats),
+                median_latency(onnx_model, x, args.repeats), median_latency(fused_onnx_model, x, args.repeats)]
+        print(f'{batch_size:5d} | ' + ' | '.join(f'{t:9.1f}' for t in times))
+
+    print(f'Written {script_path} and {fused_onnx_path}')
+    assert max(errors.values()) <= args.tolerance, f'Optimized graph differs by more than {args.tolerance}'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+import os
+import glob
+import random
+import zipfile
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
+import torch
+import torch.utils.data
+from pix2pix_helpers.create_dataset import PairedBatchTransform
+
+##
+# Reader for the voxel grids exchanged by Unity and Rhino, CSV rows of x,y,z,State
+# (see DGAI_Rhino/grid0.csv and DGAI_Unity/Grids). Grids are parsed and rasterized with numpy only,
+# straight into 256x256 A/B images, following the conventions of the Unity project:
+#   - the image is the XZ plane of the grid, x to the right and z up (texture row 0 is the bottom)
+#   - non-square grids are scaled to 256 on their longest side and placed top left (ImageReadWrite.Resize256)
+#   - the height of a red voxel is encoded as its saturation, s = y / (size_y - 1) (VoxelGrid.SetStatesFromImage)
+# A is the footprint of the boxes (black voxels), B adds the structure (red voxels) on top of it.
+# GridZipDataset streams the grids straight out of a zip archive (e.g. DGAI_Unity/Grids/grids.zip).
+##
+
+# VoxelState of the Unity project, White is an empty voxel
+STATES = ('White', 'Black', 'Red', 'Yellow')
+WHITE, BLACK, RED, YELLOW = range(len(STATES))
+
+DEFAULT_PALETTE = {WHITE: (255, 255, 255), BLACK: (0, 0, 0), RED: (255, 0, 0), YELLOW: (255, 255, 0)}
+
+# One pass of bytes.translate turns the state names into their code (by their first letter, the other
+# letters are deleted) and the line breaks into commas, so a whole file is parsed by one numpy call
+_TRANSLATION = bytes.maketrans(b'WBRY\n', b'0123,')
+_DELETED = b'acdehiklotw\r'
+
+
+def _encode(data):
+    if isinstance(data, str):
+        data = data.encode()
+    return data.translate(_TRANSLATION, _DELETED).strip(b',')
+
+
+def parse_grid(data):
+    """
+    Nx4 int32 array of x, y, z, state from the contents (bytes or str) of a grid CSV
+    """
+    data = _encode(data)
+    if len(data) == 0:
+        return np.zeros((0, 4), dtype=np.int32)
+    return np.fromstring(data, dtype=np.int32, sep=',').reshape(-1, 4)
+
+
+def parse_grids(contents):
+    """
+    Parses many grid CSVs with a single numpy call, returns a list of Nx4 arrays (views into one buffer)
+    """
+    encoded = [_encode(data) for data in contents]
+    rows = [data.count(b',') // 4 + 1 if len(data) > 0 else 0 for data in encoded]
+    values = np.fromstring(b','.join(data for data in encoded if len(data) > 0), dtype=np.int32, sep=',')
+    assert len(values) == 4 * sum(rows), 'Grid CSV rows must have 4 values, x,y,z,State'
+    return np.split(values.reshape(-1, 4), np.cumsum(rows)[:-1])
+
+
+def read_grid(path):
+    with open(path, 'rb') as f:
+        return parse_grid(f.read())
+
+
+def grid_size(voxels):
+    """
+    Size (x, y, z) of the smallest grid at the origin containing the voxels
+    """
+    if len(voxels) == 0:
+        return (1, 1, 1)
+    return tuple(int(v) + 1 for v in voxels[:, :3].max(axis=0))
+
+
+def voxel_volume(voxels, size_xyz):
+    """
+    ZxYxX uint8 array of the voxel states, White where there is no voxel. Voxels outside size_xyz are dropped
+    """
+    size_x, size_y, size_z = size_xyz
+    x, y, z, state = voxels.T
+    inside = (x < size_x) & (y < size_y) & (z < size_z)
+    volume = np.zeros((size_z, size_y, size_x), dtype=np.uint8)
+    volume[z[inside], y[inside], x[inside]] = state[inside]
+    return volume
+
+
+class GridRasterizer():
+    """
+    Turns parsed grids into A/B images.
+    states_A / states_B are the voxel states drawn in each image, projection is 'top' (the highest
+    voxel of every column) or 'slice' (only the voxels of the given layer). size_xyz fixes the size of
+    the grid, otherwise it is taken from every grid (see grid_size). Other palettes map state codes to RGB
+    """
+    def __init__(self, size=256, palette=None, states_A=(BLACK,), states_B=(BLACK, RED),
+                projection='top', layer=0, height_as_saturation=True, size_xyz=None):
+        assert projection in ('top', 'slice'), f"Unknown projection '{projection}'"
+        self.size = size
+        self.states_A = tuple(states_A)
+        self.states_B = tuple(states_B)
+        self.projection = projection
+        self.layer = layer
+        self.height_as_saturation = height_as_saturation
+        self.size_xyz = size_xyz
+        palette = dict(DEFAULT_PALETTE, **(palette or {}))
+        self.palette = np.array([palette[code] for code in range(len(STATES))], dtype=np.uint8)
+        self._pixel_maps = {}
+
+    def pixel_map(self, size_x, size_z):
+        """
+        Flat index (z * size_x + x) of the grid cell shown by every output pixel, size_x * size_z for the border
+        """
+        key = (size_x, size_z)
+        if key not in self._pixel_maps:
+            side = self.size
+            if size_x >= size_z:
+                width, height = side, int(round(side * size_z / size_x))
+            else:
+                width, height = int(round(side * size_x / size_z)), side
+            # Nearest neighbour (TextureScale.Point), rows flipped since texture row 0 is the bottom
+            rows = (height - 1 - np.arange(height)) * size_z // height
+            cols = np.arange(width) * size_x // width
+            cells = np.full((side, side), size_x * size_z, dtype=np.intp)
+            cells[:height, :width] = rows[:, None] * size_x + cols[None, :]
+            self._pixel_maps[key] = cells
+        return self._pixel_maps[key]
+
+    def project(self, volume, states):
+        """
+        State and height of every XZ cell, ZxX arrays
+        """
+        selected = np.zeros(len(STATES), dtype=bool)
+        selected[list(states)] = True
+        volume = np.where(selected[volume], volume, WHITE)
+        if self.projection == 'slice':
+            return volume[:, self.layer, :], np.full(volume[:, 0, :].shape, self.layer)
+        # Highest voxel of every column, empty columns end up at the top of the grid with an empty state
+        height = volume.shape[1] - 1 - np.argmax(volume[:, ::-1, :] != WHITE, axis=1)
+        return np.take_along_axis(volume, height[:, None, :], axis=1)[:, 0, :], height
+
+    def render(self, voxels, states, size_xyz=None, volume=None):
+        """
+        3xHxW uint8 image of the voxels in the given states, channels first like the uint8 tensors of the loaders
+        """
+        size_xyz = size_xyz or self.size_xyz or grid_size(voxels)
+        size_x, size_y, size_z = size_xyz
+        if volume is None:
+            volume = voxel_volume(voxels, size_xyz)
+        cell_state, cell_height = self.project(volume, states)
+
+        # Colors at the resolution of the grid, one plane per channel, and an empty cell for the border
+        cell_state = np.append(cell_state.ravel(), WHITE)
+        colors = self.palette.T[:, cell_state]
+        if self.height_as_saturation and size_y > 1:
+            red = np.flatnonzero(cell_state == RED)
+            # Full red at the top of the grid, fading towards white at the bottom
+            fade = 255 - np.rint(255 * cell_height.ravel()[red] / (size_y - 1))
+            colors[1:, red] = fade
+        # Scaled up by a single gather per channel
+        return np.take(colors, self.pixel_map(size_x, size_z), axis=1)
+
+    def __call__(self, voxels, size_xyz=None):
+        """
+        A and B images of a grid, 3xHxW uint8
+        """
+        size_xyz = size_xyz or self.size_xyz or grid_size(voxels)
+        volume = voxel_volume(voxels, size_xyz)
+        return (self.render(voxels, self.states_A, size_xyz, volume),
+                self.render(voxels, self.states_B, size_xyz, volume))
+
+
+def make_grid_dataset(dir):
+    return sorted(glob.glob(os.path.join(dir, '*.csv')))
+
+
+class GridDataset():
+    """
+    Training pairs rendered from the grid CSVs in root (or root/phase when it exists), without any image files.
+    Samples are uint8 CxHxW tensors, pre-processed per batch by collate like ImageFolderLoader(batch_transform=True)
+    """
+    def __init__(self, root, phase='train', rasterizer=None, preprocess='none', flip=True):
+        self.root = root
+        self.dir_grids = os.path.join(root, phase) if os.path.isdir(os.path.join(root, phase)) else root
+        self.grid_paths = make_grid_dataset(self.dir_grids)
+        if len(self.grid_paths) == 0:
+            raise(RuntimeError("Found 0 grid csv files in " + self.dir_grids))
+        self.rasterizer = rasterizer or GridRasterizer()
+        self.batch_transform = PairedBatchTransform(preprocess=preprocess, flip=flip)
+
+    def __getitem__(self, index):
+        path = self.grid_paths[index]
+        A, B = self.rasterizer(read_grid(path))
+        return {'A': torch.from_numpy(A), 'B': torch.from_numpy(B),
+                'A_paths': path, 'B_paths': path}
+
+    def collate(self, batch):
+        return self.batch_transform(torch.utils.data.dataloader.default_collate(batch))
+
+    def __len__(self):
+        return len(self.grid_paths)
+
+
+class GridZipDataset(torch.utils.data.IterableDataset):
+    """
+    Training pairs streamed from the grid CSVs in a zip archive, without extracting it.
+    Every DataLoader worker opens its own handle on the archive and reads its own shard of the members,
+    sharded over the workers and over the processes when distributed. Rendered pairs are kept in an LRU
+    cache of cache_size pairs per worker, so with persistent_workers=True (or num_workers=0) the members
+    that fit in the cache are read and rendered once. Call set_epoch(epoch) to reshuffle every epoch
+    """
+    def __init__(self, zip_path, phase='train', rasterizer=None, preprocess='none', flip=True,
+                shuffle=True, seed=0, cache_size=1024, rank=None, world_size=None):
+        self.zip_path = zip_path
+        with zipfile.ZipFile(zip_path) as archive:
+            members = sorted(name for name in archive.namelist() if name.endswith('.csv'))
+        # Use the members of the phase folder when the archive has one
+        in_phase = [name for name in members if f'/{phase}/' in '/' + name]
+        self.members = in_phase if len(in_phase) > 0 else members
+        if len(self.members) == 0:
+            raise(RuntimeError("Found 0 grid csv files in " + zip_path))
+        self.rasterizer = rasterizer or GridRasterizer()
+        self.batch_transform = PairedBatchTransform(preprocess=preprocess, flip=flip)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.cache_size = cache_size
+
+        from pix2pix_helpers import distributed
+        self.rank = distributed.get_rank() if rank is None else rank
+        self.world_size = distributed.get_world_size() if world_size is None else world_size
+        # Every process gets the same number of samples (padded like DistributedSampler),
+        # otherwise the processes would not run the same number of steps
+        per_rank = -(-len(self.members) // self.world_size)
+        padded = (self.members * self.world_size)[:per_rank * self.world_size]
+        self.shard = padded[self.rank::self.world_size]
+
+        # Shared with the workers, so set_epoch also reaches persistent workers
+        self._epoch = multiprocessing.Value('i', 0, lock=False)
+        self._archive = None
+        self._archive_pid = None
+        self._cache = OrderedDict()
+
+    def __getstate__(self):
+        # Workers start with their own handle and an empty cache
+        state = dict(self.__dict__)
+        state['_archive'] = None
+        state['_cache'] = OrderedDict()
+        return state
+
+    def set_epoch(self, epoch):
+        self._epoch.value = epoch
+
+    def open(self):
+        """
+        Handle on the archive of the current process, handles are never shared between processes
+        """
+        if self._archive is None or self._archive_pid != os.getpid():
+            self._archive = zipfile.ZipFile(self.zip_path)
+            self._archive_pid = os.getpid()
+            self._cache = OrderedDict()
+        return self._archive
+
+    def load_pair(self, member):
+        if member in self._cache:
+            self._cache.move_to_end(member)
+            return self._cache[member]
+        A, B = self.rasterizer(parse_grid(self.open().read(member)))
+        pair = (torch.from_numpy(A), torch.from_numpy(B))
+        if self.cache_size > 0:
+            self._cache[member] = pair
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return pair
+
+    def __iter__(self):
+        worker = torch.utils.data.get_worker_info()
+        members = self.shard if worker is None else self.shard[worker.id::worker.num_workers]
+        if self.shuffle:
+            # Same order on every run for a given seed and epoch
+            members = list(members)
+            random.Random(self.seed + self._epoch.value).shuffle(members)
+        for member in members:
+            A, B = self.load_pair(member)
+            path = self.zip_path + '/' + member
+            yield {'A': A, 'B': B, 'A_paths': path, 'B_paths': path}
+
+    def collate(self, batch):
+        return self.batch_transform(torch.utils.data.dataloader.default_collate(batch))
+
+    def __len__(self):
+        return len(self.shard)
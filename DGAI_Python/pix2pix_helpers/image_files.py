@@ -0,0 +1,44 @@
+import os
+from PIL import Image
+
+##
+# Listing of the image files of a dataset, and the PIL-only helpers shared with inference.
+# Kept apart from create_dataset so the preparation scripts (resize_image, pack_dataset, ...)
+# and the inference server can use them without importing torch / torchvision.
+##
+
+IMG_EXTENSIONS = [
+    '.jpg', '.JPG', 'jpeg', '.JPEG',
+    '.png', '.PNG', '.ppm', '.PPM', '.bmp', '.BMP',
+    '.tif', '.TIF', '.tiff', '.TIFF',
+]
+
+
+def is_image_file(filename):
+    return any(filename.endswith(extension) for extension in IMG_EXTENSIONS)
+
+
+def make_dataset(dir, max_dataset_size=float("inf")):
+    images = []
+    assert os.path.isdir(dir), '%s is not a valid directory' % dir
+
+    for root, _, fnames in sorted(os.walk(dir)):
+        for fname in fnames:
+            if is_image_file(fname):
+                path = os.path.join(root, fname)
+                images.append(path)
+    
+    return images[:min(max_dataset_size, len(images))]
+
+
+def pad_square(img):
+    """
+    Same result as combine_images.add_border, without the extra copy for images that are already square RGB
+    """
+    ow, oh = img.size
+    if ow == oh:
+        return img.convert('RGB')
+    w = max(ow, oh)
+    out = Image.new('RGB', (w, w))
+    out.paste(img)
+    return out
@@ -0,0 +1,140 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from PIL import Image
+from pix2pix_helpers.image_files import pad_square
+
+##
+# Batched inference with a trained Generator.
+# Images (paths, PIL images or HxWx3 uint8 arrays) are decoded on a thread pool while the
+# previous batch runs through netG, and the results are handed out (or written to disk) per batch.
+##
+
+class GeneratorInference():
+    """
+    Runs netG over iterables of images in batches, under inference mode and with channels-last memory.
+    With fuse the BatchNorms are folded into the convolutions first (see fuse.py).
+    compile can be None, 'script' (frozen TorchScript trace) or 'compile' (torch.compile, PyTorch 2 only)
+    """
+    def __init__(self, netG, device=None, batch_size=16, size=256, channels_last=True,
+                compile=None, io_threads=4, fuse=False):
+        if device is None:
+            device = next(netG.parameters()).device
+        self.device = torch.device(device)
+        self.batch_size = batch_size
+        self.size = size
+        self.channels_last = channels_last
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        self.io_threads = io_threads
+
+        netG = netG.to(self.device).eval()
+        if fuse:
+            from pix2pix_helpers.fuse import fuse_generator
+            netG = fuse_generator(netG)
+        if channels_last:
+            netG = netG.to(memory_format=torch.channels_last)
+        self.netG = self.compile_network(netG, compile)
+
+    @classmethod
+    def from_checkpoint(cls, ckpt_dir, epoch='latest', **kwargs):
+        """
+        Loads the Generator saved by Pix2PixModel.save_network for the given epoch, 'latest' or 'best'
+        """
+        from pix2pix_helpers.catalog import load_generator
+        netG, _ = load_generator(ckpt_dir, epoch)
+        return cls(netG, **kwargs)
+
+    def compile_network(self, netG, compile):
+        if compile is None:
+            return netG
+        if compile == 'script':
+            example = torch.zeros((1, 3, self.size, self.size), device=self.device)
+            example = example.contiguous(memory_format=self.memory_format)
+            with torch.no_grad():
+                traced = torch.jit.trace(netG, example)
+            return torch.jit.freeze(traced)
+        if compile == 'compile':
+            assert hasattr(torch, 'compile'), 'torch.compile requires PyTorch 2.0 or newer'
+            return torch.compile(netG)
+        raise ValueError('Unknown compile mode %s' % compile)
+
+    def load_image(self, image):
+        """
+        Returns the image as a uint8 3xHxW tensor, padded to a square and resized to the network size
+        """
+        if isinstance(image, str):
+            image = Image.open(image)
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        image = pad_square(image)
+        if image.size != (self.size, self.size):
+            image = image.resize((self.size, self.size), Image.NEAREST)
+        return torch.from_numpy(np.array(image)).permute(2, 0, 1)
+
+    def predict(self, batch):
+        """
+        Runs a uint8 Nx3xHxW batch through the Generator, returns the uint8 Nx3xHxW output
+        """
+        with torch.inference_mode():
+            # Same floats as ToTensor and Normalize(0.5, 0.5) in training, 255 maps to exactly 1.0
+            x = batch.to(self.device, non_blocking=True).float().div_(127.5).sub_(1)
+            x = x.contiguous(memory_format=self.memory_format)
+            y = self.netG(x)
+            return y.float().add_(1.0).mul_(127.5).clamp_(0, 255).round_().to(torch.uint8).cpu()
+
+    def _chunks(self, images):
+        chunk = []
+        for image in images:
+            chunk.append(image)
+            if len(chunk) == self.batch_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+    def run(self, images):
+        """
+        Generator over the outputs, yields (inputs, uint8 Nx3xHxW output) for every batch.
+        The next batch is decoded while the current one runs through the network
+        """
+        with ThreadPoolExecutor(max_workers=self.io_threads) as pool:
+            pending = None
+            for chunk in self._chunks(images):
+                loading = (chunk, pool.map(self.load_image, chunk))
+                if pending is not None:
+                    yield pending[0], self.predict(torch.stack(list(pending[1])))
+                pending = loading
+            if pending is not None:
+                yield pending[0], self.predict(torch.stack(list(pending[1])))
+
+    def save(self, images, out_dir, ext='.png'):
+        """
+        Streams the outputs to out_dir, using the input file names when the images are paths.
+        Returns the number of images written
+        """
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+
+        count = 0
+        with ThreadPoolExecutor(max_workers=self.io_threads) as pool:
+            writes = []
+            for inputs, output in self.run(images):
+                output = output.permute(0, 2, 3, 1).numpy()
+                for i, image in enumerate(inputs):
+                    if isinstance(image, str):
+                        name = os.path.splitext(os.path.basename(image))[0] + ext
+                    else:
+                        name = 'output_%06d%s' % (count + i, ext)
+                    writes.append(pool.submit(save_array, output[i], os.path.join(out_dir, name)))
+                count += len(inputs)
+                # Keep the number of images waiting to be written bounded
+                while len(writes) > 2 * self.batch_size:
+                    writes.pop(0).result()
+            for write in writes:
+                write.result()
+        return count
+
+
+def save_array(image_array, path):
+    Image.fromarray(image_array).save(path)
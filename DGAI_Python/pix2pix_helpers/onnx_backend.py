@@ -0,0 +1,227 @@
+import os
+import time
+import inspect
+import argparse
+import numpy as np
+import torch
+import torch.onnx
+
+##
+# Runs the Generator exported to ONNX (the file shipped to Unity) with onnxruntime on the CPU,
+# and checks it against the PyTorch netG it was exported from, both for correctness and speed.
+#   python -m pix2pix_helpers.onnx_backend --onnx exported/tracos_run_1.onnx --ckpt-dir checkpoints/tracos_run_1 --folder data/tracos
+##
+
+def export_onnx(netG, path, opset=10, dynamic_batch=False, device='cpu', size=256):
+    """
+    Exports netG to ONNX. With dynamic_batch=False the batch dimension is fixed to 1, as Barracuda expects
+    """
+    x = torch.randn(1, 3, size, size, device=device)
+    kwargs = {}
+    if dynamic_batch:
+        kwargs['dynamic_axes'] = {'input': {0: 'batch'}, 'output': {0: 'batch'}}
+    # Newer PyTorch versions default to the dynamo exporter, which does not support the old opsets
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False
+    torch.onnx.export(netG, x, path, training=torch.onnx.TrainingMode.EVAL, export_params=True,
+                    opset_version=opset, input_names=['input'], output_names=['output'], **kwargs)
+    return path
+
+
+class OnnxGenerator():
+    """
+    onnxruntime session around an exported Generator. Takes and returns float32 Nx3xHxW arrays in [-1, 1].
+    Models exported with a fixed batch size are run in chunks of that size
+    """
+    def __init__(self, path, intra_op_threads=None, inter_op_threads=None, io_binding=True):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads is not None:
+            options.intra_op_num_threads = intra_op_threads
+        if inter_op_threads is not None:
+            options.inter_op_num_threads = inter_op_threads
+            if inter_op_threads > 1:
+                options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+
+        self.ort = ort
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.io_binding = io_binding
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_name = self.session.get_outputs()[0].name
+        batch = self.session.get_inputs()[0].shape[0]
+        self.fixed_batch = batch if isinstance(batch, int) else None
+        self._outputs = {}
+
+    def _run(self, x):
+        if not self.io_binding:
+            return self.session.run([self.output_name], {self.input_name: x})[0]
+
+        # Bind the input in place and write into a preallocated output, avoiding copies in and out of the session
+        if x.shape not in self._outputs:
+            out = np.empty(x.shape, dtype=np.float32)
+            self._outputs[x.shape] = (out, self.ort.OrtValue.ortvalue_from_numpy(out))
+        out, out_value = self._outputs[x.shape]
+        binding = self.session.io_binding()
+        binding.bind_cpu_input(self.input_name, x)
+        binding.bind_ortvalue_output(self.output_name, out_value)
+        self.session.run_with_iobinding(binding)
+        return out.copy()
+
+    def __call__(self, x):
+        if isinstance(x, torch.Tensor):
+            x = x.detach().cpu().numpy()
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        if self.fixed_batch is None or x.shape[0] == self.fixed_batch:
+            return self._run(x)
+        assert x.shape[0] % self.fixed_batch == 0, f"Batch must be a multiple of {self.fixed_batch}"
+        return np.concatenate([self._run(x[i:i + self.fixed_batch])
+                            for i in range(0, x.shape[0], self.fixed_batch)])
+
+
+def load_checkpoint(ckpt_dir, epoch=None):
+    """
+    Pix2PixModel in eval mode with the networks of the given checkpoint (the latest one by default).
+    The Generator is built with the size of the saved weights, so distilled students load as well
+    """
+    from pix2pix_helpers.pix2pix_model import Pix2PixModel, generator_config
+    from pix2pix_helpers.catalog import CheckpointCatalog, load_weights
+    catalog = CheckpointCatalog(ckpt_dir)
+    epoch = catalog.resolve('latest' if epoch is None else epoch)
+    ngf, num_downs = generator_config(load_weights(catalog.file_path(epoch, 'net_G')))
+    model = Pix2PixModel(ckpt_dir, os.path.basename(os.path.normpath(ckpt_dir)), is_train=False,
+                        ngf=ngf, num_downs=num_downs)
+    model.load_networks(epoch)
+    model.eval()
+    return model
+
+
+def load_test_split(folder_name, paired_folders=False, limit=None):
+    """
+    Returns the real_A and real_B images of the test split as float Nx3xHxW tensors
+    """
+    from pix2pix_helpers.create_dataset import ImageFolderLoader, PairedFolderLoader
+    if paired_folders:
+        data = PairedFolderLoader(folder_name, phase='test', flip=False, preprocess='none')
+    else:
+        data = ImageFolderLoader(f'{folder_name}/AB', phase='test', flip=False, preprocess='none')
+    count = len(data) if limit is None else min(limit, len(data))
+    samples = [data[i] for i in range(count)]
+    return torch.stack([s['A'] for s in samples]), torch.stack([s['B'] for s in samples])
+
+
+def load_test_inputs(folder_name, paired_folders=False, limit=None):
+    """
+    Returns the real_A images of the test split as a float Nx3xHxW tensor
+    """
+    return load_test_split(folder_name, paired_folders, limit)[0]
+
+
+def check_parity(netG, onnx_model, inputs, batch_size=8):
+    """
+    Maximum absolute difference between netG and the ONNX model over the inputs
+    """
+    netG.eval()
+    device = next(netG.parameters()).device
+    max_error = 0.0
+    with torch.no_grad():
+        for i in range(0, len(inputs), batch_size):
+            x = inputs[i:i + batch_size]
+            expected = netG(x.to(device)).float().cpu().numpy()
+            max_error = max(max_error, float(np.abs(onnx_model(x) - expected).max()))
+    return max_error
+
+
+def time_call(fn, repeats):
+    fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def compare_latency(netG, onnx_model, batch_sizes=(1, 2, 4, 8, 16, 32), repeats=5, size=256):
+    """
+    Median time per batch and throughput of netG and the ONNX model for each batch size
+    """
+    netG.eval()
+    device = next(netG.parameters()).device
+    results = []
+    for batch_size in batch_sizes:
+        x = torch.randn(batch_size, 3, size, size)
+        x_device = x.to(device)
+        x_numpy = x.numpy()
+
+        def run_torch():
+            with torch.no_grad():
+                netG(x_device).cpu()
+
+        torch_time = time_call(run_torch, repeats)
+        onnx_time = time_call(lambda: onnx_model(x_numpy), repeats)
+        results.append({'batch_size': batch_size,
+                        'torch_ms': torch_time * 1000, 'onnx_ms': onnx_time * 1000,
+                        'torch_img_s': batch_size / torch_time, 'onnx_img_s': batch_size / onnx_time})
+    return results
+
+
+def export_main(argv=None):
+    parser = argparse.ArgumentParser(description='Export the Generator of a checkpoint to ONNX for Unity')
+    parser.add_argument('--model', required=True, help='name of the model, read from checkpoints/MODEL')
+    parser.add_argument('--epoch', default=None, help="checkpoint to export, 'latest' (default), 'best' or an epoch")
+    parser.add_argument('--out-dir', default='exported')
+    parser.add_argument('--opset', type=int, default=10)
+    parser.add_argument('--dynamic-batch', action='store_true', help='not supported by Barracuda')
+    parser.add_argument('--fuse', action='store_true', help='fold the BatchNorms into the convolutions first')
+    args = parser.parse_args(argv)
+
+    model = load_checkpoint(os.path.join('checkpoints', args.model), args.epoch)
+    netG = model.netG
+    if args.fuse:
+        from pix2pix_helpers.fuse import fuse_generator
+        netG = fuse_generator(netG)
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+    path = export_onnx(netG, os.path.join(args.out_dir, f'{args.model}.onnx'), args.opset, args.dynamic_batch)
+    print(f'Generator exported to {os.path.abspath(path)}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check an exported Generator against its checkpoint')
+    parser.add_argument('--onnx', required=True, help='exported .onnx file')
+    parser.add_argument('--ckpt-dir', required=True, help='checkpoint folder of the model')
+    parser.add_argument('--epoch', default=None, help='checkpoint to compare with (latest by default)')
+    parser.add_argument('--folder', default=None, help='data folder, the test split is used for the parity check')
+    parser.add_argument('--paired-folders', action='store_true')
+    parser.add_argument('--test-limit', type=int, default=None)
+    parser.add_argument('--intra-threads', type=int, default=None)
+    parser.add_argument('--inter-threads', type=int, default=None)
+    parser.add_argument('--no-io-binding', action='store_true')
+    parser.add_argument('--batch-sizes', default='1,2,4,8,16,32')
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    if args.intra_threads is not None:
+        torch.set_num_threads(args.intra_threads)
+    model = load_checkpoint(args.ckpt_dir, args.epoch)
+
+    onnx_model = OnnxGenerator(args.onnx, args.intra_threads, args.inter_threads,
+                                io_binding=not args.no_io_binding)
+
+    if args.folder is not None:
+        inputs = load_test_inputs(args.folder, args.paired_folders, args.test_limit)
+        error = check_parity(model.netG, onnx_model, inputs)
+        print(f'Parity on {len(inputs)} test images: max abs error {error:.2e}')
+
+    batch_sizes = [int(b) for b in args.batch_sizes.split(',')]
+    if onnx_model.fixed_batch is not None:
+        print(f'Model was exported with a fixed batch of {onnx_model.fixed_batch}, larger batches run in chunks')
+    print('batch | torch ms | onnx ms | torch img/s | onnx img/s')
+    for r in compare_latency(model.netG, onnx_model, batch_sizes, args.repeats):
+        print(f"{r['batch_size']:5d} | {r['torch_ms']:8.1f} | {r['onnx_ms']:7.1f} | {r['torch_img_s']:11.1f} | {r['onnx_img_s']:10.1f}")
+
+
+if __name__ == '__main__':
+    main()
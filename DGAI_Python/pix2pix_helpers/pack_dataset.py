@@ -0,0 +1,100 @@
+import os
+import json
+import numpy as np
+from tqdm import tqdm
+from PIL import Image
+from pix2pix_helpers.image_files import make_dataset
+
+##
+# Packs the train / test folders of an AB dataset into a single contiguous
+# uint8 shard per phase, plus a json index describing where each image lives.
+# The shard is memory-mapped by the loader, so images are never decoded again
+# and every DataLoader worker shares the same page-cached copy.
+##
+
+SHARD_SUFFIX = '.shard'
+INDEX_SUFFIX = '.index.json'
+
+
+def shard_paths(root, phase):
+    """
+    Returns the shard and index paths for a phase of the dataset in root
+    """
+    shard_path = os.path.join(root, phase + SHARD_SUFFIX)
+    index_path = os.path.join(root, phase + INDEX_SUFFIX)
+    return shard_path, index_path
+
+
+def pack_dataset(root, phases=('train', 'test')):
+    """
+    Decode every image of the given phases once and write them into a contiguous uint8 shard.
+    The shard and its index are written next to the phase folders, e.g. AB/train.shard and AB/train.index.json
+    """
+    for phase in phases:
+        phase_dir = os.path.join(root, phase)
+        if not os.path.isdir(phase_dir):
+            print(f"Folder {phase_dir} does not exist, skipping")
+            continue
+
+        img_paths = sorted(make_dataset(phase_dir))
+        shard_path, index_path = shard_paths(root, phase)
+        samples = []
+        offset = 0
+
+        print(f"Packing {len(img_paths)} images from {phase_dir} into {shard_path}")
+        # Write to temporary files first, so a crash never leaves a half-written shard behind
+        with open(shard_path + '.tmp', 'wb') as f:
+            for img_path in tqdm(img_paths):
+                img = np.asarray(Image.open(img_path).convert('RGB'), dtype=np.uint8)
+                h, w, _ = img.shape
+                f.write(np.ascontiguousarray(img).tobytes())
+                samples.append({'path': os.path.relpath(img_path, root),
+                                'offset': offset, 'height': h, 'width': w})
+                offset += img.nbytes
+
+        index = {'dtype': 'uint8', 'channels': 3, 'size': offset, 'samples': samples}
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(index, f)
+
+        os.replace(shard_path + '.tmp', shard_path)
+        os.replace(index_path + '.tmp', index_path)
+
+
+class PackedShard():
+    """
+    Read-only view over a packed phase. Items are HxWx3 uint8 numpy views into the memory-mapped shard.
+    The memory map is opened lazily, so pickling the shard into DataLoader workers only copies the index
+    """
+    def __init__(self, root, phase='train'):
+        self.root = root
+        self.shard_path, self.index_path = shard_paths(root, phase)
+        assert os.path.isfile(self.shard_path) and os.path.isfile(self.index_path), \
+            f"Packed shard for '{phase}' not found in {root}. Run pack_dataset first"
+
+        with open(self.index_path) as f:
+            index = json.load(f)
+        self.channels = index['channels']
+        self.samples = index['samples']
+        self.paths = [os.path.join(root, s['path']) for s in self.samples]
+        self._data = None
+
+    def _open(self):
+        # Copy-on-write mapping, pages stay shared with the page cache as long as nobody writes to them
+        if self._data is None:
+            self._data = np.memmap(self.shard_path, dtype=np.uint8, mode='c')
+        return self._data
+
+    def __getitem__(self, index):
+        sample = self.samples[index]
+        h, w = sample['height'], sample['width']
+        start = sample['offset']
+        end = start + h * w * self.channels
+        return self._open()[start:end].reshape(h, w, self.channels)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
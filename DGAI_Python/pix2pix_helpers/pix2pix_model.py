@@ -6,17 +6,28 @@ import torch.optim as optim
 import os
 import torch.onnx
 import functools
+import inspect
+from contextlib import nullcontext, contextmanager
+import torch.utils.checkpoint
+from pix2pix_helpers.distributed import convert_sync_batchnorm, is_main_process
+from pix2pix_helpers.checkpoint import (snapshot, save_checkpoint, load_state,
+                                        get_rng_state, set_rng_state)
+from pix2pix_helpers.catalog import CheckpointCatalog, load_weights, load_generator
 
 
 # Pix2Pix model class [256 based]
 class Pix2PixModel():
     def __init__(self, ckpt_dir, model_name,
                 is_train=True, n_epochs=100, 
-                n_epochs_decay=100):
+                n_epochs_decay=100, amp=False, distributed=False,
+                checkpoint_depth=0, ngf=64, num_downs=8, teacher_dir=None, teacher_epoch='latest',
+                lambda_distill=100.0, lambda_feat=10.0):
         super(Pix2PixModel, self).__init__()
         self.isTrain = is_train
         # self.training = self.isTrain
         self.save_dir = ckpt_dir
+        # Index of the saved checkpoints, with their digests and metrics
+        self.catalog = CheckpointCatalog(ckpt_dir)
         self.loss_names = ['G_GAN', 'G_L1', 'D_real', 'D_fake']
         self.visual_names = ['real_A', 'fake_B', 'real_B']
         if self.isTrain:
@@ -30,10 +41,26 @@ class Pix2PixModel():
         
         self.device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 
+        # Data-parallel training, one process per device, the process group must be set up by setup_distributed
+        self.distributed = distributed
+        if self.distributed and torch.cuda.is_available():
+            self.device = torch.device('cuda', torch.cuda.current_device())
+
+        # Mixed precision: bfloat16 autocast on CPU, float16 with gradient scaling on CUDA
+        # Weights and optimizer states stay in float32, so checkpoints are unaffected
+        self.amp = amp
+        self.amp_dtype = torch.float16 if self.device.type == 'cuda' else torch.bfloat16
+        self.scaler = make_grad_scaler(amp and self.device.type == 'cuda')
+
+        # Optional PhaseProfiler timing the phases of the training step, see set_profiler
+        self.profiler = None
+
         norm_layer = functools.partial(nn.BatchNorm2d, affine=True, track_running_stats=True)
-        # Define the Generator
-        self.netG = Generator(3, 3, 8, ngf=64, norm_layer=norm_layer, use_dropout=False)
+        # Define the Generator, smaller ngf / num_downs give a faster Generator (see distill.py)
+        self.netG = Generator(3, 3, num_downs, ngf=ngf, norm_layer=norm_layer, use_dropout=False)
         self.netG = init_net(self.netG)
+        # Activation checkpointing of the checkpoint_depth outer levels of the U-Net, trading compute for memory
+        self.netG.set_checkpoint_depth(checkpoint_depth)
 
         # Define the Discriminator if training
         if self.isTrain:
@@ -41,6 +68,23 @@ class Pix2PixModel():
             #self.netD = Discriminator(6, ndf=64, n_layers=3, norm_layer=norm_layer)
             self.netD = Discriminator(6)
             self.netD = init_net(self.netD)
+
+        # Distillation: the Generator learns from the outputs of a trained teacher Generator as well,
+        # L1 to the teacher output and matching of the Discriminator features of the teacher output
+        self.netT = None
+        if self.isTrain and teacher_dir is not None:
+            self.netT, epoch = load_generator(teacher_dir, teacher_epoch, mmap=False, device=self.device)
+            self.set_requires_grad(self.netT, False)
+            self.lambda_distill = lambda_distill
+            self.lambda_feat = lambda_feat
+            self.loss_names += ['G_KD', 'G_feat']
+            if is_main_process():
+                print('Distilling from the teacher %s, epoch %s' % (teacher_dir, epoch))
+
+        if self.distributed:
+            self.netG = self.wrap_distributed(self.netG)
+            if self.isTrain:
+                self.netD = self.wrap_distributed(self.netD)
         
         if self.isTrain:
             self.criterionGAN = GANLoss().to(self.device)
@@ -50,39 +94,92 @@ class Pix2PixModel():
             self.optimizers.append(self.optimizer_G)
             self.optimizers.append(self.optimizer_D)
         
+    def wrap_distributed(self, net):
+        """
+        Synchronizes the BatchNorm layers and wraps the network in DistributedDataParallel.
+        Parameters are broadcast from rank 0, buffers stay in sync through the synchronized norms
+        """
+        net = convert_sync_batchnorm(net.to(self.device))
+        device_ids = [self.device.index] if self.device.type == 'cuda' else None
+        return nn.parallel.DistributedDataParallel(net, device_ids=device_ids, broadcast_buffers=False)
+
+    def get_network(self, name):
+        """
+        Returns the network without its DataParallel / DistributedDataParallel wrapper
+        """
+        net = getattr(self, 'net' + name)
+        if isinstance(net, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+            net = net.module
+        return net
+
+    def set_profiler(self, profiler):
+        self.profiler = profiler
+
+    def phase(self, name):
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.phase(name)
+
     def set_input(self, input, single=False):
-        if single:
-            self.real_A = input.to(self.device)
-            self.real_B = input.to(self.device)
-        else:
-            self.real_A = input['A'].to(self.device)
-            self.real_B = input['B'].to(self.device)
-            self.image_paths = input['A_paths']
+        with self.phase('set_input'):
+            # Nothing to copy when DataPipeline already moved the batch, asynchronous from pinned memory otherwise
+            if single:
+                self.real_A = input.to(self.device, non_blocking=True)
+                self.real_B = input.to(self.device, non_blocking=True)
+            else:
+                self.real_A = input['A'].to(self.device, non_blocking=True)
+                self.real_B = input['B'].to(self.device, non_blocking=True)
+                self.image_paths = input['A_paths']
         
+    def autocast(self):
+        return torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.amp)
+
     def forward(self):
-        self.fake_B = self.netG(self.real_A)
+        with self.autocast():
+            self.fake_B = self.netG(self.real_A)
+            if self.netT is not None and self.isTrain:
+                with torch.no_grad():
+                    self.teacher_B = self.netT(self.real_A)
     
     def backward_D(self):
-        fake_AB = torch.cat((self.real_A, self.fake_B), 1)
-        pred_fake = self.netD(fake_AB.detach())
-        self.loss_D_fake = self.criterionGAN(pred_fake, False)
-        
-        real_AB = torch.cat((self.real_A, self.real_B), 1)
-        pred_real = self.netD(real_AB)
-        self.loss_D_real = self.criterionGAN(pred_real, True)
+        with self.autocast():
+            fake_AB = torch.cat((self.real_A, self.fake_B), 1)
+            pred_fake = self.netD(fake_AB.detach())
+            self.loss_D_fake = self.criterionGAN(pred_fake, False)
+            
+            real_AB = torch.cat((self.real_A, self.real_B), 1)
+            pred_real = self.netD(real_AB)
+            self.loss_D_real = self.criterionGAN(pred_real, True)
 
-        self.loss_D = (self.loss_D_fake + self.loss_D_real) * 0.5
-        self.loss_D.backward()
+            self.loss_D = (self.loss_D_fake + self.loss_D_real) * 0.5
+        self.scaler.scale(self.loss_D).backward()
     
     def backward_G(self):
-        fake_AB = torch.cat((self.real_A, self.fake_B), 1)
-        pred_fake = self.netD(fake_AB)
-        self.loss_G_GAN = self.criterionGAN(pred_fake, True)
-
-        self.loss_G_L1 = self.criterionL1(self.fake_B, self.real_B) * 100.0
-
-        self.loss_G = self.loss_G_GAN + self.loss_G_L1
-        self.loss_G.backward()
+        with self.autocast():
+            fake_AB = torch.cat((self.real_A, self.fake_B), 1)
+            # D is not updated here, so it runs without the DDP wrapper and its gradients are not synchronized
+            netD = self.get_network('D')
+            if self.netT is not None:
+                features_fake, pred_fake = netD.forward_features(fake_AB)
+            else:
+                pred_fake = netD(fake_AB)
+            self.loss_G_GAN = self.criterionGAN(pred_fake, True)
+
+            # The L1 loss is always computed in float32
+            self.loss_G_L1 = self.criterionL1(self.fake_B.float(), self.real_B) * 100.0
+
+            self.loss_G = self.loss_G_GAN + self.loss_G_L1
+
+            if self.netT is not None:
+                self.loss_G_KD = self.criterionL1(self.fake_B.float(), self.teacher_B.float()) * self.lambda_distill
+                # Features of the teacher pair are targets only, and must not move the running statistics of D
+                with torch.no_grad(), frozen_batchnorm(netD):
+                    features_teacher, _ = netD.forward_features(torch.cat((self.real_A, self.teacher_B), 1))
+                self.loss_G_feat = sum(self.criterionL1(fake.float(), teacher.float())
+                                    for fake, teacher in zip(features_fake, features_teacher))
+                self.loss_G_feat = self.loss_G_feat / len(features_fake) * self.lambda_feat
+                self.loss_G = self.loss_G + self.loss_G_KD + self.loss_G_feat
+        self.scaler.scale(self.loss_G).backward()
     
     def set_requires_grad(self, nets, requires_grad=False):
         if not isinstance(nets, list):
@@ -93,17 +190,23 @@ class Pix2PixModel():
                     param.requires_grad = requires_grad
 
     def optimize_parameters(self):
-        self.forward()
+        with self.phase('forward'):
+            self.forward()
 
         self.set_requires_grad(self.netD, True)
         self.optimizer_D.zero_grad()
-        self.backward_D()
-        self.optimizer_D.step()
+        with self.phase('backward_D'):
+            self.backward_D()
+        with self.phase('optimizer_D'):
+            self.scaler.step(self.optimizer_D)
 
         self.set_requires_grad(self.netD, False)
         self.optimizer_G.zero_grad()
-        self.backward_G()
-        self.optimizer_G.step()
+        with self.phase('backward_G'):
+            self.backward_G()
+        with self.phase('optimizer_G'):
+            self.scaler.step(self.optimizer_G)
+            self.scaler.update()
     
     def get_scheduler(self, optimizer):
         def lambda_rule(epoch):
@@ -139,7 +242,8 @@ class Pix2PixModel():
         visual_ret = OrderedDict()
         for name in self.visual_names:
             if isinstance(name, str):
-                visual_ret[name] = getattr(self, name)
+                # Outputs produced under autocast are returned as float32
+                visual_ret[name] = getattr(self, name).float()
         return visual_ret
 
     def get_current_losses(self):
@@ -149,15 +253,57 @@ class Pix2PixModel():
                 errors_ret[name] = float(getattr(self, 'loss_' + name))
         return errors_ret
 
-    def save_network(self, epoch):
+    def save_network(self, epoch, writer=None):
+        """
+        Saves the weights of the networks. They are copied to the CPU without moving the networks,
+        with a CheckpointWriter the files are written in the background
+        """
+        # Every process holds the same weights, only rank 0 writes them
+        if not is_main_process():
+            return
         for name in self.model_names:
             if isinstance(name, str):
                 save_filename = '%s_net_%s.pth' % (epoch, name)
                 save_path = os.path.join(self.save_dir, save_filename)
-                net = getattr(self, 'net' + name)
-
-                torch.save(net.cpu().state_dict(), save_path)
-                net.to(self.device)
+                net = self.get_network(name)
+
+                save_checkpoint(snapshot(net.state_dict()), save_path, writer, self.catalog)
+
+    def get_training_state(self, epoch, total_iters):
+        """
+        Everything needed to continue training after the given epoch: networks, optimizers,
+        schedulers, gradient scaler and random number generators
+        """
+        state = {'epoch': epoch, 'total_iters': total_iters,
+                'optimizers': [optimizer.state_dict() for optimizer in self.optimizers],
+                'schedulers': [scheduler.state_dict() for scheduler in self.schedulers],
+                'scaler': self.scaler.state_dict(), 'rng': get_rng_state()}
+        for name in self.model_names:
+            state['net_' + name] = self.get_network(name).state_dict()
+        return snapshot(state)
+
+    def save_training_state(self, epoch, total_iters, writer=None):
+        if not is_main_process():
+            return
+        save_path = os.path.join(self.save_dir, '%s_state.pth' % epoch)
+        save_checkpoint(self.get_training_state(epoch, total_iters), save_path, writer, self.catalog)
+
+    def load_training_state(self, path):
+        """
+        Restores a state saved by save_training_state, call after setup().
+        Returns the epoch the state was saved at and the total iterations so far
+        """
+        print('Resuming training from %s' % path)
+        state = load_state(path)
+        for name in self.model_names:
+            self.get_network(name).load_state_dict(state['net_' + name])
+        for optimizer, optimizer_state in zip(self.optimizers, state['optimizers']):
+            optimizer.load_state_dict(optimizer_state)
+        for scheduler, scheduler_state in zip(self.schedulers, state['schedulers']):
+            scheduler.load_state_dict(scheduler_state)
+        self.scaler.load_state_dict(state['scaler'])
+        set_rng_state(state['rng'])
+        return state['epoch'], state['total_iters']
     
     def __patch_instance_norm_state_dict(self, state_dict, module, keys, i=0):
         key = keys[i]
@@ -174,24 +320,30 @@ class Pix2PixModel():
             self.__patch_instance_norm_state_dict(state_dict, getattr(module, key), keys, i + 1)
 
     def load_networks(self, epoch):
+        """
+        Loads the networks of the epoch. Also takes 'latest', -1 or 'best' (lowest G_L1), looked up in the catalog.
+        Returns the epoch that was loaded
+        """
+        epoch = self.catalog.resolve(epoch)
         for name in self.model_names:
             if isinstance(name, str):
-                load_filename = '%s_net_%s.pth' % (epoch, name)
-                load_path = os.path.join(self.save_dir, load_filename)
-                net = getattr(self, 'net' + name)
-                if isinstance(net, nn.DataParallel):
-                    net = net.module
+                load_path = self.catalog.file_path(epoch, 'net_' + name)
+                net = self.get_network(name)
                 print('Loading the model from %s' % load_path)
 
-                state_dict = torch.load(load_path, map_location=str(self.device))
+                # Memory-mapped where supported, load_state_dict copies the weights to the device
+                state_dict = load_weights(load_path)
                 if hasattr(state_dict, '_metadata'):
                     del state_dict._metadata
                 
                 for key in list(state_dict.keys()):
                     self.__patch_instance_norm_state_dict(state_dict, net, key.split('.'))
                 net.load_state_dict(state_dict)
+        return epoch
 
     def print_networks(self):
+        if not is_main_process():
+            return
         print('---------- Networks initialized -------------')
         for name in self.model_names:
             if isinstance(name, str):
@@ -256,13 +408,37 @@ class UnetBlock(nn.Module):
                 model = down + [submodule] + up
         
         self.model = nn.Sequential(*model)
+        # Recompute this level during backward instead of keeping its activations, see Generator.set_checkpoint_depth
+        self.checkpoint = False
     
     def forward(self, x):
         if self.outermost:
             return self.model(x)
+        elif self.checkpoint and self.training and torch.is_grad_enabled():
+            return self.checkpointed_forward(x)
         else:
             return torch.cat([x, self.model(x)], 1)
 
+    def checkpointed_forward(self, x):
+        """
+        Same result as forward, but only the input of the level is kept for backward
+        """
+        # The leading LeakyReLU is in-place. Run inside the checkpoint it would be applied again to its
+        # own output when the level is recomputed, so it runs outside and only the rest is checkpointed
+        x = self.model[0](x)
+        # Only the number of calls, keeping their inputs would hold the activations checkpointing frees
+        calls = 0
+
+        def run(x):
+            nonlocal calls
+            calls += 1
+            # The first call is the forward pass, a second one is the recomputation during backward.
+            # BatchNorm must not update its running statistics twice for the same batch
+            with frozen_batchnorm(self) if calls > 1 else nullcontext():
+                return torch.cat([x, self.model[1:](x)], 1)
+
+        return checkpoint(run, x)
+
 class Generator(nn.Module):
     def __init__(self, input_nc, output_nc, num_downs, ngf=64,
                 norm_layer=nn.BatchNorm2d, use_dropout=False):
@@ -290,9 +466,45 @@ class Generator(nn.Module):
                                 outermost=True, norm_layer=norm_layer)
         
 
+        self.checkpoint_depth = 0
+
+    def unet_levels(self):
+        """
+        The UnetBlocks below the outermost one, from the highest resolution to the innermost
+        """
+        levels = []
+        block = self.model
+        while True:
+            inner = [m for m in block.model if isinstance(m, UnetBlock)]
+            if len(inner) == 0:
+                return levels
+            block = inner[0]
+            levels.append(block)
+
+    def set_checkpoint_depth(self, depth):
+        """
+        Activation checkpointing of the depth highest resolution levels (they hold the largest activations),
+        -1 for all levels and 0 to turn it off. Saves memory in training at the cost of recomputing the
+        checkpointed levels during backward. Only attributes change, the state dict stays the same
+        """
+        levels = self.unet_levels()
+        if depth < 0:
+            depth = len(levels)
+        for i, level in enumerate(levels):
+            level.checkpoint = i < depth
+        self.checkpoint_depth = min(depth, len(levels))
+
     def forward(self, input):
         return self.model(input)
 
+def generator_config(state_dict):
+    """
+    ngf and num_downs of the Generator that saved state_dict. Every level has one Conv2d and one
+    ConvTranspose2d, the only 4-dimensional weights, and the first Conv2d has ngf output channels
+    """
+    convolutions = [key for key, value in state_dict.items() if key.endswith('weight') and value.dim() == 4]
+    return state_dict['model.model.0.weight'].shape[0], len(convolutions) // 2
+
 class Discriminator(nn.Module):
     def __init__(self, input_nc, ndf=64, n_layers=3, norm_layer=nn.BatchNorm2d):
         super(Discriminator, self).__init__()
@@ -334,6 +546,18 @@ class Discriminator(nn.Module):
     def forward(self, input):
         return self.model(input)
 
+    def forward_features(self, input):
+        """
+        Returns the activations after every LeakyReLU, used for feature matching, and the output
+        """
+        features = []
+        x = input
+        for layer in self.model:
+            x = layer(x)
+            if isinstance(layer, nn.LeakyReLU):
+                features.append(x)
+        return features, x
+
 class GANLoss(nn.Module):
     def __init__(self, target_real_label=1.0, target_fake_label=0.0):
         super(GANLoss, self).__init__()
@@ -351,11 +575,46 @@ class GANLoss(nn.Module):
         return target_tensor.expand_as(prediction)
     
     def __call__(self, prediction, target_is_real):
+        # BCE with logits is evaluated in float32, also when the prediction comes from autocast
+        prediction = prediction.float()
         target_tensor = self.get_target_tensor(prediction, target_is_real)
         loss = self.loss(prediction, target_tensor)
 
         return loss
 
+@contextmanager
+def frozen_batchnorm(module):
+    """
+    BatchNorm layers of module use the batch statistics as usual but leave their running statistics untouched
+    """
+    norms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    saved = [(m.momentum, m.num_batches_tracked.clone()) for m in norms]
+    try:
+        for m in norms:
+            # running = (1 - momentum) * running + momentum * batch
+            m.momentum = 0.0
+        yield
+    finally:
+        for m, (momentum, num_batches_tracked) in zip(norms, saved):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(num_batches_tracked)
+
+def checkpoint(function, *args):
+    """
+    torch.utils.checkpoint, non-reentrant where available (PyTorch 1.11 or newer, also works with DDP)
+    """
+    if 'use_reentrant' in inspect.signature(torch.utils.checkpoint.checkpoint).parameters:
+        return torch.utils.checkpoint.checkpoint(function, *args, use_reentrant=False)
+    return torch.utils.checkpoint.checkpoint(function, *args)
+
+def make_grad_scaler(enabled):
+    """
+    Gradient scaler for float16 training on CUDA. When disabled, scale() and step() fall back to the plain calls
+    """
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda', enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
 def init_net(net):
         device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
         net.to(device)
@@ -0,0 +1,70 @@
+import os
+import argparse
+from pix2pix_helpers.resize_image import scale_down, scale_up
+from pix2pix_helpers.fix_names import fix_names
+from pix2pix_helpers.combine_images import combine_images
+from pix2pix_helpers.create_train_test import create_train_test
+from pix2pix_helpers.pack_dataset import pack_dataset
+
+##
+# The steps of prepare-files.ipynb as a script. Only PIL and numpy are needed, torch is never imported,
+# so many of these jobs can be launched cheaply. Steps run in the notebook order, only the ones asked for:
+#   python -m pix2pix_helpers prepare --folder data/tracos --combine --split 10
+# The folder holds the A and B images, combined into AB and split into AB/train and AB/test.
+##
+
+def prepare(folder, resize_factor=None, resize_workers=None, resize_fast=False, fix_target=None,
+            combine=False, combine_workers=None, incremental=False, test_count=None, seed=0, pack=False):
+    """
+    Runs the selected preparation steps on folder. resize_factor > 0 scales up, < 0 scales down
+    """
+    folder = os.path.realpath(folder)
+    folder_AB = os.path.join(folder, 'AB')
+
+    if resize_factor is not None:
+        if resize_factor > 0:
+            scale_up(folder, resize_factor, workers=resize_workers)
+        else:
+            scale_down(folder, -resize_factor, workers=resize_workers, fast=resize_fast)
+
+    if fix_target is not None:
+        fix_names(folder, fix_target)
+
+    if combine:
+        combine_images(os.path.join(folder, 'A'), os.path.join(folder, 'B'), folder_AB,
+                    workers=combine_workers, incremental=incremental)
+
+    if test_count is not None:
+        create_train_test(folder_AB, test_count, seed=seed)
+
+    if pack:
+        pack_dataset(folder_AB)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Prepare a pix2pix dataset (the steps of prepare-files.ipynb)')
+    parser.add_argument('--folder', required=True, help='main folder of the dataset')
+    parser.add_argument('--resize', type=float, default=None,
+                        help='scale the images in the folder up by this factor, or down when negative')
+    parser.add_argument('--resize-workers', type=int, default=None, help='processes, all cores by default')
+    parser.add_argument('--resize-fast', action='store_true', help='reduced JPEG decoding when scaling down photos')
+    parser.add_argument('--fix-names', default=None, metavar='TARGET',
+                        help="replace TARGET in the file names with the name of their folder")
+    parser.add_argument('--combine', action='store_true', help='combine A and B into AB')
+    parser.add_argument('--combine-workers', type=int, default=None, help='processes, all cores by default')
+    parser.add_argument('--incremental', action='store_true', help='combine only new or modified pairs')
+    parser.add_argument('--split', type=int, default=None, metavar='TEST_COUNT',
+                        help='move AB into train and test, with TEST_COUNT test images')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the train / test split')
+    parser.add_argument('--pack', action='store_true', help='pack AB/train and AB/test into shards')
+    args = parser.parse_args(argv)
+
+    resize_factor = args.resize
+    if resize_factor is not None and resize_factor == int(resize_factor):
+        resize_factor = int(resize_factor)
+    prepare(args.folder, resize_factor, args.resize_workers, args.resize_fast, args.fix_names,
+            args.combine, args.combine_workers, args.incremental, args.split, args.seed, args.pack)
+
+
+if __name__ == '__main__':
+    main()
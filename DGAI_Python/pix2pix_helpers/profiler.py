@@ -0,0 +1,184 @@
+import os
+import json
+import time
+from contextlib import contextmanager
+import numpy as np
+import torch
+
+##
+# Per-phase timing of the training step. Pix2PixModel reports its phases (forward, backward_D,
+# backward_G and the optimizer steps) to the profiler set with model.set_profiler,
+# profiler.iterate(loader) times the wait for every batch of the data loader and
+# profiler.step() closes every step.
+# Optionally, a torch.profiler trace of a few steps is written for the TensorBoard profiler plugin.
+##
+
+def current_rss_mb():
+    """
+    Current resident memory of this process in MB, None where it can not be measured
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 2 ** 20
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def summarize(values):
+    values = np.array(values)
+    return {'count': len(values), 'mean': float(values.mean()), 'p50': float(np.percentile(values, 50)),
+            'p90': float(np.percentile(values, 90)), 'p99': float(np.percentile(values, 99)),
+            'max': float(values.max()), 'total': float(values.sum())}
+
+
+class PhaseProfiler():
+    """
+    Records the wall time of every phase of the training step, plus RSS and (on CUDA) allocator memory after
+    each step. trace_dir enables a torch.profiler trace that skips trace_start steps and records trace_steps
+    """
+    def __init__(self, enabled=True, track_memory=True, trace_dir=None, trace_start=10, trace_steps=3):
+        self.enabled = enabled
+        self.track_memory = track_memory
+        self.cuda = torch.cuda.is_available()
+        self.trace_dir = trace_dir
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self._trace = None
+        self.step_count = 0
+        self.reset()
+
+    def reset(self):
+        """
+        Clears the recorded times, e.g. at the start of every epoch
+        """
+        self.times = {}
+        self.memory = {}
+        self._step_start = None
+
+    def start(self):
+        if not self.enabled or self.trace_dir is None or self._trace is not None:
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.cuda:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._trace = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=max(self.trace_start - 1, 0), warmup=1,
+                                            active=self.trace_steps, repeat=1),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(self.trace_dir),
+            record_shapes=True, profile_memory=True)
+        self._trace.__enter__()
+
+    def stop(self):
+        if self._trace is not None:
+            self._trace.__exit__(None, None, None)
+            self._trace = None
+
+    def _sync(self):
+        # CUDA kernels run asynchronously, wait for them so the time lands in the right phase
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    def add_time(self, name, seconds):
+        self.times.setdefault(name, []).append(seconds)
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        if self._step_start is None:
+            self._step_start = time.perf_counter()
+        self._sync()
+        start = time.perf_counter()
+        if self._trace is not None:
+            with torch.profiler.record_function(name):
+                yield
+        else:
+            yield
+        self._sync()
+        self.add_time(name, time.perf_counter() - start)
+
+    def iterate(self, loader):
+        """
+        Iterates over the loader, timing the wait for every batch as the 'data' phase
+        """
+        iterator = iter(loader)
+        while True:
+            start = time.perf_counter()
+            try:
+                data = next(iterator)
+            except StopIteration:
+                return
+            if self.enabled:
+                self.add_time('data', time.perf_counter() - start)
+            yield data
+
+    def step(self):
+        """
+        Marks the end of a training step
+        """
+        if not self.enabled:
+            return
+        if self._step_start is not None:
+            self.add_time('step', time.perf_counter() - self._step_start)
+            self._step_start = None
+        if self.track_memory:
+            rss = current_rss_mb()
+            if rss is not None:
+                self.memory.setdefault('rss_mb', []).append(rss)
+            if self.cuda:
+                self.memory.setdefault('allocated_mb', []).append(torch.cuda.memory_allocated() / 2 ** 20)
+                self.memory.setdefault('peak_allocated_mb', []).append(torch.cuda.max_memory_allocated() / 2 ** 20)
+        self.step_count += 1
+        if self._trace is not None:
+            self._trace.step()
+
+    def last(self, name):
+        """
+        Last recorded time of a phase in seconds, 0 if it was never recorded
+        """
+        values = self.times.get(name)
+        return values[-1] if values else 0.0
+
+    def summary(self):
+        """
+        Percentiles in ms for every phase, with its share of the step time, and memory percentiles in MB
+        """
+        result = {'steps': self.step_count, 'phases': {}, 'memory': {}}
+        step_total = sum(self.times.get('step', [])) + sum(self.times.get('data', []))
+        for name, values in self.times.items():
+            stats = summarize(np.array(values) * 1000)
+            if name != 'step' and step_total > 0:
+                stats['share'] = stats['total'] / 1000 / step_total
+            result['phases'][name] = stats
+        for name, values in self.memory.items():
+            result['memory'][name] = summarize(values)
+        return result
+
+    def log_tensorboard(self, writer, step):
+        summary = self.summary()
+        for name, stats in summary['phases'].items():
+            writer.add_scalar(f'profile/{name}_ms', stats['mean'], step)
+            writer.add_scalar(f'profile/{name}_p90_ms', stats['p90'], step)
+        for name, stats in summary['memory'].items():
+            writer.add_scalar(f'profile/{name}', stats['max'], step)
+
+    def save_json(self, path, **extra):
+        summary = self.summary()
+        summary.update(extra)
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=1)
+
+    def print_summary(self):
+        summary = self.summary()
+        for name, stats in summary['phases'].items():
+            share = f"{stats['share']:6.1%}" if 'share' in stats else '      '
+            print(f"{name:12s} mean {stats['mean']:8.1f} ms | p50 {stats['p50']:8.1f} | p90 {stats['p90']:8.1f} | p99 {stats['p99']:8.1f} | {share}")
+        for name, stats in summary['memory'].items():
+            print(f"{name:12s} max {stats['max']:9.1f} MB")
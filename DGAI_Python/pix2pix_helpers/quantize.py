@@ -0,0 +1,187 @@
+import os
+import io
+import copy
+import argparse
+import torch
+import torch.nn as nn
+from pix2pix_helpers.onnx_backend import (export_onnx, OnnxGenerator, load_checkpoint,
+                                        load_test_split, time_call)
+
+##
+# Static INT8 post-training quantization of the Generator, calibrated on images of the test split.
+# The PyTorch version uses FX graph mode quantization (BatchNorm is folded into the convolutions),
+# the ONNX version uses the onnxruntime static quantizer on a fp32 export.
+#   python -m pix2pix_helpers.quantize --ckpt-dir checkpoints/tracos_run_1 --folder data/tracos --onnx
+##
+
+try:
+    import torch.ao.quantization as quantization
+    from torch.ao.quantization import quantize_fx
+except ImportError:
+    import torch.quantization as quantization
+    from torch.quantization import quantize_fx
+
+
+def default_backend():
+    engines = torch.backends.quantized.supported_engines
+    return 'x86' if 'x86' in engines else 'fbgemm'
+
+
+def quantize_generator(netG, calibration, backend=None, batch_size=8):
+    """
+    Returns a static INT8 copy of netG, with activation ranges observed on the calibration images.
+    netG itself is not modified
+    """
+    if backend is None:
+        backend = default_backend()
+    torch.backends.quantized.engine = backend
+
+    model = copy.deepcopy(netG).cpu().eval()
+    example = calibration[:1]
+    if hasattr(quantization, 'get_default_qconfig_mapping'):
+        qconfig = quantization.get_default_qconfig_mapping(backend)
+        prepared = quantize_fx.prepare_fx(model, qconfig, example_inputs=(example,))
+    else:
+        # Older versions take a qconfig dict, ConvTranspose2d only supports per-tensor weights there
+        qconfig = quantization.get_default_qconfig(backend)
+        transpose = quantization.QConfig(activation=qconfig.activation,
+                                        weight=quantization.default_weight_observer)
+        prepared = quantize_fx.prepare_fx(model, {'': qconfig,
+                                                'object_type': [(nn.ConvTranspose2d, transpose)]})
+
+    with torch.no_grad():
+        for i in range(0, len(calibration), batch_size):
+            prepared(calibration[i:i + batch_size])
+    return quantize_fx.convert_fx(prepared)
+
+
+class CalibrationReader():
+    """
+    onnxruntime calibration data reader feeding the calibration images one at a time
+    """
+    def __init__(self, input_name, calibration):
+        self.input_name = input_name
+        self.calibration = calibration.numpy()
+        self.index = 0
+
+    def get_next(self):
+        if self.index >= len(self.calibration):
+            return None
+        x = self.calibration[self.index:self.index + 1]
+        self.index += 1
+        return {self.input_name: x}
+
+    def rewind(self):
+        self.index = 0
+
+
+def quantize_onnx(netG, path, calibration, opset=13):
+    """
+    Exports netG to ONNX and writes a static INT8 (QDQ) version of it to path.
+    Per-channel QDQ needs opset 13, so this export is separate from the opset 10 one used by Unity
+    """
+    from onnxruntime.quantization import quantize_static, QuantFormat, QuantType
+
+    fp32_path = os.path.splitext(path)[0] + '_fp32.onnx'
+    export_onnx(netG.cpu().eval(), fp32_path, opset=opset, dynamic_batch=True)
+    quantize_static(fp32_path, path, CalibrationReader('input', calibration),
+                    quant_format=QuantFormat.QDQ, per_channel=True,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    return fp32_path
+
+
+def model_size(model):
+    """
+    Size in bytes of the serialized state dict
+    """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def mean_l1(run, inputs, targets, batch_size=8):
+    total = 0.0
+    for i in range(0, len(inputs), batch_size):
+        output = torch.as_tensor(run(inputs[i:i + batch_size])).float()
+        total += (output - targets[i:i + batch_size]).abs().sum().item()
+    return total / targets.numel()
+
+
+def torch_runner(model):
+    def run(x):
+        with torch.no_grad():
+            return model(x)
+    return run
+
+
+def report(netG, quantized, inputs, targets, onnx_models=None, batch_size=8, repeats=5):
+    """
+    Size, latency and L1 of the fp32 and INT8 Generators. The L1 is measured both against the
+    real images and against the fp32 output, which isolates the error added by quantization
+    """
+    fp32 = torch_runner(netG)
+    runners = [('torch fp32', fp32, model_size(netG)),
+            ('torch int8', torch_runner(quantized), model_size(quantized))]
+    for name, (path, onnx_model) in (onnx_models or {}).items():
+        runners.append((name, onnx_model, os.path.getsize(path)))
+
+    reference = torch.cat([torch.as_tensor(fp32(inputs[i:i + batch_size]))
+                        for i in range(0, len(inputs), batch_size)])
+    x = inputs[:batch_size]
+    results = []
+    for name, run, size in runners:
+        seconds = time_call(lambda: run(x), repeats)
+        results.append({'model': name, 'size_mb': size / 2 ** 20,
+                        'ms_per_image': seconds * 1000 / len(x),
+                        'l1_real': mean_l1(run, inputs, targets, batch_size),
+                        'l1_fp32': mean_l1(run, inputs, reference, batch_size)})
+    base = results[0]['ms_per_image']
+    for r in results:
+        r['speedup'] = base / r['ms_per_image']
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Quantize a trained Generator to INT8')
+    parser.add_argument('--ckpt-dir', required=True, help='checkpoint folder of the model')
+    parser.add_argument('--epoch', default=None, help='checkpoint to quantize (latest by default)')
+    parser.add_argument('--folder', required=True, help='data folder, the test split is used for calibration')
+    parser.add_argument('--paired-folders', action='store_true')
+    parser.add_argument('--calibration-size', type=int, default=32)
+    parser.add_argument('--backend', default=None, help='fbgemm or x86')
+    parser.add_argument('--onnx', action='store_true', help='also write and evaluate an INT8 ONNX model')
+    parser.add_argument('--out-dir', default='exported')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    model = load_checkpoint(args.ckpt_dir, args.epoch)
+    netG = model.netG.cpu().eval()
+    inputs, targets = load_test_split(args.folder, args.paired_folders)
+    # The first images calibrate, all of them are used to measure the degradation
+    calibration = inputs[:args.calibration_size]
+
+    quantized = quantize_generator(netG, calibration, args.backend, args.batch_size)
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+    name = os.path.basename(os.path.normpath(args.ckpt_dir))
+    torch_path = os.path.join(args.out_dir, f'{name}_int8.pt')
+    torch.jit.save(torch.jit.trace(quantized, calibration[:1]), torch_path)
+    print(f'INT8 TorchScript Generator saved to {torch_path}')
+
+    onnx_models = {}
+    if args.onnx:
+        onnx_path = os.path.join(args.out_dir, f'{name}_int8.onnx')
+        fp32_path = quantize_onnx(netG, onnx_path, calibration)
+        onnx_models['onnx fp32'] = (fp32_path, OnnxGenerator(fp32_path))
+        onnx_models['onnx int8'] = (onnx_path, OnnxGenerator(onnx_path))
+        print(f'INT8 ONNX Generator saved to {onnx_path}')
+
+    print(f'Calibrated on {len(calibration)} images, evaluated on {len(inputs)}')
+    print('model      | size MB | ms/image | speedup | L1 to real | L1 to fp32')
+    for r in report(netG, quantized, inputs, targets, onnx_models, args.batch_size, args.repeats):
+        print(f"{r['model']:10s} | {r['size_mb']:7.1f} | {r['ms_per_image']:8.1f} | {r['speedup']:7.2f} | {r['l1_real']:10.4f} | {r['l1_fp32']:10.4f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,16 @@
 import os
-import shutil
+from pix2pix_helpers.staging import stage_folder
 
-def relocate_files(source, target):
+def relocate_files(source, target, mode='copy', dedupe=False, workers=None):
     """
-    Use this script to move files to a folder
+    Use this script to move files to a folder.
+    Files are copied. With mode='auto' they are reflinked or hardlinked where the filesystem allows and
+    copied otherwise (see staging). With dedupe, files with the same content as an earlier file are skipped
     """
 
     source = os.path.realpath(source)
     target = os.path.realpath(target)
 
-    if not os.path.isdir(target):
-        os.makedirs(target)
-    
-    for (dirpath, dirnames, filenames) in os.walk(source):
-        for filename in filenames:
-            srcPath = os.path.join(dirpath, filename)
-            toPath = os.path.join(target, filename)
-            if os.path.isfile(toPath):
-                print(f"File {toPath} exists! Overwriting has been avoided")
-            else:
-                shutil.copy(srcPath, toPath)
+    counts = stage_folder(source, target, mode=mode, dedupe=dedupe, workers=workers)
+    print(f"Staged {source} into {target}: " + ', '.join(f'{count} {method}' for method, count in sorted(counts.items())))
+    return counts
@@ -1,49 +1,116 @@
 from PIL import Image
 from PIL import ImageOps
 import os
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+from pix2pix_helpers.image_files import is_image_file
 
-def scale_up(folder, factor=2):
+##
+# Batch rescaling of the images in a folder, in place. Images are processed on a process pool, scaled with
+# nearest neighbour (so the palette colors of the grid images are preserved) and replaced atomically,
+# so an interrupted run never leaves a truncated image behind.
+# fast=True trades exactness for speed when scaling down photos: JPEGs are decoded at reduced size (draft)
+# and other images are box-filtered by Image.reduce.
+##
+
+def scale_up_image(im, factor):
     """
-    This method scales up the images in the folder by the given factor
-    and then crops to the original size, expected to be 256x256
+    Scales up by factor and crops the center back to the original size
     """
-    for (dirpath, dirnames, filenames) in os.walk(folder):
-        for filename in filenames:
-            if '.jpg' in filename:
-                filepath = os.path.join(dirpath, filename)
-                im = Image.open(filepath)
-                (width, height) = im.size
+    width, height = im.size
+    scaled_width, scaled_height = int(width * factor), int(height * factor)
+    left, top = (scaled_width - width) // 2, (scaled_height - height) // 2
+    if factor == int(factor):
+        # Resampling only the source box of the crop gives the same pixels without the full scaled image
+        box = (left / factor, top / factor, (left + width) / factor, (top + height) / factor)
+        return im.resize((width, height), resample=Image.NEAREST, box=box)
+    scaled = im.resize((scaled_width, scaled_height), resample=Image.NEAREST)
+    return scaled.crop((left, top, left + width, top + height))
 
-                width = width * factor
-                height = height * factor
 
-                left = int(width / factor * 2)
-                top = int(height / factor * 2)
-                right = left + 256
-                bottom = top + 256
+def pad_white(im, size):
+    width, height = size
+    left, top = (width - im.size[0]) // 2, (height - im.size[1]) // 2
+    border = (left, top, width - im.size[0] - left, height - im.size[1] - top)
+    return ImageOps.expand(im.convert('RGB'), border, fill=(255, 255, 255))
 
-                im = im.resize((width, height), resample=Image.NEAREST)
-                im = im.crop((left, top, right, bottom))
 
-                im.save(filepath)
+def scale_image(im, mode, factor, fast=False):
+    """
+    Scaled copy of a PIL image, mode is 'up' or 'down'
+    """
+    size = im.size
+    if mode == 'down' and fast:
+        scaled = (int(size[0] / factor), int(size[1] / factor))
+        if im.format == 'JPEG':
+            # Decode directly at 1/2, 1/4 or 1/8 of the size in the JPEG decoder
+            im.draft('RGB', scaled)
+        # reducing_gap lets PIL reduce() by an integer factor before the final resampling
+        return pad_white(im.resize(scaled, resample=Image.BOX, reducing_gap=2.0), size)
 
+    if mode == 'up':
+        return scale_up_image(im, factor)
+    scaled = im.resize((int(size[0] / factor), int(size[1] / factor)), resample=Image.NEAREST)
+    return pad_white(scaled, size)
 
-def scale_down(folder, factor=2):
+
+def resize_job(job):
     """
-    This method scales up the images in the folder by the given factor
-    and then crops to the original size, expected to be 256x256
+    Scales one image and replaces it atomically, used both serially and by the worker processes
+    """
+    path, mode, factor, fast = job
+    with Image.open(path) as im:
+        image_format = im.format
+        out = scale_image(im, mode, factor, fast)
+    # Written next to the image and renamed over it, also breaks hardlinks made by staging
+    tmp_path = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.tmp')
+    try:
+        out.save(tmp_path, format=image_format)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path
+
+
+def resize_folder(folder, mode, factor=2, workers=None, fast=False):
+    """
+    Scales every image in the folder (any extension in IMG_EXTENSIONS) up or down by factor.
+    Use workers=1 to run serially, None uses one process per core
     """
+    assert mode in ('up', 'down'), f"Unknown resize mode '{mode}'"
+    paths = []
     for (dirpath, dirnames, filenames) in os.walk(folder):
-        for filename in filenames:
-            if '.jpg' in filename:
-                filepath = os.path.join(dirpath, filename)
-                im = Image.open(filepath)
-                (width, height) = im.size
+        paths.extend(os.path.join(dirpath, filename) for filename in sorted(filenames)
+                    if is_image_file(filename))
+    jobs = [(path, mode, factor, fast) for path in paths]
+
+    if workers == 1:
+        results = map(resize_job, jobs)
+        for _ in tqdm(results, total=len(jobs)):
+            pass
+        return len(jobs)
 
-                width = int(width / factor)
-                height = int(height / factor)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunksize = max(1, len(jobs) // ((workers or os.cpu_count() or 1) * 8))
+        for _ in tqdm(executor.map(resize_job, jobs, chunksize=chunksize), total=len(jobs)):
+            pass
+    return len(jobs)
 
-                im = im.resize((width, height), resample=Image.NEAREST)
-                im = ImageOps.expand(im, 64, fill=(255, 255, 255))
 
-                im.save(filepath)
+def scale_up(folder, factor=2, workers=None):
+    """
+    This method scales up the images in the folder by the given factor
+    and then crops to the original size, expected to be 256x256
+    """
+    return resize_folder(folder, 'up', factor, workers)
+
+
+def scale_down(folder, factor=2, workers=None, fast=False):
+    """
+    This method scales down the images in the folder by the given factor
+    and then pads with white to the original size, expected to be 256x256.
+    fast=True is for photos only, see the top of this file
+    """
+    return resize_folder(folder, 'down', factor, workers, fast)
@@ -0,0 +1,211 @@
+import io
+import json
+import time
+import queue
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import torch
+from PIL import Image
+from pix2pix_helpers.inference import GeneratorInference
+
+##
+# Local inference service for the Unity client. netG stays loaded, and concurrent requests are
+# coalesced into micro-batches: a batch runs when it is full or when its oldest request has waited max_wait_ms.
+#   python -m pix2pix_helpers.server --ckpt-dir checkpoints/tracos_run_1 --port 8000
+# Endpoints:
+#   POST /generate            body is a PNG/JPG image, the response is the generated PNG
+#   POST /generate?format=raw same, but the response is raw RGB bytes (size in X-Width / X-Height)
+#                             raw RGB input is accepted with Content-Type application/octet-stream
+#                             and the X-Width / X-Height headers
+#   GET /metrics              queue depth, batch sizes and latency percentiles as json
+#   GET /health
+##
+
+class MicroBatcher():
+    """
+    Collects requests from many threads into batches for the engine, on a single worker thread
+    """
+    def __init__(self, engine, max_batch=8, max_wait_ms=10, window=1000):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.batch_times = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+        self._thread = threading.Thread(target=self._run, name='MicroBatcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, image):
+        """
+        Queues a uint8 3xHxW tensor, returns a Future of the uint8 3xHxW output
+        """
+        future = Future()
+        self._queue.put((image, future, time.perf_counter()))
+        return future
+
+    def _collect(self):
+        # Block for the first request, then wait at most max_wait for the batch to fill up
+        batch = [self._queue.get()]
+        deadline = batch[0][2] + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=max(remaining, 0)) if remaining > 0
+                            else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            start = time.perf_counter()
+            try:
+                outputs = self.engine.predict(torch.stack([image for image, _, _ in batch]))
+            except Exception as e:
+                with self._lock:
+                    self.errors += len(batch)
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            end = time.perf_counter()
+            with self._lock:
+                self.batches += 1
+                self.requests += len(batch)
+                self.batch_sizes.append(len(batch))
+                self.batch_times.append(end - start)
+                for _, _, queued in batch:
+                    self.latencies.append(end - queued)
+            for output, (_, future, _) in zip(outputs, batch):
+                future.set_result(output)
+
+    def metrics(self):
+        with self._lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_times = np.array(self.batch_times) * 1000
+            result = {'queue_depth': self._queue.qsize(), 'requests': self.requests, 'batches': self.batches,
+                    'errors': self.errors, 'max_batch': self.max_batch, 'max_wait_ms': self.max_wait * 1000,
+                    'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0}
+        if len(latencies) > 0:
+            result['latency_ms'] = {'p50': float(np.percentile(latencies, 50)),
+                                    'p90': float(np.percentile(latencies, 90)),
+                                    'p99': float(np.percentile(latencies, 99))}
+            result['batch_ms'] = {'mean': float(batch_times.mean()), 'p90': float(np.percentile(batch_times, 90))}
+        return result
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    # Set by create_server
+    batcher = None
+    engine = None
+
+    def log_message(self, format, *args):
+        # One line per request is too much under load
+        pass
+
+    def send_body(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, obj):
+        self.send_body(status, json.dumps(obj).encode(), 'application/json')
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/metrics':
+            self.send_json(200, self.batcher.metrics())
+        elif path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def read_image(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Type') == 'application/octet-stream':
+            width, height = int(self.headers['X-Width']), int(self.headers['X-Height'])
+            return Image.fromarray(np.frombuffer(body, dtype=np.uint8).reshape(height, width, 3))
+        return Image.open(io.BytesIO(body))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/generate':
+            self.send_json(404, {'error': 'not found'})
+            return
+        try:
+            image = self.engine.load_image(self.read_image())
+        except Exception as e:
+            self.send_json(400, {'error': f'could not read the image: {e}'})
+            return
+
+        try:
+            output = self.batcher.submit(image).result().permute(1, 2, 0).numpy()
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+
+        height, width, _ = output.shape
+        if parse_qs(url.query).get('format', ['png'])[0] == 'raw':
+            self.send_body(200, np.ascontiguousarray(output).tobytes(), 'application/octet-stream',
+                        {'X-Width': width, 'X-Height': height})
+        else:
+            buffer = io.BytesIO()
+            # Lowest compression, the images are small and latency matters more than size here
+            Image.fromarray(output).save(buffer, format='PNG', compress_level=1)
+            self.send_body(200, buffer.getvalue(), 'image/png')
+
+
+def create_server(engine, host='127.0.0.1', port=8000, max_batch=8, max_wait_ms=10):
+    """
+    HTTP server around a GeneratorInference engine. Call serve_forever() on the result
+    """
+    batcher = MicroBatcher(engine, max_batch, max_wait_ms)
+    handler = type('Handler', (InferenceHandler,), {'batcher': batcher, 'engine': engine})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.batcher = batcher
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve a trained Generator over HTTP')
+    parser.add_argument('--ckpt-dir', required=True, help='checkpoint folder of the model')
+    parser.add_argument('--epoch', default='latest', help="checkpoint to serve, 'latest', 'best' or an epoch")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch', type=int, default=8, help='largest micro-batch')
+    parser.add_argument('--max-wait-ms', type=float, default=10, help='latency budget to fill a micro-batch')
+    parser.add_argument('--threads', type=int, default=None, help='intra-op threads')
+    parser.add_argument('--compile', default=None, choices=['script', 'compile'])
+    parser.add_argument('--fuse', action='store_true', help='fold the BatchNorms into the convolutions')
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    engine = GeneratorInference.from_checkpoint(args.ckpt_dir, args.epoch, batch_size=args.max_batch,
+                                                compile=args.compile, fuse=args.fuse)
+    server = create_server(engine, args.host, args.port, args.max_batch, args.max_wait_ms)
+    print(f'Serving {args.ckpt_dir} on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import io
+import time
+import argparse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+##
+# Stand-in for the Unity client of server.py, plus a load generator to test the micro-batching.
+#   python -m pix2pix_helpers.server_client --url http://127.0.0.1:8000 --concurrency 8 --requests 200
+##
+
+class InferenceClient():
+    def __init__(self, url='http://127.0.0.1:8000', timeout=60):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _request(self, path, data=None, headers=None):
+        request = urllib.request.Request(self.url + path, data=data, headers=headers or {})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return response.read(), response.headers
+
+    def generate(self, image, raw=False):
+        """
+        Sends an image (path or PIL image) and returns the generated PIL image.
+        raw=True sends and receives raw RGB bytes instead of PNG
+        """
+        if isinstance(image, str):
+            image = Image.open(image)
+        image = image.convert('RGB')
+        if raw:
+            width, height = image.size
+            body, headers = self._request('/generate?format=raw', np.asarray(image).tobytes(),
+                                        {'Content-Type': 'application/octet-stream',
+                                        'X-Width': str(width), 'X-Height': str(height)})
+            shape = (int(headers['X-Height']), int(headers['X-Width']), 3)
+            return Image.fromarray(np.frombuffer(body, dtype=np.uint8).reshape(shape))
+
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG')
+        body, _ = self._request('/generate', buffer.getvalue(), {'Content-Type': 'image/png'})
+        return Image.open(io.BytesIO(body))
+
+    def metrics(self):
+        import json
+        body, _ = self._request('/metrics')
+        return json.loads(body)
+
+
+def synthetic_grid(seed, size=256):
+    """
+    Blocky palette image, similar to the grids produced by Unity
+    """
+    rng = np.random.RandomState(seed)
+    palette = np.array([[0, 0, 0], [255, 0, 0], [255, 255, 0], [255, 255, 255]], dtype=np.uint8)
+    cells = rng.randint(0, len(palette), (size // 8, size // 8))
+    return Image.fromarray(palette[cells].repeat(8, axis=0).repeat(8, axis=1))
+
+
+def generate_load(url, requests=100, concurrency=8, raw=False, images=None):
+    """
+    Sends requests from concurrency threads and returns the client side latency percentiles and throughput
+    """
+    client = InferenceClient(url)
+    if images is None:
+        images = [synthetic_grid(i) for i in range(16)]
+
+    def send(i):
+        start = time.perf_counter()
+        client.generate(images[i % len(images)], raw=raw)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = np.array(list(executor.map(send, range(requests)))) * 1000
+    elapsed = time.perf_counter() - start
+    return {'requests': requests, 'concurrency': concurrency, 'img_s': requests / elapsed,
+            'p50_ms': float(np.percentile(latencies, 50)), 'p90_ms': float(np.percentile(latencies, 90)),
+            'p99_ms': float(np.percentile(latencies, 99))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load generator for the inference server')
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', default='1,8', help='comma separated levels of concurrency')
+    parser.add_argument('--raw', action='store_true', help='send and receive raw RGB instead of PNG')
+    args = parser.parse_args()
+
+    for concurrency in [int(c) for c in args.concurrency.split(',')]:
+        result = generate_load(args.url, args.requests, concurrency, args.raw)
+        print(f"concurrency {concurrency:3d} | {result['img_s']:7.1f} img/s | p50 {result['p50_ms']:7.1f} ms | p90 {result['p90_ms']:7.1f} ms | p99 {result['p99_ms']:7.1f} ms")
+    print(InferenceClient(args.url).metrics())
+
+
+if __name__ == '__main__':
+    main()
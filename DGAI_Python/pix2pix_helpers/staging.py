@@ -0,0 +1,178 @@
+import os
+import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, reflinks are never attempted there
+    fcntl = None
+
+##
+# Staging of dataset files. Files are copied by default. With mode='auto' they are placed without copying
+# their bytes where the filesystem allows it: a reflink (copy-on-write clone, btrfs / xfs / APFS-like
+# filesystems), a hardlink, or a plain copy as the last resort, in that order. With dedupe, identical files
+# are detected by content hash and staged once; only use it on folders of unrelated files, in the A and B
+# folders of a dataset it would drop one image of a pair. Train / test membership is derived from a seeded
+# hash of the file name, so the same files always land in the same split no matter the listing order.
+# Note that a hardlinked file shares its content with the source: replace files (os.replace) instead of
+# writing into them, as resize_image does.
+##
+
+# ioctl request cloning a whole file on Linux (FICLONE from linux/fs.h)
+FICLONE = 0x40049409
+
+METHODS = ('reflink', 'hardlink', 'copy')
+
+# Methods that failed between two filesystems, keyed by (source device, target device)
+_unsupported = {}
+_unsupported_lock = threading.Lock()
+
+
+def reflink(src, dst):
+    """
+    Copy-on-write clone of src at dst, raises OSError when the filesystem does not support it
+    """
+    if fcntl is None:
+        raise OSError('reflinks are not supported on this platform')
+    try:
+        with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+            fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        raise
+
+
+def place_file(src, dst, mode='auto'):
+    """
+    Places src at dst with the given method, or with the first method that works when mode is 'auto'.
+    Returns the method used
+    """
+    assert mode == 'auto' or mode in METHODS, f"Unknown staging mode '{mode}'"
+    methods = METHODS if mode == 'auto' else (mode,)
+    devices = (os.stat(src).st_dev, os.stat(os.path.dirname(dst) or '.').st_dev)
+    for method in methods:
+        if method != 'copy' and (devices, method) in _unsupported:
+            continue
+        try:
+            if method == 'reflink':
+                reflink(src, dst)
+            elif method == 'hardlink':
+                os.link(src, dst)
+            else:
+                shutil.copy(src, dst)
+            return method
+        except OSError:
+            if mode != 'auto' or method == 'copy':
+                raise
+            # Do not try this method again between the same filesystems
+            with _unsupported_lock:
+                _unsupported[(devices, method)] = True
+
+
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def find_duplicates(paths, workers=None):
+    """
+    Maps every path whose content is identical to an earlier path (in the given order) to that path.
+    Only files with the same size are hashed
+    """
+    by_size = {}
+    for path in paths:
+        by_size.setdefault(os.path.getsize(path), []).append(path)
+    candidates = [path for group in by_size.values() if len(group) > 1 for path in group]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        hashes = dict(zip(candidates, executor.map(file_hash, candidates)))
+    first = {}
+    duplicates = {}
+    for path in paths:
+        if path not in hashes:
+            continue
+        key = (os.path.getsize(path), hashes[path])
+        if key in first:
+            duplicates[path] = first[key]
+        else:
+            first[key] = path
+    return duplicates
+
+
+def name_key(name, seed=0):
+    """
+    Seeded hash of a file name. The extension is ignored, so x.png and x.jpg always land in the same split
+    """
+    stem = os.path.splitext(os.path.basename(name))[0]
+    return hashlib.sha1(f'{seed}:{stem}'.encode()).digest()
+
+
+def is_test(name, test_fraction, seed=0):
+    return int.from_bytes(name_key(name, seed)[:8], 'big') / 2 ** 64 < test_fraction
+
+
+def split_files(names, test_count=None, test_fraction=None, seed=0):
+    """
+    Returns the set of names in the test split. With test_fraction every name is assigned on its own,
+    with test_count the test_count names with the lowest seeded hash are picked.
+    Either way the split does not depend on the order the names are listed in
+    """
+    assert (test_count is None) != (test_fraction is None), 'Give either test_count or test_fraction'
+    if test_fraction is not None:
+        return set(name for name in names if is_test(name, test_fraction, seed))
+    return set(sorted(names, key=lambda name: name_key(name, seed))[:test_count])
+
+
+def stage_files(jobs, mode='copy', workers=None, desc=None):
+    """
+    Places the (src, dst) jobs in parallel, skipping destinations that exist.
+    Returns the number of files placed with every method, and 'skipped'
+    """
+    def stage(job):
+        src, dst = job
+        if os.path.isfile(dst):
+            print(f"File {dst} exists! Overwriting has been avoided")
+            return 'skipped'
+        if mode == 'move':
+            shutil.move(src, dst)
+            return 'move'
+        return place_file(src, dst, mode)
+
+    counts = {}
+    # File operations are system calls that release the GIL, threads are enough
+    with ThreadPoolExecutor(max_workers=workers or min(32, (os.cpu_count() or 1) * 4)) as executor:
+        for method in tqdm(executor.map(stage, jobs), total=len(jobs), desc=desc):
+            counts[method] = counts.get(method, 0) + 1
+    return counts
+
+
+def stage_folder(source, target, mode='copy', dedupe=False, workers=None):
+    """
+    Stages every file under source into the (flat) target folder. With dedupe, files whose content
+    is identical to an earlier file (in sorted path order) are not staged.
+    Returns the counts of stage_files, and 'duplicate'
+    """
+    source = os.path.realpath(source)
+    target = os.path.realpath(target)
+    if not os.path.isdir(target):
+        os.makedirs(target)
+
+    paths = []
+    for (dirpath, dirnames, filenames) in os.walk(source):
+        dirnames.sort()
+        paths.extend(os.path.join(dirpath, filename) for filename in sorted(filenames))
+
+    duplicates = find_duplicates(paths, workers) if dedupe else {}
+    jobs = [(path, os.path.join(target, os.path.basename(path))) for path in paths if path not in duplicates]
+    counts = stage_files(jobs, mode, workers, desc=f'Staging {source}')
+    if len(duplicates) > 0:
+        counts['duplicate'] = len(duplicates)
+    return counts
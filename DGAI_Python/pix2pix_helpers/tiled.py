@@ -0,0 +1,193 @@
+import os
+import argparse
+import numpy as np
+import torch
+from PIL import Image
+from pix2pix_helpers.inference import GeneratorInference
+
+##
+# Tiled inference for inputs larger than the 256px the Generator was trained on.
+# The input is split into overlapping tiles, the tiles are batched through netG and blended
+# with a smooth window, and the output is produced as strips of finished rows. Only one band
+# of tiles is kept in memory, so memory grows with the width of the input but not its height.
+#   python -m pix2pix_helpers.tiled --ckpt-dir checkpoints/tracos_run_1 --input site.png --output site_out.npy
+##
+
+def tile_starts(length, tile, stride):
+    """
+    Start offsets of the tiles along one axis, the last tile is aligned to the end
+    """
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, stride))
+    starts.append(length - tile)
+    return starts
+
+
+def blend_window(tile, overlap):
+    """
+    2D weights of a tile, 1 in the middle and going smoothly towards 0 over the overlap.
+    The weights never reach 0, so pixels on the border of the image (covered by one tile only) stay defined
+    """
+    weights = np.ones(tile, dtype=np.float32)
+    if overlap > 0:
+        ramp = np.sin(0.5 * np.pi * (np.arange(overlap, dtype=np.float32) + 0.5) / overlap) ** 2
+        weights[:overlap] = ramp
+        weights[tile - overlap:] = ramp[::-1]
+    return weights[:, None] * weights[None, :]
+
+
+def open_input(image):
+    """
+    HxWx3 uint8 array of the input. .npy files are memory-mapped, other images are decoded with PIL
+    """
+    if isinstance(image, str):
+        if image.endswith('.npy'):
+            return np.load(image, mmap_mode='r')
+        image = Image.open(image)
+    if isinstance(image, Image.Image):
+        image = np.asarray(image.convert('RGB'))
+    return image
+
+
+class StripWriter():
+    """
+    Writes strips of rows to .npy (memory-mapped on disk) or binary .ppm, in order
+    """
+    def __init__(self, path, height, width):
+        self.path = path
+        if path.endswith('.npy'):
+            self.out = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(height, width, 3))
+            self.file = None
+        elif path.endswith('.ppm'):
+            self.out = None
+            self.file = open(path, 'wb')
+            self.file.write(b'P6\n%d %d\n255\n' % (width, height))
+        else:
+            raise ValueError('Tiled output must be .npy or .ppm, got %s' % path)
+
+    def write(self, y, strip):
+        if self.out is not None:
+            self.out[y:y + len(strip)] = strip
+        else:
+            self.file.write(np.ascontiguousarray(strip).tobytes())
+
+    def close(self):
+        if self.out is not None:
+            self.out.flush()
+            del self.out
+        else:
+            self.file.close()
+
+
+class TiledInference():
+    """
+    Runs a GeneratorInference engine over inputs of any size in overlapping tiles.
+    Inputs smaller than a tile are padded with pad_value (white, the empty cells of the Unity grids)
+    """
+    def __init__(self, engine, tile=256, overlap=64, pad_value=255):
+        assert 0 <= overlap < tile, 'overlap must be smaller than the tile'
+        self.engine = engine
+        self.tile = tile
+        self.overlap = overlap
+        self.stride = tile - overlap
+        self.pad_value = pad_value
+        self.window = blend_window(tile, overlap)
+
+    def _read_band(self, image, y, padded_width):
+        """
+        Rows y to y + tile of the input, padded with pad_value to a full tile high and padded_width wide.
+        Only this band of a memory-mapped input is read into memory
+        """
+        band = np.asarray(image[y:y + self.tile])
+        rows, width, _ = band.shape
+        if rows == self.tile and width == padded_width:
+            return band
+        padded = np.full((self.tile, padded_width, 3), self.pad_value, dtype=np.uint8)
+        padded[:rows, :width] = band
+        return padded
+
+    def _run_band(self, band, xs):
+        """
+        Generated tiles of one band (tile rows x W) of the input, batched through the engine
+        """
+        tiles = torch.from_numpy(np.stack([band[:, x:x + self.tile] for x in xs])).permute(0, 3, 1, 2)
+        batch_size = self.engine.batch_size
+        outputs = [self.engine.predict(tiles[i:i + batch_size]) for i in range(0, len(tiles), batch_size)]
+        return torch.cat(outputs).permute(0, 2, 3, 1).numpy()
+
+    def strips(self, image):
+        """
+        Generator of (y, strip) with the finished rows of the output, top to bottom
+        """
+        image = open_input(image)
+        height, width, _ = image.shape
+        # Inputs smaller than a tile are padded band by band, never as a whole
+        padded_height, padded_width = max(height, self.tile), max(width, self.tile)
+        ys = tile_starts(padded_height, self.tile, self.stride)
+        xs = tile_starts(padded_width, self.tile, self.stride)
+
+        # Weighted sums and weights of the rows from y0 on, one tile high
+        accumulator = np.zeros((self.tile, padded_width, 3), dtype=np.float32)
+        weights = np.zeros((self.tile, padded_width, 1), dtype=np.float32)
+        y0 = 0
+        for i, y in enumerate(ys):
+            # Every band starts at y0, the first unfinished row
+            band = self._read_band(image, y, padded_width)
+            for x, tile in zip(xs, self._run_band(band, xs)):
+                accumulator[:, x:x + self.tile] += tile * self.window[:, :, None]
+                weights[:, x:x + self.tile] += self.window[:, :, None]
+
+            # Rows above the next band get no more contributions
+            done = (ys[i + 1] if i + 1 < len(ys) else y + self.tile) - y0
+            rows = min(done, height - y0)
+            if rows > 0:
+                strip = accumulator[:rows] / weights[:rows]
+                yield y0, np.clip(np.rint(strip), 0, 255).astype(np.uint8)[:, :width]
+
+            # Shift the unfinished rows to the top of the buffers
+            accumulator[:self.tile - done] = accumulator[done:].copy()
+            weights[:self.tile - done] = weights[done:].copy()
+            accumulator[self.tile - done:] = 0
+            weights[self.tile - done:] = 0
+            y0 += done
+
+    def run(self, image, out_path=None):
+        """
+        Generates the full output. It is streamed to out_path (.npy or .ppm) when given,
+        and returned as an array otherwise
+        """
+        image = open_input(image)
+        height, width, _ = image.shape
+        if out_path is None:
+            output = np.empty((height, width, 3), dtype=np.uint8)
+            for y, strip in self.strips(image):
+                output[y:y + len(strip)] = strip
+            return output
+
+        writer = StripWriter(out_path, height, width)
+        try:
+            for y, strip in self.strips(image):
+                writer.write(y, strip)
+        finally:
+            writer.close()
+        return out_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the Generator over large images in overlapping tiles')
+    parser.add_argument('--ckpt-dir', required=True, help='checkpoint folder of the model')
+    parser.add_argument('--epoch', default='latest')
+    parser.add_argument('--input', required=True, help='input image, or HxWx3 uint8 .npy for very large inputs')
+    parser.add_argument('--output', required=True, help='.npy or .ppm, written row by row')
+    parser.add_argument('--overlap', type=int, default=64)
+    parser.add_argument('--batch-size', type=int, default=8)
+    args = parser.parse_args()
+
+    engine = GeneratorInference.from_checkpoint(args.ckpt_dir, args.epoch, batch_size=args.batch_size)
+    TiledInference(engine, overlap=args.overlap).run(args.input, args.output)
+    print(f'Output written to {os.path.abspath(args.output)}')
+
+
+if __name__ == '__main__':
+    main()
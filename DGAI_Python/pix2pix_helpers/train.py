@@ -0,0 +1,338 @@
+import os
+import time
+import argparse
+import torch
+import torch.utils.data
+import pix2pix_helpers.util as util
+from pix2pix_helpers.create_dataset import ImageFolderLoader, PairedFolderLoader
+from pix2pix_helpers.grid_loader import GridDataset, GridZipDataset
+from pix2pix_helpers.pix2pix_model import Pix2PixModel, generator_config
+from pix2pix_helpers.catalog import CheckpointCatalog, load_weights
+from pix2pix_helpers.profiler import PhaseProfiler
+from pix2pix_helpers.checkpoint import CheckpointWriter, latest_state
+from pix2pix_helpers.data_pipeline import DataPipeline, create_loader
+from pix2pix_helpers import distributed
+
+##
+# Training loop of training.ipynb as a function, so it can also run from a script.
+# Launch with torchrun to train with one process per core group or node, e.g.
+#   torchrun --nproc_per_node=4 -m pix2pix_helpers.train --folder data/tracos --model tracos_run_1
+# batch_size is per process, so the global batch grows with the number of processes (weak scaling).
+# Divide it by the number of processes to keep the global batch fixed (strong scaling).
+##
+
+def create_train_set(folder_name, packed=False, paired_folders=False, grids=False):
+    if grids:
+        # Pairs rendered from the Unity grid CSVs, no image files needed
+        if folder_name.endswith('.zip'):
+            return GridZipDataset(folder_name, phase='train')
+        return GridDataset(folder_name, phase='train')
+    if paired_folders:
+        return PairedFolderLoader(folder_name, phase='train', preprocess='none', batch_transform=True)
+    return ImageFolderLoader(f"{folder_name}/AB", phase='train', preprocess='none',
+                            packed=packed, batch_transform=True)
+
+
+def save_epoch_visuals(model, test_dir, epoch):
+    if not hasattr(model, 'fake_B'):
+        # No step ran yet
+        return
+    # Only the first sample of the batch is saved
+    visuals = dict((name, visual[:1]) for name, visual in model.get_current_visuals().items())
+    util.save_visuals(visuals, os.path.join(test_dir, 'epoch_' + str(epoch) + '.jpg'))
+
+
+def train(folder_name, model_name, epochs=100, batch_size=1, num_workers=4, prefetch=2, autotune=False,
+        packed=False, paired_folders=False, grids=False, amp=False, write_logs=True, save_ckpts=True,
+        save_img_ckpt=True, print_freq=100, log_freq=100, ckpt_freq=10, max_steps=None,
+        profile=False, profile_trace=False, resume=False, keep_last=None, keep_every=None,
+        checkpoint_depth=0, evaluate=False, eval_threads=1, ngf=64, num_downs=8, teacher=None,
+        teacher_epoch='latest'):
+    """
+    Trains the pix2pix model on the images in folder_name for the given number of epochs.
+    With grids=True folder_name holds Unity grid CSVs instead, or is a zip of them, rendered on the fly (see grid_loader).
+    Runs data-parallel when the process was started by torchrun. Returns the trained model.
+    With profile=True the time of every phase of the step is summarized at the end of each epoch,
+    and written to the logs and to a json file per epoch in the log folder.
+    With resume=True training continues from the latest training state in the checkpoint folder.
+    keep_last / keep_every set the retention of the checkpoints, see checkpoint.apply_retention.
+    checkpoint_depth > 0 recomputes that many levels of the Generator during backward to save memory.
+    With evaluate=True every checkpoint is evaluated on the test split by a separate process on eval_threads cores,
+    see evaluation.py
+    The batches are loaded by num_workers persistent workers, prefetch batches ahead, and moved to the device
+    ahead of the step. With autotune both are retuned every epoch from the time spent waiting for data
+    ngf and num_downs set the size of the Generator. With teacher, the name of a trained model, the Generator is
+    distilled from the teacher's checkpoint teacher_epoch, see distill.py
+    """
+    is_distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+    if is_distributed:
+        distributed.setup_distributed()
+    main_process = distributed.is_main_process()
+    world_size = distributed.get_world_size()
+
+    ckpt_dir = os.path.join('checkpoints', model_name)
+    log_dir = 'runs/' + model_name
+    test_dir = 'test/' + model_name
+
+    # Create the required folders and the log writer, on the main process only
+    writer = None
+    if main_process:
+        if save_ckpts and not os.path.isdir(ckpt_dir):
+            os.makedirs(ckpt_dir)
+        if write_logs:
+            from torch.utils.tensorboard import SummaryWriter
+            writer = SummaryWriter(log_dir=log_dir)
+        if save_img_ckpt and not os.path.isdir(test_dir):
+            os.makedirs(test_dir)
+
+    # Create the pix2pix model
+    model = Pix2PixModel(ckpt_dir, model_name, is_train=True, n_epochs=epochs / 2,
+                        n_epochs_decay=epochs / 2, amp=amp, distributed=is_distributed,
+                        checkpoint_depth=checkpoint_depth, ngf=ngf, num_downs=num_downs,
+                        teacher_dir=os.path.join('checkpoints', teacher) if teacher is not None else None,
+                        teacher_epoch=teacher_epoch)
+    model.setup()
+
+    # Create the training data set, sharded over the processes when distributed.
+    # Streamed datasets shard and shuffle themselves, persistent workers keep their caches between epochs
+    train_data = create_train_set(folder_name, packed=packed, paired_folders=paired_folders, grids=grids)
+    train_set = DataPipeline(train_data, batch_size, device=model.device, shuffle=True, num_workers=num_workers,
+                            prefetch=prefetch, autotune=autotune, distributed=is_distributed,
+                            verbose=main_process)
+    total_iters = 0
+    start_epoch = 0
+
+    # Continue from the end of the last saved epoch, with the same data order and learning rate
+    state_path = latest_state(ckpt_dir) if resume else None
+    if state_path is not None:
+        last_epoch, total_iters = model.load_training_state(state_path)
+        start_epoch = last_epoch + 1
+
+    # Checkpoints are written in the background, only the main process writes
+    ckpt_writer = CheckpointWriter(keep_last, keep_every) if save_ckpts and main_process else None
+
+    # Evaluation of the checkpoints as they are written, in its own process
+    watcher = None
+    if evaluate and save_ckpts and main_process:
+        from pix2pix_helpers.evaluation import start_watcher
+        watcher = start_watcher(ckpt_dir, folder_name, packed, paired_folders, grids, threads=eval_threads,
+                                log_dir=os.path.join(log_dir, 'eval') if write_logs else None)
+
+    # Phase timers, and optionally a torch.profiler trace of a few steps of the first epoch
+    profiler = PhaseProfiler(enabled=profile and main_process,
+                            trace_dir=os.path.join(log_dir, 'trace') if profile_trace else None)
+    model.set_profiler(profiler)
+    profiler.start()
+
+    # Initiate the training iteration
+    epoch = start_epoch - 1
+    for epoch in range(start_epoch, epochs):
+        epoch_start_time = time.time()
+        epoch_iter = 0
+        epoch_steps = 0
+        loss_sums = dict((name, 0.0) for name in model.loss_names)
+
+        if epoch != 0:
+            model.update_learning_rate()
+        train_set.set_epoch(epoch)
+
+        # Iterate through the data batches in the training set
+        for i, data in enumerate(profiler.iterate(train_set)):
+            # Setup counters, counting the samples of all processes
+            total_iters += batch_size * world_size
+            epoch_iter += batch_size * world_size
+
+            # Feed input through model, optimize parameters
+            model.set_input(data)
+            model.optimize_parameters()
+            profiler.step()
+            epoch_steps += 1
+            for name in model.loss_names:
+                loss_sums[name] += getattr(model, 'loss_' + name).detach()
+
+            if main_process and total_iters % print_freq == 0:
+                losses = model.get_current_losses()
+                distill = f' | KD L1: {losses["G_KD"]:.3f} | Feat.: {losses["G_feat"]:.3f}' if 'G_KD' in losses else ''
+                print(f'Step {total_iters} | Epoch {epoch} | GAN Loss: {losses["G_GAN"]:.3f} | Gen. L1: {losses["G_L1"]:.3f} | Disc. real: {losses["D_real"]:.3f} | Disc. fake: {losses["D_fake"]:.3f}' + distill)
+                if profile:
+                    print(f'Data: {profiler.last("data"):.3f}s | Step: {profiler.last("step"):.3f}s')
+
+            if writer is not None and total_iters % log_freq == 0:
+                for name, loss in model.get_current_losses().items():
+                    writer.add_scalar(name, loss, total_iters)
+                writer.flush()
+
+            if max_steps is not None and i + 1 >= max_steps:
+                break
+
+        epoch_time = time.time() - epoch_start_time
+        # Mean losses of the epoch, recorded in the checkpoint catalog. A process can get no batches at all,
+        # e.g. with a dataset smaller than the batch or a small shard of a distributed run
+        epoch_losses = {}
+        if epoch_steps > 0:
+            epoch_losses = dict((name, float(loss) / epoch_steps) for name, loss in loss_sums.items())
+
+        if profile and main_process and epoch_steps > 0:
+            profiler.print_summary()
+            if writer is not None:
+                profiler.log_tensorboard(writer, epoch)
+            if not os.path.isdir(log_dir):
+                os.makedirs(log_dir)
+            profiler.save_json(os.path.join(log_dir, f'profile_epoch_{epoch}.json'), epoch=epoch,
+                            batch_size=batch_size, samples_per_second=epoch_iter / epoch_time)
+            profiler.reset()
+
+        # Save checkpoints per epochs
+        if save_ckpts and epoch % ckpt_freq == 0:
+            if main_process:
+                print('Saving the model at the end of epoch %d, iters %d' % (epoch, total_iters))
+            model.save_network(epoch, ckpt_writer)
+            model.save_training_state(epoch, total_iters, ckpt_writer)
+            if main_process:
+                model.catalog.set_metrics(epoch, **epoch_losses)
+
+            # Save image per checkpoint
+            if save_img_ckpt and main_process:
+                save_epoch_visuals(model, test_dir, epoch)
+
+        # Print details at the end of the epoch
+        if main_process:
+            print('End of epoch %d / %d \t Time Taken: %d secs \t %.2f samples/s over %d processes' %
+                (epoch, epochs - 1, epoch_time, epoch_iter / epoch_time, world_size))
+
+    # Save / overwrite final epoch and image
+    if save_ckpts and epoch >= start_epoch:
+        model.save_network(epoch, ckpt_writer)
+        model.save_training_state(epoch, total_iters, ckpt_writer)
+        if main_process:
+            model.catalog.set_metrics(epoch, **epoch_losses)
+        if save_img_ckpt and main_process:
+            save_epoch_visuals(model, test_dir, epoch)
+    if ckpt_writer is not None:
+        ckpt_writer.close()
+    if watcher is not None:
+        # Evaluates the checkpoints that are left and stops
+        process, stop_event = watcher
+        stop_event.set()
+        process.join()
+
+    profiler.stop()
+    if writer is not None:
+        writer.close()
+    if is_distributed:
+        distributed.cleanup_distributed()
+    return model
+
+
+def test(folder_name, model_name, epoch='latest', sample=10, batch_size=1, packed=False, paired_folders=False,
+        num_workers=0):
+    """
+    Saves input, generated and real images of the first sample test images, like the test cell of training.ipynb.
+    epoch is an epoch number, 'latest' or 'best'. Returns the folder the images were saved to
+    """
+    ckpt_dir = os.path.join('checkpoints', model_name)
+    test_dir = 'test/' + model_name
+    if not os.path.isdir(test_dir):
+        os.makedirs(test_dir)
+
+    if paired_folders:
+        test_data = PairedFolderLoader(folder_name, phase='test', flip=False, preprocess='none')
+    else:
+        test_data = ImageFolderLoader(f'{folder_name}/AB', phase='test', flip=False, preprocess='none', packed=packed)
+    # Loaded once, the workers do not need to outlive the loop
+    test_set = create_loader(test_data, batch_size, num_workers=num_workers, persistent=False,
+                            pin_memory=torch.cuda.is_available())
+
+    # Distilled students are smaller than the default Generator
+    catalog = CheckpointCatalog(ckpt_dir)
+    ngf, num_downs = generator_config(load_weights(catalog.file_path(catalog.resolve(epoch), 'net_G')))
+    model = Pix2PixModel(ckpt_dir, model_name, is_train=False, ngf=ngf, num_downs=num_downs)
+    model.setup()
+    model.eval()
+    print(f'Testing checkpoint {model.load_networks(epoch)}')
+
+    saved = 0
+    for data in test_set:
+        if saved >= sample:
+            break
+        model.set_input(data)
+        model.test()
+        visuals = model.get_current_visuals()
+        if len(data['A']) > sample - saved:
+            visuals = dict((name, visual[:sample - saved]) for name, visual in visuals.items())
+        util.save_visuals(visuals, os.path.join(test_dir, 'test_' + str(saved) + '.jpg'))
+        saved += len(data['A'])
+    return test_dir
+
+
+def test_main(argv=None):
+    parser = argparse.ArgumentParser(description='Save test images of a trained pix2pix model')
+    parser.add_argument('--folder', required=True, help='folder containing AB/test (or A and B)')
+    parser.add_argument('--model', required=True, help='name of the model')
+    parser.add_argument('--epoch', default='latest', help="checkpoint to test, 'latest', 'best' or an epoch")
+    parser.add_argument('--sample', type=int, default=10, help='number of test images')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--packed', action='store_true')
+    parser.add_argument('--paired-folders', action='store_true')
+    parser.add_argument('--workers', type=int, default=0, help='DataLoader workers')
+    args = parser.parse_args(argv)
+
+    test_dir = test(args.folder, args.model, args.epoch, args.sample, args.batch_size,
+                    args.packed, args.paired_folders, args.workers)
+    print(f'Test images saved to {os.path.abspath(test_dir)}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Train the pix2pix model')
+    parser.add_argument('--folder', required=True, help='folder containing AB/train (or A and B)')
+    parser.add_argument('--model', required=True, help='name of the model, used for checkpoints and logs')
+    parser.add_argument('--epochs', type=int, default=100)
+    parser.add_argument('--batch-size', type=int, default=1, help='batch size per process')
+    parser.add_argument('--workers', type=int, default=4, help='DataLoader workers per process')
+    parser.add_argument('--prefetch', type=int, default=2, help='batches loaded ahead by every worker')
+    parser.add_argument('--autotune-loader', action='store_true',
+                        help='tune the workers and prefetch every epoch from the time spent waiting for data')
+    parser.add_argument('--threads', type=int, default=None, help='intra-op threads per process')
+    parser.add_argument('--packed', action='store_true')
+    parser.add_argument('--paired-folders', action='store_true')
+    parser.add_argument('--grids', action='store_true',
+                        help='folder (or .zip archive) holds Unity grid CSVs instead of images')
+    parser.add_argument('--amp', action='store_true')
+    parser.add_argument('--no-logs', action='store_true')
+    parser.add_argument('--no-ckpts', action='store_true')
+    parser.add_argument('--ckpt-freq', type=int, default=10)
+    parser.add_argument('--print-freq', type=int, default=100)
+    parser.add_argument('--max-steps', type=int, default=None, help='stop every epoch after this many steps')
+    parser.add_argument('--resume', action='store_true', help='continue from the latest training state')
+    parser.add_argument('--keep-last', type=int, default=None, help='keep the checkpoints of the last N epochs only')
+    parser.add_argument('--keep-every', type=int, default=None, help='always keep the epochs that are a multiple of N')
+    parser.add_argument('--profile', action='store_true', help='time the phases of every step')
+    parser.add_argument('--profile-trace', action='store_true', help='also write a torch.profiler trace')
+    parser.add_argument('--checkpoint-depth', type=int, default=0,
+                        help='activation checkpointing of the N outer U-Net levels, -1 for all')
+    parser.add_argument('--evaluate', action='store_true',
+                        help='evaluate every checkpoint on the test split, in a separate process')
+    parser.add_argument('--eval-threads', type=int, default=1, help='intra-op threads of the evaluation process')
+    parser.add_argument('--ngf', type=int, default=64, help='filters of the first Generator layer')
+    parser.add_argument('--num-downs', type=int, default=8, help='downsampling levels of the Generator')
+    parser.add_argument('--teacher', default=None, help='trained model to distill the Generator from')
+    parser.add_argument('--teacher-epoch', default='latest', help="checkpoint of the teacher, 'latest', 'best' or an epoch")
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    train(args.folder, args.model, epochs=args.epochs, batch_size=args.batch_size,
+        num_workers=args.workers, prefetch=args.prefetch, autotune=args.autotune_loader, packed=args.packed, paired_folders=args.paired_folders,
+        grids=args.grids,
+        amp=args.amp, write_logs=not args.no_logs, save_ckpts=not args.no_ckpts,
+        save_img_ckpt=not args.no_ckpts, print_freq=args.print_freq, log_freq=args.print_freq,
+        ckpt_freq=args.ckpt_freq, max_steps=args.max_steps, profile=args.profile or args.profile_trace,
+        profile_trace=args.profile_trace, resume=args.resume, keep_last=args.keep_last,
+        keep_every=args.keep_every, checkpoint_depth=args.checkpoint_depth, evaluate=args.evaluate,
+        eval_threads=args.eval_threads, ngf=args.ngf, num_downs=args.num_downs, teacher=args.teacher,
+        teacher_epoch=args.teacher_epoch)
+
+
+if __name__ == '__main__':
+    main()
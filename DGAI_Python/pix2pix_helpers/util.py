@@ -1,8 +1,9 @@
-import torch
 import numpy as np
 from PIL import Image
 import os
-import matplotlib.pyplot as plt
+
+# torch and matplotlib are imported where they are used, so importing util stays cheap
+# for the scripts that only handle files
 
 def tensor2im(input_image, imtype=np.uint8):
     """"Converts a Tensor array into a numpy image array.
@@ -10,6 +11,7 @@ def tensor2im(input_image, imtype=np.uint8):
     Parameters:
         input_image (tensor) --  the input image tensor array
     """
+    import torch
     input_image = input_image.cpu()
     input_image = torch.add(input_image, 1)
     input_image = torch.div(input_image, 2)
@@ -34,40 +36,51 @@ def save_image(image_numpy, image_path, aspect_ratio=1.0):
     image_pil.save(image_path)
 
 def save_visuals(visuals, test_dir):
-    input = visuals['real_A'].view(3, 256, 256)
-    output = visuals['fake_B'].view(3, 256, 256)
-    real = visuals['real_B'].view(3, 256, 256)
+    """
+    Saves input, generated and real images side by side.
+    With more than one image in the batch, one file per sample is saved, with the index added to the name
+    """
+    batch = [visuals[name].detach() for name in ('real_A', 'fake_B', 'real_B')]
+    batch = [images.unsqueeze(0) if images.dim() == 3 else images for images in batch]
+    n = batch[0].shape[0]
+    root, ext = os.path.splitext(test_dir)
 
-    input = tensor2im(input).detach().numpy() * 255
-    output = tensor2im(output).detach().numpy() * 255
-    real = tensor2im(real).detach().numpy() * 255
+    for i in range(n):
+        images = [np.uint8(tensor2im(images[i]).numpy() * 255) for images in batch]
+        h, w, _ = images[0].shape
 
-    out_im = Image.new('RGB', (256 * 3, 256))
-    out_im.paste(Image.fromarray(np.uint8(input)))
-    out_im.paste(Image.fromarray(np.uint8(output)), (256, 0))
-    out_im.paste(Image.fromarray(np.uint8(real)), (512, 0))
+        out_im = Image.new('RGB', (w * 3, h))
+        out_im.paste(Image.fromarray(images[0]))
+        out_im.paste(Image.fromarray(images[1]), (w, 0))
+        out_im.paste(Image.fromarray(images[2]), (w * 2, 0))
 
-    out_im.save(test_dir)
+        out_im.save(test_dir if n == 1 else f'{root}_{i}{ext}')
 
 
-def plot_visuals(visuals):
-    input = visuals['real_A'].view(3, 256, 256)
-    output = visuals['fake_B'].view(3, 256, 256)
-    real = visuals['real_B'].view(3, 256, 256)
+def plot_visuals(visuals, index=0):
+    """
+    Plots input, generated and real images of one sample of the batch
+    """
+    import matplotlib.pyplot as plt
+    input = visuals['real_A'].detach()
+    output = visuals['fake_B'].detach()
+    real = visuals['real_B'].detach()
+    if input.dim() == 4:
+        input, output, real = input[index], output[index], real[index]
     
     input = tensor2im(input)
     output = tensor2im(output)
     real = tensor2im(real)
     
     fig, axs = plt.subplots(1, 3)
-    axs[0].imshow(input.detach().numpy())
+    axs[0].imshow(input.numpy())
     axs[0].set_title('Input image')
 
     
-    axs[1].imshow(output.detach().numpy())
+    axs[1].imshow(output.numpy())
     axs[1].set_title('Generated image')
 
-    axs[2].imshow(real.detach().numpy())
+    axs[2].imshow(real.numpy())
     axs[2].set_title('Real image')
 
     plt.show()
\ No newline at end of file
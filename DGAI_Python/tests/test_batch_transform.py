@@ -0,0 +1,15 @@
+import pytest
+import torch
+from pix2pix_helpers.create_dataset import PairedBatchTransform, get_transform
+
+
+@pytest.mark.parametrize('preprocess,size', [('resize', (256, 256)), ('scale_width', (200, 300)),
+                                             ('none', (256, 256))])
+def test_batch_transform_matches_get_transform(preprocess, size):
+    torch.manual_seed(0)
+    A = torch.randint(0, 256, (4, 3) + size, dtype=torch.uint8)
+    B = torch.randint(0, 256, (4, 3) + size, dtype=torch.uint8)
+    data = PairedBatchTransform(preprocess=preprocess, flip=False)({'A': A, 'B': B})
+    transform = get_transform(preprocess=preprocess, flip=False, tensor=True)
+    for X, Y in ((A, data['A']), (B, data['B'])):
+        assert torch.equal(Y, torch.stack([transform(x) for x in X]))
@@ -0,0 +1,13 @@
+from pix2pix_helpers.benchmark import STARTUP_BUDGETS, _startup_command, check_startup, imported_packages
+
+
+def test_prepare_startup_budget():
+    budget_ms, _ = STARTUP_BUDGETS['prepare']
+    results = check_startup(('prepare',))
+    assert results['startup.prepare.ms'] <= budget_ms <= 1000
+
+
+def test_prepare_does_not_import_torch_or_matplotlib():
+    imported = imported_packages(_startup_command('prepare', importtime=True).stderr)
+    assert 'torch' not in imported
+    assert 'matplotlib' not in imported
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from pix2pix_helpers.create_dataset import ImageFolderLoader
+from pix2pix_helpers.pack_dataset import pack_dataset
+
+
+@pytest.fixture
+def dataset_root(tmp_path):
+    rng = np.random.default_rng(0)
+    (tmp_path / 'train').mkdir()
+    for i in range(3):
+        AB = rng.integers(0, 256, (200, 400, 3), dtype=np.uint8)
+        Image.fromarray(AB).save(tmp_path / 'train' / f'{i}.png')
+    pack_dataset(str(tmp_path), phases=('train',))
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize('preprocess', ['resize_and_crop', 'scale_width', 'none'])
+def test_packed_matches_files(dataset_root, preprocess):
+    files = ImageFolderLoader(dataset_root, preprocess=preprocess)
+    packed = ImageFolderLoader(dataset_root, preprocess=preprocess, packed=True)
+    assert files.AB_paths == packed.AB_paths
+    for index in range(len(files)):
+        torch.manual_seed(index)
+        expected = files[index]
+        torch.manual_seed(index)
+        sample = packed[index]
+        for key in ('A', 'B'):
+            assert sample[key].shape == expected[key].shape
+            different = (sample[key] != expected[key]).any(0).float().mean().item()
+            if preprocess == 'none':
+                assert different == 0
+            else:
+                # PIL rounds the nearest source pixel in fixed point, so a row or column may differ
+                assert different < 0.02